@@ -0,0 +1,193 @@
+"""
+Benchmark of the sync diff algorithms, against the deepcopy-based versions they replaced
+
+Usage: python benchmarks/bench_diff.py [--sizes 1000 10000 100000] [--json]
+
+Every run also checks the new algorithms return exactly the same action lists as the old ones.
+"""
+import argparse
+import copy
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from octoprint_onedrive_files import sync  # noqa: E402
+
+# Reference copies of the algorithms as they were before the diff engine, comments removed
+
+
+def legacy_two_way_sync(octoprint_data, onedrive_data):
+
+    actions = []
+    octoprint_files_remaining = copy.deepcopy(octoprint_data)
+    for od_file_name, od_file_data in onedrive_data.items():
+        if od_file_name not in octoprint_data:
+            actions.append({"action": "download", "file": od_file_name})
+        else:
+            octoprint_files_remaining.pop(od_file_name)
+            op_file_data = octoprint_data[od_file_name]
+            if "eTag" in op_file_data:
+                if op_file_data["eTag"] != od_file_data["eTag"]:
+                    actions.append({"action": "download", "file": od_file_name})
+            else:
+                actions.append({"action": "upload", "file": od_file_name})
+
+    for op_file_name, op_file_data in octoprint_files_remaining.items():
+        if "eTag" in op_file_data:
+            actions.append({"action": "delete_octoprint", "file": op_file_name})
+        else:
+            actions.append({"action": "upload", "file": op_file_name})
+
+    return actions
+
+
+def legacy_octoprint_sync(octoprint_data, onedrive_data):
+
+    actions = []
+    for od_file_name, od_file_data in onedrive_data.items():
+
+        if od_file_name in octoprint_data:
+            op_file_data = octoprint_data[od_file_name]
+            if "eTag" in op_file_data and op_file_data["eTag"] == od_file_data["eTag"]:
+                continue
+            else:
+                actions.append({"action": "upload", "file": od_file_name})
+        else:
+            actions.append({"action": "delete_onedrive", "file": od_file_name})
+
+    for op_file_name in octoprint_data.keys():
+        if op_file_name not in onedrive_data:
+            actions.append({"action": "upload", "file": op_file_name})
+
+    return actions
+
+
+def legacy_onedrive_sync(octoprint_data, onedrive_data):
+
+    actions = []
+    for od_file_name, od_file_data in onedrive_data.items():
+
+        if od_file_name in octoprint_data:
+            op_file_data = octoprint_data[od_file_name]
+            if "eTag" in op_file_data and op_file_data["eTag"] == od_file_data["eTag"]:
+                continue
+            else:
+                actions.append({"action": "download", "file": od_file_name})
+        else:
+            actions.append({"action": "download", "file": od_file_name})
+
+    for op_file_name, op_file_data in octoprint_data.items():
+        if op_file_name not in onedrive_data:
+            if "eTag" in op_file_data:
+                actions.append({"action": "delete_octoprint", "file": op_file_name})
+
+    return actions
+
+
+ALGORITHMS = {
+    "two": (legacy_two_way_sync, sync.two_way_sync),
+    "octoprint": (legacy_octoprint_sync, sync.octoprint_sync),
+    "onedrive": (legacy_onedrive_sync, sync.onedrive_sync),
+}
+
+
+def make_data(size, seed=0):
+    """
+    Build a realistic pair of listings: most files in sync, with a few percent each
+    added, removed, modified & untracked
+    """
+    rng = random.Random(seed)
+
+    octoprint_data = {}
+    onedrive_data = {}
+    for i in range(size):
+        path = f"/folder_{i % 97}/sub_{i % 13}/file_{i}.gcode"
+        etag = f"{{{i:08X}-0000-0000-0000-000000000000}},1"
+        roll = rng.random()
+
+        def onedrive_file(etag):
+            return {
+                "id": str(i),
+                "eTag": etag,
+                "hash": "",
+                "size": 0,
+                "downloadUrl": "",
+            }
+
+        if roll < 0.02:
+            # Added in OneDrive
+            onedrive_data[path] = onedrive_file(etag)
+        elif roll < 0.04:
+            # Removed from OneDrive
+            octoprint_data[path] = {"eTag": etag, "id": str(i)}
+        elif roll < 0.05:
+            # Added in OctoPrint
+            octoprint_data[path] = {}
+        elif roll < 0.07:
+            # Modified in OneDrive
+            onedrive_data[path] = onedrive_file(etag[:-1] + "2")
+            octoprint_data[path] = {"eTag": etag, "id": str(i)}
+        elif roll < 0.08:
+            # Overwritten in OctoPrint
+            onedrive_data[path] = onedrive_file(etag)
+            octoprint_data[path] = {}
+        else:
+            onedrive_data[path] = onedrive_file(etag)
+            octoprint_data[path] = {"eTag": etag, "id": str(i)}
+
+    return octoprint_data, onedrive_data
+
+
+def best_of(func, args, repeat):
+    return min(timeit.repeat(lambda: func(*args), number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="Output results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        data = make_data(size)
+        for mode, (legacy, current) in ALGORITHMS.items():
+            # Actions now carry the OneDrive metadata too, compare what is done to which file
+            current_actions = [(a["action"], a["file"]) for a in current(*data)]
+            legacy_actions = [(a["action"], a["file"]) for a in legacy(*data)]
+            if legacy_actions != current_actions:
+                raise AssertionError(
+                    f"Action lists differ for mode {mode}, size {size}"
+                )
+
+            results.append(
+                {
+                    "size": size,
+                    "mode": mode,
+                    "legacy_seconds": best_of(legacy, data, args.repeat),
+                    "seconds": best_of(current, data, args.repeat),
+                }
+            )
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(
+        f"{'paths':>8} {'mode':>10} {'legacy (ms)':>12} {'new (ms)':>10} {'speedup':>8}"
+    )
+    for result in results:
+        print(
+            f"{result['size']:>8} {result['mode']:>10} "
+            f"{result['legacy_seconds'] * 1000:>12.2f} {result['seconds'] * 1000:>10.2f} "
+            f"{result['legacy_seconds'] / result['seconds']:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+"""
+Benchmark of a full sync run, against an in-memory OneDrive and a temporary OctoPrint folder
+
+Usage: python benchmarks/bench_sync.py [--sizes 1000 10000] [--shapes flat wide deep]
+                                       [--modes onedrive two octoprint] [--delta]
+                                       [--action-concurrency 2 1 4] [--latency MS] [--change-ratio 0.01] [--output FILE]
+                                       [--low-priority]
+
+Each combination of size, tree shape & sync mode gets three runs:
+    cold: the first run after startup, OctoPrint folder scanned & OneDrive fully listed
+    warm: nothing changed since the last run
+    changed: a fraction of the OneDrive files were modified, added or deleted
+    subtree (with --subtree): as changed, but only one folder is synced
+
+Phases (OctoPrint listing, OneDrive listing, diff, actions) are timed separately, results
+are written as JSON so they can be compared between versions. The wake up latency of a normal
+priority thread during each run is recorded too, compare with & without --low-priority.
+"""
+import argparse
+import functools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from octoprint.events import Events  # noqa: E402
+
+from benchmarks import fakes  # noqa: E402
+from octoprint_onedrive_files import sync  # noqa: E402
+from octoprint_onedrive_files.delta import DeltaListing  # noqa: E402
+from octoprint_onedrive_files.downloads import (  # noqa: E402
+    DownloadStaging,
+    staging_folder,
+)
+from octoprint_onedrive_files.index import SyncIndex  # noqa: E402
+from octoprint_onedrive_files.metrics import SyncMetrics  # noqa: E402
+from octoprint_onedrive_files.priority import LatencyProbe, lower_priority  # noqa: E402
+from octoprint_onedrive_files.progress import TransferProgress  # noqa: E402
+from octoprint_onedrive_files.throttle import BandwidthLimiter  # noqa: E402
+from octoprint_onedrive_files.tracking import OctoPrintChangeTracker  # noqa: E402
+from octoprint_onedrive_files.uploads import UploadSessions  # noqa: E402
+
+SHAPES = {
+    # name: (depth, fanout)
+    "flat": (0, 0),
+    "wide": (2, 16),
+    "deep": (6, 2),
+}
+
+FILE_EVENTS = (
+    Events.FILE_ADDED,
+    Events.FILE_REMOVED,
+    Events.FOLDER_ADDED,
+    Events.FOLDER_REMOVED,
+)
+
+
+def mutate(tree, ratio, rng):
+    """
+    Modify, touch (new eTag, same content), add & delete a fraction of the files in OneDrive
+    (2:1:1:1)
+    """
+    paths = list(tree.paths)
+    count = max(1, int(len(paths) * ratio))
+    chosen = rng.sample(paths, min(len(paths), count))
+
+    for i, path in enumerate(chosen):
+        if i % 5 < 2:
+            tree.modify(path)
+        elif i % 5 == 2:
+            tree.modify(path, content=False)
+        elif i % 5 == 3:
+            tree.delete(path)
+        else:
+            folder_path = path.rsplit("/", 1)[0] + "/"
+            tree.add_file(tree.folder_for(path), folder_path, f"new_{i}.gcode")
+
+
+def in_thread(target, low_priority=False):
+    """Call target in a new thread, at low priority if asked, returning its result"""
+    result = {}
+
+    def run():
+        if low_priority:
+            lower_priority()
+        result["value"] = target()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    return result["value"]
+
+
+def print_progress(progress):
+    print(
+        f"  {progress['files_done']}/{progress['files_total']} files, "
+        f"{progress['done']}/{progress['total']} bytes, "
+        f"{progress['throughput']} B/s, eta {progress['eta']}s",
+        file=sys.stderr,
+    )
+
+
+def run_benchmark(size, shape, mode, args, event_manager, latency_probe, metrics):
+    depth, fanout = SHAPES[shape]
+    workdir = tempfile.mkdtemp(prefix="onedrive-bench-")
+    results = []
+
+    try:
+        tree = fakes.RemoteTree(size, depth, fanout, file_size=args.file_size)
+        file_manager = fakes.make_file_manager(os.path.join(workdir, "uploads"))
+        index = SyncIndex(os.path.join(workdir, "index.db"))
+        tracker = OctoPrintChangeTracker()
+        delta_listing = DeltaListing(os.path.join(workdir, "delta.json"))
+        upload_sessions = UploadSessions(os.path.join(workdir, "uploads.json"))
+        download_staging = DownloadStaging(
+            staging_folder(workdir, os.path.join(workdir, "uploads"))
+        )
+
+        # Stand in for the plugin's on_event, feeding OctoPrint's file events to the tracker
+        def on_file_event(event, payload):
+            tracker.mark_dirty(payload["path"])
+
+        for event in FILE_EVENTS:
+            event_manager.subscribe(event, on_file_event)
+
+        fakes.mirror_to_octoprint(tree, file_manager, index)
+
+        # As while printing, with --trickle
+        transfer_limits = {}
+        if args.trickle:
+            transfer_limits = {
+                "bandwidth": args.trickle[0],
+                "concurrency": args.trickle[1],
+            }
+
+        graph = fakes.FakeGraphClient(
+            tree,
+            latency=args.latency / 1000,
+            rate_limit=args.server_rate,
+            bandwidth=BandwidthLimiter(lambda: transfer_limits.get("bandwidth", 0)),
+        )
+        graph.expire_download_urls = args.expired_urls
+        onedrive = fakes.FakeOneDriveComm(tree, latency=args.latency / 1000)
+        config = {
+            "mode": mode,
+            "interval": 3600,
+            "onedrive_folder": fakes.ROOT_ID,
+            "octoprint_folder": "OneDrive",
+            "max_depth": depth,
+            "delta": args.delta,
+            "list_concurrency": args.list_concurrency,
+            "reconcile_interval": 24 * 60 * 60,
+            "concurrency": {
+                "download": args.action_concurrency[0],
+                "upload": args.action_concurrency[1],
+                "delete": args.action_concurrency[2],
+            },
+            "placeholders": args.placeholders,
+            "cache_size": args.cache_size,
+        }
+
+        rng = random.Random(size)
+        runs = ["cold", "warm", "changed"]
+        if args.subtree:
+            runs.append("subtree")
+
+        for run in runs:
+            if run in ("changed", "subtree"):
+                mutate(tree, args.change_ratio, rng)
+
+            subtree = args.subtree if run == "subtree" else None
+            requests_before = graph.requests + onedrive.requests
+            start = time.monotonic()
+            progress = TransferProgress(print_progress) if args.progress else None
+            with latency_probe.measure():
+                summary = in_thread(
+                    functools.partial(
+                        sync.run_sync,
+                        onedrive,
+                        file_manager,
+                        config,
+                        index,
+                        tracker,
+                        delta_listing=delta_listing,
+                        graph=graph,
+                        upload_sessions=upload_sessions,
+                        download_staging=download_staging,
+                        transfer_limits=lambda: transfer_limits,
+                        subtree=subtree,
+                        metrics=metrics,
+                        progress=progress,
+                    ),
+                    args.low_priority,
+                )
+            metrics.run_done(summary)
+            total = time.monotonic() - start
+            fakes.wait_for_events(event_manager)
+
+            results.append(
+                {
+                    "size": size,
+                    "shape": shape,
+                    "depth": depth,
+                    "fanout": fanout,
+                    "mode": mode,
+                    "delta": args.delta,
+                    "latency_ms": args.latency,
+                    "run": run,
+                    "total_seconds": total,
+                    "phases": summary["phases"],
+                    "phase_requests": summary["requests"],
+                    "files": summary["files"],
+                    "actions": summary["actions"],
+                    "failed": summary["failed"],
+                    "throttled": summary["throttled"],
+                    "evicted": summary["evicted"],
+                    "latency": latency_probe.stats(),
+                    "requests": graph.requests + onedrive.requests - requests_before,
+                }
+            )
+
+        for event in FILE_EVENTS:
+            event_manager.unsubscribe(event, on_file_event)
+        index.close()
+
+    finally:
+        fakes.cleanup(workdir)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1000, 10000, 50000, 200000]
+    )
+    parser.add_argument(
+        "--shapes", nargs="+", choices=list(SHAPES), default=list(SHAPES)
+    )
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=["onedrive", "octoprint", "two"],
+        default=["onedrive"],
+    )
+    parser.add_argument("--delta", action="store_true", help="Use delta listing")
+    parser.add_argument("--list-concurrency", type=int, default=4)
+    parser.add_argument(
+        "--action-concurrency",
+        type=int,
+        nargs=3,
+        default=[2, 1, 4],
+        metavar=("DOWNLOAD", "UPLOAD", "DELETE"),
+        help="Number of each type of action to run at the same time",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Simulated latency per request (ms)"
+    )
+    parser.add_argument(
+        "--expired-urls",
+        action="store_true",
+        help="Download URLs from the listing have expired, so downloads fall back",
+    )
+    parser.add_argument(
+        "--server-rate",
+        type=float,
+        help="Requests per second the fake server allows before throttling (429)",
+    )
+    parser.add_argument(
+        "--trickle",
+        type=int,
+        nargs=2,
+        metavar=("BYTES_PER_SEC", "TRANSFERS"),
+        help="Hold transfers to these limits, as while printing",
+    )
+    parser.add_argument(
+        "--subtree",
+        help="Add a run syncing only this folder, e.g. /folder_0, after another change",
+    )
+    parser.add_argument(
+        "--low-priority",
+        action="store_true",
+        help="Run the sync at low CPU & I/O priority, as the plugin does",
+    )
+    parser.add_argument(
+        "--placeholders",
+        action="store_true",
+        help="Add placeholders for new files in OneDrive instead of downloading them",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=0,
+        help="Bytes the synced files may take up before the least recently used are "
+        "evicted to placeholders",
+    )
+    parser.add_argument("--change-ratio", type=float, default=0.01)
+    parser.add_argument("--file-size", type=int, default=256, help="Bytes per file")
+    parser.add_argument(
+        "--progress", action="store_true", help="Print transfer progress as it is sent"
+    )
+    parser.add_argument("--output", help="Write JSON results here instead of stdout")
+    parser.add_argument(
+        "--prometheus",
+        help="Write the metrics from all runs here, as Prometheus would see",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    basedir = tempfile.mkdtemp(prefix="onedrive-bench-octoprint-")
+    try:
+        event_manager = fakes.init_octoprint(basedir)
+
+        # Started here, so it keeps normal priority
+        latency_probe = LatencyProbe()
+        latency_probe.start()
+
+        metrics = SyncMetrics()
+        results = []
+        for size in args.sizes:
+            for shape in args.shapes:
+                for mode in args.modes:
+                    for result in run_benchmark(
+                        size, shape, mode, args, event_manager, latency_probe, metrics
+                    ):
+                        results.append(result)
+                        phases = " ".join(
+                            f"{name}={seconds:.3f}s"
+                            for name, seconds in result["phases"].items()
+                        )
+                        print(
+                            f"{size:>7} {shape:>5} {mode:>9} {result['run']:>8}: "
+                            f"{result['total_seconds']:.3f}s ({phases}) "
+                            f"{result['requests']} requests, "
+                            f"{result['throttled']['seconds']:.1f}s throttled, "
+                            f"latency p99 {result['latency']['p99']}ms",
+                            file=sys.stderr,
+                        )
+    finally:
+        fakes.cleanup(basedir)
+
+    if args.prometheus:
+        with open(args.prometheus, "w") as f:
+            f.write(metrics.prometheus())
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
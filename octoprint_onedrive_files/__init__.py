@@ -1,11 +1,16 @@
+import functools
+import operator
 import time
 from pathlib import Path
 
+import flask
 import octo_onedrive.onedrive
 import octoprint.plugin
+from octoprint.access.permissions import Permissions
+from octoprint.events import Events
 from octoprint.util.version import is_octoprint_compatible
 
-from . import _version, api, sync
+from . import _version, api, placeholders, sync
 
 APPLICATION_ID = "192e2408-1e4e-49bb-96af-fef02c7c2433"  # Not a secret :)
 
@@ -16,10 +21,13 @@ class OneDriveFilesSyncPlugin(
     octoprint.plugin.TemplatePlugin,
     octoprint.plugin.StartupPlugin,
     octoprint.plugin.SimpleApiPlugin,
+    octoprint.plugin.EventHandlerPlugin,
+    octoprint.plugin.BlueprintPlugin,
 ):
     sync_worker: sync.OneDriveSyncWorker
     onedrive: octo_onedrive.onedrive.OneDriveComm
     api: api.OneDriveFilesApi
+    placeholders: placeholders.PlaceholderHydrator
 
     last_sync: int
 
@@ -30,24 +38,70 @@ class OneDriveFilesSyncPlugin(
         # Create the 'OneDrive' folder if it doesn't exist
         self._file_manager.add_folder("local", "OneDrive", ignore_existing=True)
 
+        sync_defaults = self.get_settings_defaults()["sync"]
+
+        def get_sync_int(*path, minimum=None):
+            # Fields cleared in the UI come back as None, use the default instead
+            value = self._settings.get_int(["sync", *path], min=minimum)
+            if value is None:
+                value = functools.reduce(operator.getitem, path, sync_defaults)
+            return value
+
         def get_config():
+            # Cleared in the UI, that's no limit
+            cache_size = self._settings.get_int(["sync", "cache_size"], min=0) or 0
+
             return {
                 "mode": self._settings.get(["sync", "mode"]),
-                "interval": self._settings.get_int(["sync", "interval"]),
+                "interval": get_sync_int("interval", minimum=0),
                 "onedrive_folder": self._settings.get(["folder", "id"]),
                 "octoprint_folder": "OneDrive",
-                "max_depth": self._settings.get_int(["sync", "max_depth"]),
+                "max_depth": get_sync_int("max_depth", minimum=0),
+                "delta": self._settings.get_boolean(["sync", "delta"]),
+                "list_concurrency": get_sync_int("list_concurrency", minimum=1),
+                "reconcile_interval": get_sync_int("reconcile_interval", minimum=0),
+                "concurrency": {
+                    kind: get_sync_int("concurrency", kind, minimum=1)
+                    for kind in ("download", "upload", "delete")
+                },
+                "low_priority": self._settings.get_boolean(["sync", "low_priority"]),
+                "notification_url": self._settings.get(["sync", "notifications", "url"])
+                if self._settings.get_boolean(["sync", "notifications", "enabled"])
+                else "",
+                "placeholders": self._settings.get_boolean(["sync", "placeholders"]),
+                "cache_size": cache_size << 20,
             }
 
         def sync_condition():
             if self._settings.get(["sync", "automatic"]):
-                if self._settings.get(["sync", "while_printing"]):
+                if self._settings.get(["sync", "while_printing"]) != "pause":
                     return True
                 else:
                     return not self._printer.is_printing()
             else:
                 return False
 
+        def transfer_limits():
+            # Checked throughout a sync, so it speeds back up as soon as the print ends
+            limited = self._settings.get(["sync", "while_printing"]) == "limited"
+            if not (limited and self._printer.is_printing()):
+                return {}
+
+            bandwidth = get_sync_int("printing_limits", "bandwidth", minimum=0)
+            return {
+                "bandwidth": bandwidth * 1024,
+                "concurrency": get_sync_int(
+                    "printing_limits", "concurrency", minimum=0
+                ),
+            }
+
+        def in_use(path):
+            # Selected, and so maybe printing, or about to be
+            selected = self._printer.get_current_job().get("file") or {}
+            if selected.get("origin") == "local" and selected.get("path") == path:
+                return True
+            return self.placeholders.is_downloading(placeholders.placeholder_name(path))
+
         def on_sync_start():
             self.send_message("sync_start", {})
 
@@ -69,9 +123,28 @@ class OneDriveFilesSyncPlugin(
             onedrive=self.onedrive,
             octoprint_filemanager=self._file_manager,
             sync_condition=sync_condition,
+            data_folder=self._settings.get_plugin_data_folder(),
             on_sync_start=on_sync_start,
             on_sync_end=on_sync_end,
+            transfer_limits=transfer_limits,
+            in_use=in_use,
+            on_progress=lambda progress: self.send_message("sync_progress", progress),
         )
+
+        def on_placeholder_done(path, print_after):
+            # Downloads are asked for to load or print the file, so carry on with that
+            self._printer.select_file(path, False, printAfterSelect=print_after)
+
+        self.placeholders = placeholders.PlaceholderHydrator(
+            path_on_disk=lambda path: self._file_manager.path_on_disk("local", path),
+            download=self.sync_worker.download_placeholder,
+            on_done=on_placeholder_done,
+            send_message=self.send_message,
+        )
+
+        # Carries on from before a restart
+        self.last_sync = int(self.sync_worker.history.last_end() or 0)
+
         self.sync_worker.start()
 
     # SettingsPlugin mixin
@@ -90,10 +163,55 @@ class OneDriveFilesSyncPlugin(
                 "interval": 60 * 60,
                 "max_depth": 6,
                 "automatic": True,
-                "while_printing": False,
+                # While printing, sync can be paused ("pause"), limited so it doesn't
+                # disrupt the print ("limited"), or run at full speed ("full")
+                "while_printing": "pause",
+                "printing_limits": {
+                    "bandwidth": 256,  # KiB/s, across all transfers
+                    "concurrency": 1,  # Downloads & uploads at once
+                },
+                # Run the sync with idle I/O priority and a raised nice value (Linux only)
+                "low_priority": True,
+                # Add placeholders for files in OneDrive, only downloading them when asked
+                # to from the file list
+                "placeholders": False,
+                # MiB the files synced from OneDrive may take up, the least recently used
+                # are swapped for placeholders to stay under it. 0 for no limit
+                "cache_size": 0,
+                # Have OneDrive notify us of changes, instead of waiting for the interval.
+                # The URL must be the public HTTPS address of /plugin/onedrive_files/notifications
+                "notifications": {
+                    "enabled": False,
+                    "url": "",
+                },
+                # Use Graph delta queries to only fetch changes to the OneDrive folder
+                "delta": True,
+                # Number of OneDrive folders to list at the same time
+                "list_concurrency": 4,
+                # Changes in OctoPrint are tracked through events, but the whole folder is
+                # re-scanned this often (seconds) just in case
+                "reconcile_interval": 6 * 60 * 60,
+                # Number of each type of sync action to run at the same time
+                "concurrency": {
+                    "download": 2,
+                    "upload": 1,
+                    "delete": 4,
+                },
             },
         }
 
+    def get_settings_version(self):
+        return 1
+
+    def on_settings_migrate(self, target, current):
+        if current is None:
+            # while_printing was a boolean, on or off
+            while_printing = self._settings.get(["sync", "while_printing"])
+            if isinstance(while_printing, bool):
+                self._settings.set(
+                    ["sync", "while_printing"], "full" if while_printing else "pause"
+                )
+
     def on_settings_load(self):
         data = octoprint.plugin.SettingsPlugin.on_settings_load(self)
         # Inject the list of accounts in to the settings
@@ -114,9 +232,65 @@ class OneDriveFilesSyncPlugin(
     def on_api_get(self, request):
         return self.api.on_api_get(request)
 
+    # BlueprintPlugin mixin
+    @octoprint.plugin.BlueprintPlugin.route("/notifications", methods=["POST"])
+    @octoprint.plugin.BlueprintPlugin.csrf_exempt()
+    def on_graph_notification(self):
+        # Graph can't log in, notifications are checked against the subscription's secret.
+        # The blueprint isn't protected for this, other routes check permissions themselves
+        body, status, headers = self.sync_worker.subscription.handle(
+            flask.request.args,
+            flask.request.get_data(),
+            self.sync_worker.notify_changed,
+        )
+        return flask.make_response(body, status, headers)
+
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    def on_metrics(self):
+        # Prometheus can authenticate with an API key, in the X-Api-Key header
+        if not Permissions.SETTINGS_READ.can():
+            flask.abort(403)
+        return flask.make_response(
+            self.sync_worker.metrics.prometheus(),
+            200,
+            {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    def is_blueprint_protected(self):
+        return False
+
+    def is_blueprint_csrf_protected(self):
+        return True
+
+    # EventHandlerPlugin mixin
+    def on_event(self, event, payload):
+        if event in (
+            Events.FILE_ADDED,
+            Events.FILE_REMOVED,
+            Events.FOLDER_ADDED,
+            Events.FOLDER_REMOVED,
+        ):
+            # Moves are covered too, OctoPrint sends Removed & Added for both ends of them
+            if payload.get("storage") == "local":
+                self.sync_worker.tracker.mark_dirty(payload["path"])
+
+        elif event in (Events.FILE_SELECTED, Events.PRINT_STARTED):
+            path = payload.get("path", "")
+            if payload.get("origin") != "local" or not path.startswith("OneDrive/"):
+                return
+
+            printing = event == Events.PRINT_STARTED
+            self.sync_worker.index.mark_used(path[len("OneDrive") :], printed=printing)
+
     def sync_now(self):
         self.sync_worker.sync_now()
 
+    def sync_path(self, subtree):
+        self.sync_worker.sync_path(subtree)
+
+    def download_placeholder(self, path, print_after=False) -> bool:
+        return self.placeholders.hydrate(path, print_after=print_after)
+
     def on_shutdown(self):
         self.sync_worker.stop()
 
@@ -167,12 +341,28 @@ class OneDriveFilesSyncPlugin(
             }
         }
 
+    def extension_tree_hook(self, *args, **kwargs):
+        """
+        Placeholders get their own file type, so OctoPrint never selects or prints them
+        """
+        return placeholders.extension_tree()
+
     def backup_excludes_hook(self, *args, **kwargs):
         """
         Excluding the MS Graph API token from the backup. Unnecessary security risk, if someone was to share
         the backup it could partly compromise their MS account.
+
+        The same goes for the sync state holding pre-authenticated URLs or secrets: upload sessions, the
+        delta listing with its download URLs, and the change notification subscription. Partial downloads
+        are only dead weight. All of these are rebuilt by the next sync.
         """
-        return ["token_cache.bin"]
+        return [
+            "token_cache.bin",
+            "downloads",
+            "uploads.json",
+            "delta.json",
+            "subscription.json",
+        ]
 
 
 __plugin_name__ = "OneDrive File Sync"
@@ -188,4 +378,5 @@ def __plugin_load__():
     __plugin_hooks__ = {
         "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
         "octoprint.plugin.backup.additional_excludes": __plugin_implementation__.backup_excludes_hook,
+        "octoprint.filemanager.extension_tree": __plugin_implementation__.extension_tree_hook,
     }
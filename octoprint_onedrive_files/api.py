@@ -1,25 +1,33 @@
 import logging
 
+import flask
 from octo_onedrive.onedrive import AuthInProgressError
+from octoprint.access.permissions import Permissions
+
+from .sync import normalize_subtree
 
 
 class Commands:
     Sync = "sync"
+    SyncPath = "syncPath"
     StartAuth = "startAuth"
     GetFolders = "folders"
     GetFoldersByID = "foldersById"
     SetFolder = "setFolder"
     Forget = "forget"
+    Download = "download"
 
     @staticmethod
     def list_commands():
         return {
             Commands.Sync: [],
+            Commands.SyncPath: ["path"],
             Commands.StartAuth: [],
             Commands.GetFolders: [],
             Commands.GetFoldersByID: ["id"],
             Commands.SetFolder: ["id", "path"],
             Commands.Forget: [],
+            Commands.Download: ["path"],
         }
 
 
@@ -33,12 +41,26 @@ class OneDriveFilesApi:
             "accounts": self.plugin.onedrive.list_accounts(),
             "flow": self.plugin.onedrive.flow_in_progress,
             "folder": self.plugin._settings.get(["folder"], merged=True),
+            "metrics": self.plugin.sync_worker.metrics.as_dict(),
+            "history": self.plugin.sync_worker.history.runs(),
         }
 
     def on_api_command(self, command, data):
         if command == Commands.Sync:
             self.plugin.sync_now()
 
+        if command == Commands.SyncPath:
+            # Path of a folder inside the synced folder, e.g. /jobs/bracket
+            try:
+                subtree = normalize_subtree(data.get("path"))
+            except ValueError as e:
+                flask.abort(400, description=str(e))
+
+            if subtree is None:
+                self.plugin.sync_now()
+            else:
+                self.plugin.sync_path(subtree)
+
         if command == Commands.StartAuth:
 
             def on_success(response):
@@ -88,3 +110,19 @@ class OneDriveFilesApi:
 
         if command == Commands.Forget:
             self.plugin.onedrive.forget_account()
+
+        if command == Commands.Download:
+            # Path of a placeholder in OctoPrint's local storage, e.g.
+            # OneDrive/jobs/bracket.gcode.onedrive
+            path = data.get("path")
+            print_after = bool(data.get("print", False))
+
+            permission = Permissions.PRINT if print_after else Permissions.FILES_SELECT
+            if not permission.can():
+                flask.abort(403)
+
+            if not isinstance(path, str) or not path.startswith("OneDrive/"):
+                flask.abort(400, description=f"Invalid placeholder path: {path!r}")
+
+            if not self.plugin.download_placeholder(path, print_after):
+                flask.abort(404, description=f"{path} is not a placeholder")
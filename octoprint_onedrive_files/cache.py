@@ -0,0 +1,62 @@
+"""
+Size limit for the files synced from OneDrive
+
+With a limit set, once the files synced from OneDrive take up more space than allowed, the
+least recently used are swapped for placeholders (see placeholders.py) until they fit again.
+A file was used when it was last selected or printed, or else when it was synced. Evicted
+files keep their sync state, and can be downloaded again from the file list.
+
+Only G-code files are evicted, and never one that is selected, printing or has been changed
+in OctoPrint since it was synced.
+"""
+import logging
+
+from octoprint.filemanager import valid_file_type
+
+from .placeholders import placeholder_content
+
+logger = logging.getLogger("octoprint.plugins.onedrive_files.cache")
+
+
+def last_used(entry) -> float:
+    """When a file in the index was last selected, printed or else synced"""
+    return max(entry["last_selected"], entry["last_printed"], entry["last_sync"])
+
+
+def cache_size(files) -> int:
+    """Bytes taken up by the files in the index"""
+    return sum(entry["size"] for entry in files.values())
+
+
+def select_evictions(files, max_size, can_evict: callable) -> list:
+    """
+    Choose the files to evict to bring the cache under max_size
+
+    :param files: the index's files, as from SyncIndex.files()
+    :param max_size: bytes the files may take up, 0 for no limit
+    :param can_evict: can_evict(path, entry) says whether a file may be evicted right now
+    :return: paths to evict, least recently used first. May not be enough to get under
+        max_size, if too much can't be evicted
+    """
+    total = cache_size(files)
+    if not max_size or total <= max_size:
+        return []
+
+    evict = []
+    for path, entry in sorted(files.items(), key=lambda f: last_used(f[1])):
+        if total <= max_size:
+            break
+        if not valid_file_type(path, "machinecode") or not can_evict(path, entry):
+            continue
+        evict.append(path)
+        total -= entry["size"] - len(placeholder_content(entry))
+
+    if total > max_size:
+        logger.warning(
+            "Synced files take up %s bytes, over the limit of %s, even after evicting "
+            "everything possible",
+            total,
+            max_size,
+        )
+
+    return evict
@@ -0,0 +1,238 @@
+"""
+Incremental listing of the OneDrive folder, using Graph delta queries
+
+Rather than listing every folder on every run, an index of the remote folder is persisted in
+the plugin's data folder along with the deltaLink. Each run only asks Graph what changed since
+the last one and applies that to the index.
+
+Download URLs are pre-authenticated and short lived, so they are only kept in memory for the
+run that listed them. Files unchanged since are downloaded through /content instead.
+"""
+import logging
+
+from octoprint.filemanager import valid_file_type
+
+from .graph import GraphClient, normalize_item
+from .placeholders import is_placeholder_name
+from .state import load_state, save_state
+
+logger = logging.getLogger("octoprint.plugins.onedrive_files.delta")
+
+
+class DeltaSyncError(Exception):
+    """Raised when the delta query fails, and a full listing is needed instead."""
+
+    pass
+
+
+class DeltaListing:
+    STATE_VERSION = 2
+
+    def __init__(self, path):
+        """
+        :param path: Path to persist the delta state to
+        """
+        self.path = path
+
+        # Loaded lazily, on the first run
+        self._state = None
+        # Whether the state has changed since it was last saved
+        self._changed = False
+        # Item id => downloadUrl, for the items listed in the current run
+        self._download_urls = {}
+
+    def list_files(self, graph: GraphClient, folder_id, max_depth):
+        """
+        Bring the remote index up to date, and list the files in it
+
+        Falls back to re-enumerating the whole folder if the delta token has expired,
+        or if there is no token yet.
+
+        :return: dict of files in OneDrive, the same as a full listing
+        :raises DeltaSyncError: if the folder can't be enumerated with a delta query
+        """
+        state = self._load()
+        self._download_urls = {}
+
+        if state["folder"] == folder_id and state["deltaLink"]:
+            try:
+                self._apply_delta(graph, folder_id, state["deltaLink"])
+            except DeltaSyncError as e:
+                logger.warning(
+                    "Delta query failed, re-listing all files in OneDrive (%s)", e
+                )
+                self.reset(folder_id)
+                self._apply_delta(graph, folder_id)
+        else:
+            logger.debug("No delta state for folder %s, listing all files", folder_id)
+            self.reset(folder_id)
+            self._apply_delta(graph, folder_id)
+
+        files = self.files(max_depth)
+
+        # Most runs find nothing changed, no need to write it all out again
+        if self._changed:
+            self._save()
+
+        return files
+
+    def reset(self, folder_id=None):
+        """Forget everything we know about the remote folder"""
+        self._state = {
+            "version": self.STATE_VERSION,
+            "folder": folder_id,
+            "deltaLink": None,
+            "items": {},
+        }
+        self._changed = True
+
+    def files(self, max_depth):
+        """
+        Build the {path: data} dict of valid files from the index
+
+        Paths are resolved from the parent ids, since Graph doesn't give a path in delta results.
+        Items that can't be traced back to the root folder (e.g. the children of a deleted
+        folder, which are not reported individually) are dropped from the index.
+        """
+        state = self._load()
+        items = state["items"]
+        folder_id = state["folder"]
+
+        # folder id => (path, depth) cache, so each folder is only resolved once
+        folders = {folder_id: ("/", 0)}
+        orphans = set()
+
+        def resolve_folder(item_id):
+            if item_id in folders:
+                return folders[item_id]
+
+            item = items.get(item_id)
+            if item is None or item["type"] != "folder" or item_id in orphans:
+                return None
+
+            parent = resolve_folder(item["parent"])
+            if parent is None:
+                orphans.add(item_id)
+                return None
+
+            path, depth = parent
+            folders[item_id] = (path + item["name"] + "/", depth + 1)
+            return folders[item_id]
+
+        result = {}
+        too_deep = set()
+        for item_id, item in items.items():
+            if item["type"] != "file":
+                continue
+
+            parent = resolve_folder(item["parent"])
+            if parent is None:
+                orphans.add(item_id)
+                continue
+
+            path, depth = parent
+            if depth > max_depth:
+                too_deep.add(path)
+                continue
+
+            # Placeholders are only ever made by the sync, never synced themselves
+            if valid_file_type(item["name"]) and not is_placeholder_name(item["name"]):
+                result[path + item["name"]] = {
+                    "id": item_id,
+                    "eTag": item["eTag"],
+                    "hash": item.get("hash", ""),
+                    "size": item.get("size"),
+                    "downloadUrl": self._download_urls.get(item_id, ""),
+                }
+
+        for path in too_deep:
+            logger.warning(
+                f"Reached max depth of sub-folders, not going further into {path}"
+            )
+
+        for item_id in orphans:
+            if items.pop(item_id, None) is not None:
+                self._changed = True
+
+        return result
+
+    def _apply_delta(self, graph, folder_id, delta_link=None):
+        items = self._state["items"]
+
+        for page in graph.delta(folder_id, delta_link):
+            if "error" in page:
+                raise DeltaSyncError(page["error"])
+
+            for item in page.get("value", []):
+                entry = self._apply_item(items, folder_id, item)
+                if entry is not None and entry.get("downloadUrl"):
+                    self._download_urls[item["id"]] = entry["downloadUrl"]
+
+            delta_link = page.get("@odata.deltaLink")
+            if delta_link and delta_link != self._state["deltaLink"]:
+                self._state["deltaLink"] = delta_link
+                self._changed = True
+
+    def _apply_item(self, items, folder_id, item):
+        """
+        Apply one item from the delta results to the index
+
+        :return: the normalized item, if it is in the index now
+        """
+        item_id = item["id"]
+
+        if item_id == folder_id:
+            # The synced folder itself is included in the results
+            return None
+
+        if "deleted" in item:
+            self._remove_item(items, item_id)
+            return None
+
+        item = normalize_item(item)
+        if item is None:
+            # Unknown type so ignore, it could have changed type though
+            self._remove_item(items, item_id)
+            return None
+
+        if item["type"] == "folder":
+            entry = {
+                "type": "folder",
+                "name": item["name"],
+                "parent": item["parent"],
+            }
+        else:
+            entry = {
+                "type": "file",
+                "name": item["name"],
+                "parent": item["parent"],
+                "eTag": item["eTag"],
+                "hash": item["hash"],
+                "size": item["size"],
+            }
+
+        if items.get(item_id) != entry:
+            items[item_id] = entry
+            self._changed = True
+        return item
+
+    def _remove_item(self, items, item_id):
+        if items.pop(item_id, None) is not None:
+            self._changed = True
+
+    def _load(self):
+        if self._state is not None:
+            return self._state
+
+        self.reset()
+
+        state = load_state(self.path, self.STATE_VERSION, "delta state")
+        if state is not None:
+            self._state = state
+            self._changed = False
+
+        return self._state
+
+    def _save(self):
+        if save_state(self.path, self.STATE_VERSION, self._state, "delta state"):
+            self._changed = False
@@ -0,0 +1,169 @@
+"""
+Resumable downloads from OneDrive, through a staging folder
+
+Files are downloaded into the staging folder under a name made from their OneDrive id and
+eTag. If a download is interrupted the partial file is kept, and the next attempt asks
+OneDrive for the rest with a Range request. A new eTag means the file changed, so any
+partial download of an older version is dropped.
+
+The staging folder is kept on the same filesystem as OctoPrint's uploads folder where
+possible, so a finished download is moved into place with a single rename rather than
+being written to the SD card a second time.
+"""
+import glob
+import logging
+import os
+import re
+import time
+
+from .graph import GraphClient
+
+logger = logging.getLogger("octoprint.plugins.onedrive_files.downloads")
+
+# Partial downloads untouched for this long are deleted
+STALE_AFTER = 7 * 24 * 60 * 60  # Seconds
+
+PART_SUFFIX = ".part"
+
+# Hidden, so OctoPrint's file list and the change tracker skip it
+UPLOADS_STAGING_FOLDER = ".onedrive_files_staging"
+
+
+class DownloadError(Exception):
+    """Raised when a download fails, anything received so far is kept to resume from."""
+
+    def __init__(self, error):
+        super().__init__(error)
+        self.error = error
+
+
+class DownloadStaging:
+    def __init__(self, folder):
+        """
+        :param folder: Folder to keep partial downloads in, created if it does not exist
+        """
+        self.folder = folder
+
+    def fetch(
+        self,
+        graph: GraphClient,
+        item_id,
+        etag,
+        size=None,
+        download_url=None,
+        on_progress: callable = None,
+    ) -> str:
+        """
+        Download a file into the staging folder, resuming an earlier attempt if there was one
+
+        :param item_id: OneDrive id of the file
+        :param etag: current eTag of the file
+        :param size: expected size of the file in bytes, if known
+        :param download_url: pre-authenticated download URL from the listing, if any
+        :param on_progress: called with the number of bytes received so far, as they arrive
+        :return: path of the complete file in the staging folder
+        :raises DownloadError: if the download fails or is incomplete
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        self._drop_other_versions(item_id, etag)
+
+        path = self.path_for(item_id, etag)
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+
+        if size is not None and offset > size:
+            # Can't be right, start again
+            offset = 0
+            os.remove(path)
+
+        # A complete file can be left over if placing it in OctoPrint failed last time
+        if not (size and offset == size):
+            if offset:
+                logger.info("Resuming download of %s from byte %s", item_id, offset)
+
+            with open(path, "ab") as f:
+                result = graph.download(
+                    item_id, f, offset, download_url, on_progress=on_progress
+                )
+
+            if "error" in result:
+                raise DownloadError(result["error"])
+
+        if size is not None and os.path.getsize(path) != size:
+            received = os.path.getsize(path)
+            self.discard(path)
+            raise DownloadError(
+                {
+                    "code": "incompleteDownload",
+                    "message": f"Expected {size} bytes, got {received}",
+                }
+            )
+
+        return path
+
+    def path_for(self, item_id, etag) -> str:
+        return os.path.join(self.folder, f"{_safe(item_id)}_{_safe(etag)}{PART_SUFFIX}")
+
+    def same_filesystem(self, path) -> bool:
+        """Whether files can be renamed from the staging folder to path, without a copy"""
+        try:
+            return os.stat(self.folder).st_dev == os.stat(path).st_dev
+        except OSError:
+            return False
+
+    def discard(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def cleanup(self, max_age=STALE_AFTER):
+        """Delete partial downloads that haven't been touched for max_age seconds"""
+        cutoff = time.time() - max_age
+        for path in glob.glob(os.path.join(self.folder, f"*{PART_SUFFIX}")):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    logger.debug("Removing stale partial download %s", path)
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _drop_other_versions(self, item_id, etag):
+        current = self.path_for(item_id, etag)
+        for path in glob.glob(
+            os.path.join(self.folder, f"{_safe(item_id)}_*{PART_SUFFIX}")
+        ):
+            if path != current:
+                logger.debug("File changed in OneDrive, dropping %s", path)
+                self.discard(path)
+
+
+def staging_folder(data_folder, uploads_folder) -> str:
+    """
+    Pick a staging folder on the same filesystem as the uploads folder
+
+    The plugin's data folder is used when it is on the same filesystem, which is the usual
+    case. Otherwise a hidden folder inside the uploads folder, unless that can't be created.
+    """
+    folder = os.path.join(data_folder, "downloads")
+    os.makedirs(folder, exist_ok=True)
+
+    try:
+        if os.stat(folder).st_dev == os.stat(uploads_folder).st_dev:
+            return folder
+
+        uploads_staging = os.path.join(uploads_folder, UPLOADS_STAGING_FOLDER)
+        os.makedirs(uploads_staging, exist_ok=True)
+        return uploads_staging
+    except OSError as e:
+        logger.warning(
+            "Downloads will be copied into the uploads folder, could not stage them on "
+            "the same filesystem (%s)",
+            e,
+        )
+        return folder
+
+
+def _safe(value):
+    # Ids and eTags can contain quotes, braces, commas and '!', keep them out of file names.
+    # No underscores either, so the id prefix of a staged file is unambiguous
+    return re.sub(r"[^A-Za-z0-9]", "", value)
@@ -0,0 +1,156 @@
+"""
+Concurrent execution of sync actions
+
+Each type of action (download, upload, delete) gets its own bounded thread pool, so for
+example a slow upload can't hold up downloads. Actions on the same path are always run
+one after another, in the order they were given.
+
+On top of that, the number of transfers (downloads and uploads together) running at once can
+be capped by a limit that is checked as each one starts, so it can change mid-run.
+"""
+import concurrent.futures
+import logging
+import threading
+
+logger = logging.getLogger("octoprint.plugins.onedrive_files.executor")
+
+# Action => the limit it counts towards
+ACTION_KINDS = {
+    "download": "download",
+    "upload": "upload",
+    "update_metadata": "metadata",
+    "delete_octoprint": "delete",
+    "delete_onedrive": "delete",
+}
+
+DEFAULT_LIMITS = {
+    "download": 2,
+    "upload": 1,
+    "delete": 4,
+    # Only touches OctoPrint's metadata and the index, not configurable
+    "metadata": 4,
+}
+
+# Kinds of action that count towards the transfer limit
+TRANSFER_KINDS = ("download", "upload")
+
+TRANSFER_LIMIT_CHECK_INTERVAL = 1.0  # Seconds, while waiting for the transfer limit
+
+
+def action_limits(limits: dict = None) -> dict:
+    """
+    DEFAULT_LIMITS, overridden by whichever of limits are set
+
+    :param limits: {"download": n, "upload": n, "delete": n}, missing or None values are
+        left at the default
+    """
+    result = dict(DEFAULT_LIMITS)
+    if limits:
+        result.update({kind: int(limit) for kind, limit in limits.items() if limit})
+    return result
+
+
+class ActionExecutor:
+    def __init__(
+        self,
+        perform: callable,
+        limits: dict = None,
+        transfer_limit: callable = lambda: 0,
+    ):
+        """
+        :param perform: called with each action dict to carry it out, exceptions are logged
+        :param limits: maximum number of concurrent actions of each kind, see DEFAULT_LIMITS
+        :param transfer_limit: returns the maximum number of downloads and uploads to run
+            at once, 0 for no limit beyond `limits`
+        """
+        self.perform = perform
+        self.transfer_limit = transfer_limit
+
+        self.limits = action_limits(limits)
+
+        self._lock = threading.Lock()
+        self._transfers = threading.Condition(self._lock)
+        self._active_transfers = 0
+        self._remaining = 0
+        self._done = threading.Event()
+        self._failed = []
+
+    def run(self, actions) -> list:
+        """
+        Run all the actions, blocking until they are done
+
+        :return: list of the actions that failed
+        """
+        if not actions:
+            return []
+
+        # Group the actions on each path, keeping the order they were given in
+        chains = {}
+        for action in actions:
+            chains.setdefault(action["file"], []).append(action)
+
+        self._remaining = len(actions)
+        self._done.clear()
+        self._failed = []
+
+        pools = {
+            kind: concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, limit),
+                thread_name_prefix=f"OneDriveSync-{kind}",
+            )
+            for kind, limit in self.limits.items()
+        }
+
+        try:
+            for chain in chains.values():
+                self._submit(pools, chain, 0)
+
+            self._done.wait()
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=True)
+
+        return self._failed
+
+    def _submit(self, pools, chain, position):
+        action = chain[position]
+        future = pools[ACTION_KINDS[action["action"]]].submit(self._perform, action)
+
+        if position + 1 < len(chain):
+            # Only start the next action on this path once this one has finished
+            future.add_done_callback(lambda _: self._submit(pools, chain, position + 1))
+
+    def _perform(self, action):
+        transfer = False
+        try:
+            if ACTION_KINDS[action["action"]] in TRANSFER_KINDS:
+                self._start_transfer()
+                transfer = True
+            self.perform(action)
+        except Exception as e:
+            logger.error("Error syncing file with OneDrive")
+            logger.error(
+                "Error on file %s, action %s", action["file"], action["action"]
+            )
+            logger.exception(e)
+            with self._lock:
+                self._failed.append(action)
+        finally:
+            with self._lock:
+                if transfer:
+                    self._active_transfers -= 1
+                    self._transfers.notify_all()
+                self._remaining -= 1
+                if self._remaining <= 0:
+                    self._done.set()
+
+    def _start_transfer(self):
+        with self._transfers:
+            while True:
+                limit = self.transfer_limit() or 0
+                if not limit or self._active_transfers < limit:
+                    self._active_transfers += 1
+                    return
+
+                # Wake up now and again, the limit may have been lifted
+                self._transfers.wait(TRANSFER_LIMIT_CHECK_INTERVAL)
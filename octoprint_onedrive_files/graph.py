@@ -0,0 +1,466 @@
+"""
+Direct access to the parts of the Microsoft Graph API that octo_onedrive does not wrap
+
+Authentication is still handled by the OneDriveComm instance, this only builds & sends the requests.
+Requests go through one connection-pooled session, so a sync run reuses its TLS connections
+instead of setting up a new one for every file, and through a RequestScheduler so they back
+off together when Graph throttles us. File content can also be held to a bandwidth limit.
+"""
+import datetime
+import logging
+import re
+
+import octo_onedrive.onedrive
+import requests
+import requests.adapters
+
+from .metrics import RequestCounters
+from .throttle import (
+    THROTTLED_STATUSES,
+    BandwidthLimiter,
+    MeteredBody,
+    RequestScheduler,
+    parse_retry_after,
+)
+
+GRAPH_URL = "https://graph.microsoft.com/v1.0"
+REQUEST_TIMEOUT = 10  # Seconds
+DOWNLOAD_TIMEOUT = 30  # Seconds, between bytes rather than for the whole file
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+POOL_SIZE = 10  # Connections kept alive per host
+BATCH_SIZE = 20  # Maximum requests in one $batch
+MAX_RETRIES = 5  # Times a throttled request is retried
+
+# A pre-authenticated download URL answers with one of these once it has expired
+EXPIRED_URL_STATUSES = (401, 403, 404, 410)
+
+logger = logging.getLogger("octoprint.plugins.onedrive_files.graph")
+
+
+class GraphClient:
+    def __init__(
+        self,
+        onedrive: octo_onedrive.onedrive.OneDriveComm,
+        pool_size=POOL_SIZE,
+        scheduler: RequestScheduler = None,
+        bandwidth: BandwidthLimiter = None,
+    ):
+        """
+        :param pool_size: connections to keep alive to each host, at least as many as the
+            requests that will be made at the same time
+        :param scheduler: RequestScheduler to pace the requests with, by default a new one
+        :param bandwidth: BandwidthLimiter for uploaded and downloaded file content, if any
+        """
+        self.onedrive = onedrive
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+        self.bandwidth = bandwidth
+        self.counters = RequestCounters()
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def send(self, method, url, **kwargs) -> requests.Response:
+        """
+        Send a request once the scheduler allows it, retrying it if it is throttled
+
+        Every request to OneDrive goes through here. Exceptions from requests are raised.
+
+        :param kwargs: passed to requests
+        :return: the response, still throttled if it was on every retry
+        """
+        data = kwargs.get("data")
+        for attempt in range(MAX_RETRIES + 1):
+            if data and self.bandwidth is not None:
+                # A new body each attempt, it is used up once sent
+                kwargs["data"] = MeteredBody(data, self.bandwidth)
+
+            self.scheduler.acquire()
+            self.counters.add("requests")
+            if data:
+                self.counters.add("bytes_sent", len(data))
+            response = self._transport(method, url, **kwargs)
+
+            if response.status_code not in THROTTLED_STATUSES or attempt == MAX_RETRIES:
+                break
+
+            self.counters.add("retries")
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            response.close()
+            self.scheduler.throttled(retry_after)
+
+        if response.status_code not in THROTTLED_STATUSES:
+            self.scheduler.succeeded()
+
+        return response
+
+    def _transport(self, method, url, **kwargs) -> requests.Response:
+        return self.session.request(method, url, **kwargs)
+
+    def request(
+        self,
+        endpoint,
+        method="GET",
+        params=None,
+        json=None,
+        headers=None,
+        timeout=REQUEST_TIMEOUT,
+        data=None,
+        auth=True,
+    ) -> dict:
+        """
+        Send a request to Graph, returning the decoded response body
+
+        Mirrors OneDriveComm._graph_request: errors are never raised, instead they are returned
+        as {"error": {"code": ..., "message": ...}} so callers can check for the "error" key.
+
+        :param data: raw request body, e.g. a chunk of a file being uploaded
+        :param auth: send the Authorization header, pre-authenticated URLs (upload sessions,
+            download URLs) must be requested without it
+        """
+        if endpoint.startswith("https"):
+            url = endpoint
+        else:
+            if not endpoint[:1] == "/":
+                endpoint = f"/{endpoint}"
+            url = f"{GRAPH_URL}{endpoint}"
+
+        request_headers = self.onedrive._get_headers() if auth else {}
+        if headers is not None:
+            request_headers.update(headers)
+
+        # Catch-all in case of internet problems
+        try:
+            response = self.send(
+                method,
+                url,
+                params=params,
+                json=json,
+                data=data,
+                headers=request_headers,
+                timeout=timeout,
+            )
+        except Exception as e:
+            # Upload session URLs carry their authentication, keep them out of the logs
+            message = _redact_urls(str(e))
+            logger.error("Request failed: %s", message)
+            return {"error": {"code": "requestFailed", "message": message}}
+
+        if not response.ok:
+            return {"error": _error_from_response(response)}
+
+        if not response.content:
+            # 204 No Content, e.g. from DELETE
+            return {}
+
+        try:
+            return response.json()
+        except Exception as e:
+            logger.exception(e)
+            return {"error": {"code": "invalidResponse", "message": str(e)}}
+
+    def batch(self, batch_requests) -> dict:
+        """
+        Send requests through Graph's JSON $batch endpoint, up to BATCH_SIZE per call
+
+        :param batch_requests: list of {"id": ..., "method": ..., "url": ...}, optionally with
+            "headers" & "body". Each id must be unique, urls are relative to GRAPH_URL.
+        :return: {id: {"status": ..., "body": {...}}} for each request. If a whole batch
+            fails, each of its requests gets a status of None and the batch's error as body.
+        """
+        results = {}
+
+        for start in range(0, len(batch_requests), BATCH_SIZE):
+            pending = batch_requests[start : start + BATCH_SIZE]
+
+            for attempt in range(MAX_RETRIES + 1):
+                response = self.request(
+                    "/$batch", method="POST", json={"requests": pending}
+                )
+
+                if "error" in response:
+                    for request in pending:
+                        results[request["id"]] = {
+                            "status": None,
+                            "body": {"error": response["error"]},
+                        }
+                    break
+
+                # Requests inside a batch are throttled individually, retry just those
+                throttled = set()
+                retry_after = None
+                can_retry = attempt < MAX_RETRIES
+                for item in response.get("responses", []):
+                    if can_retry and item.get("status") in THROTTLED_STATUSES:
+                        throttled.add(item["id"])
+                        item_retry_after = parse_retry_after(
+                            item.get("headers", {}).get("Retry-After")
+                        )
+                        if item_retry_after is not None:
+                            retry_after = max(retry_after or 0, item_retry_after)
+                    else:
+                        results[item["id"]] = {
+                            "status": item.get("status"),
+                            "body": item.get("body") or {},
+                        }
+
+                if not throttled:
+                    break
+
+                self.counters.add("retries", len(throttled))
+                self.scheduler.throttled(retry_after)
+                pending = [r for r in pending if r["id"] in throttled]
+
+            for request in batch_requests[start : start + BATCH_SIZE]:
+                results.setdefault(
+                    request["id"],
+                    {
+                        "status": None,
+                        "body": {
+                            "error": {
+                                "code": "missingResponse",
+                                "message": "No response in batch",
+                            }
+                        },
+                    },
+                )
+
+        return results
+
+    def download(
+        self,
+        item_id,
+        f,
+        offset=0,
+        download_url=None,
+        timeout=DOWNLOAD_TIMEOUT,
+        on_progress: callable = None,
+    ) -> dict:
+        """
+        Stream the content of a file into an open file object
+
+        The pre-authenticated download URL from the listing is used if there is one, saving
+        the round trip through Graph. Those only last about an hour though, so once it has
+        expired the file is downloaded through Graph by id instead.
+
+        Anything received before an error is left written to f, so the download can be
+        resumed from there.
+
+        :param item_id: id of the file to download
+        :param f: binary file object to write to, positioned at offset
+        :param offset: byte to start from, sent as a Range request
+        :param download_url: the file's "@microsoft.graph.downloadUrl", if known
+        :param on_progress: called with the number of bytes in f after each chunk
+        :return: {} once the whole file is written, or {"error": {...}}
+        """
+        if download_url:
+            result, status = self._stream(
+                download_url, {}, f, offset, timeout, on_progress
+            )
+            if status not in EXPIRED_URL_STATUSES:
+                return result
+
+            logger.debug("Download URL of %s has expired, going through Graph", item_id)
+            offset = f.tell()
+
+        # Graph redirects to a pre-authenticated URL, requests drops the auth header for it
+        result, _ = self._stream(
+            f"{GRAPH_URL}/me/drive/items/{item_id}/content",
+            self.onedrive._get_headers(),
+            f,
+            offset,
+            timeout,
+            on_progress,
+        )
+        return result
+
+    def _stream(self, url, headers, f, offset, timeout, on_progress=None):
+        # Returns (result, HTTP status), status is None if no response was received
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+
+        try:
+            with self.send(
+                "GET", url, headers=headers, stream=True, timeout=timeout
+            ) as response:
+                if not response.ok:
+                    return (
+                        {"error": _error_from_response(response)},
+                        response.status_code,
+                    )
+
+                if offset and response.status_code != 206:
+                    # Range was ignored, so this is the whole file
+                    f.seek(0)
+                    f.truncate()
+
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    self.counters.add("bytes_received", len(chunk))
+                    if self.bandwidth is not None:
+                        self.bandwidth.consume(len(chunk))
+                    if on_progress is not None:
+                        on_progress(f.tell())
+
+                return {}, response.status_code
+
+        except Exception as e:
+            # Download URLs carry their authentication, keep them out of the logs
+            message = _redact_urls(str(e))
+            logger.error("Error downloading file: %s", message)
+            return {"error": {"code": "requestFailed", "message": message}}, None
+
+    def children(self, folder_id):
+        """
+        Generator yielding the files and folders directly inside a folder
+
+        Pages are fetched as they are consumed, following "@odata.nextLink", so only one page
+        of the response is held in memory at a time.
+
+        :param folder_id: id of the folder to list
+        :raises GraphError: if Graph returns an error for any page
+        """
+        url = f"/me/drive/items/{folder_id}/children"
+
+        while url:
+            page = self.request(url)
+            if "error" in page:
+                raise GraphError(page["error"])
+
+            url = page.get("@odata.nextLink")
+
+            for item in page.get("value", []):
+                item = normalize_item(item)
+                if item is not None:
+                    yield item
+
+    def delta(self, folder_id, delta_link=None):
+        """
+        Generator yielding each page of a delta query on the folder
+
+        Starting without a delta link enumerates every item under the folder. The final page
+        carries the "@odata.deltaLink" to use next time, an error page ends the generator.
+
+        :param folder_id: id of the folder to track
+        :param delta_link: deltaLink returned by the previous query, if any
+        """
+        url = delta_link if delta_link else f"/me/drive/items/{folder_id}/delta"
+
+        while url:
+            page = self.request(url)
+            yield page
+
+            if "error" in page:
+                return
+
+            url = page.get("@odata.nextLink")
+
+
+class GraphError(Exception):
+    """Raised by the generator methods of GraphClient, which can't return an error dict."""
+
+    def __init__(self, error):
+        super().__init__(error)
+        self.error = error
+
+
+def normalize_item(item: dict):
+    """
+    Reduce a Graph driveItem to the fields the sync uses, in the same shape as
+    OneDriveComm.list_files_and_folders
+
+    :return: the item as a dict, or None if it is neither a file nor a folder
+    """
+    if "folder" in item:
+        return {
+            "type": "folder",
+            "name": item["name"],
+            "id": item["id"],
+            "parent": item.get("parentReference", {}).get("id"),
+            "childCount": item["folder"].get("childCount", 0),
+        }
+
+    elif "file" in item:
+        return {
+            "type": "file",
+            "name": item["name"],
+            "id": item["id"],
+            "parent": item.get("parentReference", {}).get("id"),
+            "eTag": item.get("eTag", ""),
+            "hash": content_hash(item),
+            "size": item.get("size", 0),
+            "downloadUrl": item.get("@microsoft.graph.downloadUrl", ""),
+        }
+
+    # Unknown type (e.g. OneNote package)
+    return None
+
+
+def content_hash(item: dict) -> str:
+    """
+    The hash of a driveItem's content, as "<type>:<value>", or "" if Graph didn't give one
+
+    Unlike the eTag, this doesn't change when a file is renamed or its properties edited.
+    Business accounts only have quickXorHash, personal ones may also have sha1/sha256.
+    """
+    hashes = item.get("file", {}).get("hashes", {})
+    for hash_type in ("quickXorHash", "sha1Hash", "sha256Hash"):
+        if hashes.get(hash_type):
+            return f"{hash_type}:{hashes[hash_type]}"
+    return ""
+
+
+def parse_time(value):
+    """Parse a Graph timestamp, e.g. 2015-01-29T09:21:55.523Z, to seconds since the epoch"""
+    if not value:
+        return None
+
+    try:
+        # Graph gives up to 7 fractional digits, more than datetime can parse
+        timestamp = datetime.datetime.strptime(
+            value.rstrip("Z").split(".")[0], "%Y-%m-%dT%H:%M:%S"
+        )
+        return timestamp.replace(tzinfo=datetime.timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+
+def format_time(timestamp):
+    """Format seconds since the epoch as a Graph timestamp"""
+    return datetime.datetime.fromtimestamp(
+        timestamp, tz=datetime.timezone.utc
+    ).strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
+
+
+def _error_from_response(response: requests.Response) -> dict:
+    # Graph errors should (by protocol) carry a useful error body, but not always
+    try:
+        data = response.json()
+        if "error" in data:
+            return data["error"]
+    except Exception:
+        pass
+
+    return {"code": str(response.status_code), "message": response.reason}
+
+
+def _redact_urls(message: str) -> str:
+    """
+    Strip the paths & queries of any URLs in an error message, leaving only the host
+
+    Pre-authenticated URLs carry their token in either. Connection errors from requests
+    give the URL in two parts, "host='...'" and "url: /path?query".
+    """
+    message = re.sub(r"(https?://[^/\s'\"]+)[^\s'\"]*", r"\1/...", message)
+    return re.sub(r"(url: )(?!https?://)\S+", r"\1/...", message)
@@ -0,0 +1,114 @@
+"""
+History of recent sync runs
+
+A summary of each of the last HISTORY_SIZE runs is kept in the plugin's data folder, so slow
+or failing runs can be spotted from the settings, and still be seen after a restart.
+"""
+import collections
+import threading
+
+from .state import load_state, save_state
+
+HISTORY_SIZE = 50  # Runs
+
+# What started a run
+TRIGGER_INTERVAL = "interval"
+TRIGGER_MANUAL = "manual"
+TRIGGER_NOTIFICATION = "notification"
+TRIGGER_PATH = "path"
+
+
+def history_entry(start, duration, trigger, summary=None, subtree=None) -> dict:
+    """
+    Condense a run into a history entry
+
+    :param start: when the run started, as a timestamp
+    :param duration: how long the run took, in seconds
+    :param trigger: what started it, one of the TRIGGER_* constants
+    :param summary: the run's summary from sync.run_sync, None if it stopped with an error
+    """
+    entry = {
+        "start": start,
+        "duration": round(duration, 3),
+        "trigger": trigger,
+        "subtree": subtree,
+        "error": summary is None,
+        "files": {},
+        "actions": {},
+        "failed": 0,
+        "requests": 0,
+        "bytes": {"downloaded": 0, "uploaded": 0},
+        "throttled": 0.0,
+        "evicted": 0,
+    }
+    if summary is None:
+        return entry
+
+    requests = summary.get("requests", {}).values()
+    entry.update(
+        {
+            "files": summary.get("files", {}),
+            "actions": summary.get("actions", {}),
+            "failed": summary.get("failed", 0),
+            "requests": sum(counts["requests"] for counts in requests),
+            "bytes": {
+                "downloaded": sum(counts["bytes_received"] for counts in requests),
+                "uploaded": sum(counts["bytes_sent"] for counts in requests),
+            },
+            "throttled": round(summary.get("throttled", {}).get("seconds", 0.0), 3),
+            "evicted": summary.get("evicted", {}).get("files", 0),
+        }
+    )
+    return entry
+
+
+class SyncHistory:
+    STATE_VERSION = 1
+
+    def __init__(self, path=None, size=HISTORY_SIZE):
+        """
+        :param path: Path to persist the history to, None to only keep it in memory
+        :param size: Number of runs to keep, older ones are dropped
+        """
+        self.path = path
+        self.size = size
+
+        # Loaded lazily, on first use
+        self._runs = None
+        self._lock = threading.Lock()
+
+    def add(self, entry):
+        """Add a run, see history_entry"""
+        with self._lock:
+            self._load().append(entry)
+            self._save()
+
+    def runs(self) -> list:
+        """The runs kept, oldest first"""
+        with self._lock:
+            return list(self._load())
+
+    def last_end(self):
+        """When the last run finished, as a timestamp, None if there hasn't been one"""
+        with self._lock:
+            runs = self._load()
+            if not runs:
+                return None
+            return runs[-1]["start"] + runs[-1]["duration"]
+
+    def _load(self):
+        if self._runs is not None:
+            return self._runs
+
+        self._runs = collections.deque(maxlen=self.size)
+
+        state = load_state(self.path, self.STATE_VERSION, "sync history")
+        if state is not None:
+            self._runs.extend(state.get("runs", []))
+
+        return self._runs
+
+    def _save(self):
+        save_state(
+            self.path, self.STATE_VERSION, {"runs": list(self._runs)}, "sync history"
+        )
@@ -0,0 +1,182 @@
+"""
+Persistent index of the files being kept in sync
+
+Stored as an SQLite database in the plugin's data folder, so the sync state of each file
+no longer has to be rebuilt from OctoPrint's metadata on every run.
+"""
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger("octoprint.plugins.onedrive_files.index")
+
+SCHEMA_VERSION = 3
+
+
+class SyncIndex:
+    def __init__(self, path):
+        """
+        :param path: Path to the SQLite database, created if it does not exist
+        """
+        self.path = path
+
+        # Opened lazily, on first use
+        self._connection = None
+        self._lock = threading.RLock()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._connection is None:
+                self._connection = self._connect()
+            return self._connection
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, "
+                "onedrive_id TEXT NOT NULL DEFAULT '', "
+                "etag TEXT NOT NULL DEFAULT '', "
+                "size INTEGER NOT NULL DEFAULT 0, "
+                "mtime REAL NOT NULL DEFAULT 0, "
+                "last_sync REAL NOT NULL DEFAULT 0, "
+                "hash TEXT NOT NULL DEFAULT '', "
+                "last_selected REAL NOT NULL DEFAULT 0, "
+                "last_printed REAL NOT NULL DEFAULT 0)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+
+            # Schema 1 had no content hashes
+            columns = [
+                row["name"] for row in connection.execute("PRAGMA table_info(files)")
+            ]
+            if "hash" not in columns:
+                connection.execute(
+                    "ALTER TABLE files ADD COLUMN hash TEXT NOT NULL DEFAULT ''"
+                )
+
+            # Schema 2 didn't track when files were used
+            for column in ("last_selected", "last_printed"):
+                if column not in columns:
+                    connection.execute(
+                        f"ALTER TABLE files ADD COLUMN {column} REAL NOT NULL DEFAULT 0"
+                    )
+
+            connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('schema', ?)",
+                (str(SCHEMA_VERSION),),
+            )
+
+        return connection
+
+    @property
+    def seeded(self) -> bool:
+        """Whether the index has been populated from OctoPrint's metadata yet"""
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'seeded'"
+            ).fetchone()
+        return row is not None
+
+    def mark_seeded(self):
+        with self._lock, self.connection as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('seeded', ?)",
+                (str(int(time.time())),),
+            )
+
+    def files(self, prefix="") -> dict:
+        """
+        All the tracked files, or just those with paths starting with prefix
+
+        :return: dict of {path: {"id": ..., "eTag": ..., "hash": ..., "size": ..., "mtime": ...,
+            "last_sync": ..., "last_selected": ..., "last_printed": ...}}
+        """
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT * FROM files WHERE substr(path, 1, ?) = ?",
+                (len(prefix), prefix),
+            ).fetchall()
+
+        return {row["path"]: _row_to_dict(row) for row in rows}
+
+    def get(self, path):
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT * FROM files WHERE path = ?", (path,)
+            ).fetchone()
+
+        return _row_to_dict(row) if row is not None else None
+
+    def update(self, path, onedrive_id, etag, size, mtime, content_hash=""):
+        """
+        Record a file as in sync, called after it has been successfully transferred
+
+        When it was last selected & printed is kept.
+
+        :param content_hash: OneDrive's hash of the file content, see graph.content_hash.
+            Not every item has one, None is stored as ""
+        """
+        with self._lock, self.connection as connection:
+            connection.execute(
+                "INSERT INTO files "
+                "(path, onedrive_id, etag, size, mtime, last_sync, hash) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (path) DO UPDATE SET "
+                "onedrive_id = excluded.onedrive_id, etag = excluded.etag, "
+                "size = excluded.size, mtime = excluded.mtime, "
+                "last_sync = excluded.last_sync, hash = excluded.hash",
+                (
+                    path,
+                    onedrive_id,
+                    etag,
+                    size,
+                    mtime,
+                    time.time(),
+                    content_hash or "",
+                ),
+            )
+
+    def mark_used(self, path, printed=False):
+        """
+        Record that a file was selected, or printed, now
+
+        Files that aren't tracked are ignored.
+        """
+        column = "last_printed" if printed else "last_selected"
+        with self._lock, self.connection as connection:
+            connection.execute(
+                f"UPDATE files SET {column} = ? WHERE path = ?", (time.time(), path)
+            )
+
+    def remove(self, *paths):
+        with self._lock, self.connection as connection:
+            connection.executemany(
+                "DELETE FROM files WHERE path = ?", [(path,) for path in paths]
+            )
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def _row_to_dict(row: sqlite3.Row) -> dict:
+    return {
+        "id": row["onedrive_id"],
+        "eTag": row["etag"],
+        "hash": row["hash"],
+        "size": row["size"],
+        "mtime": row["mtime"],
+        "last_sync": row["last_sync"],
+        "last_selected": row["last_selected"],
+        "last_printed": row["last_printed"],
+    }
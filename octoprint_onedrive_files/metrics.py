@@ -0,0 +1,244 @@
+"""
+Metrics on what syncing costs
+
+Counters & histograms are kept in memory from when OctoPrint starts, covering every sync run:
+how long each phase takes, the requests sent to Graph in each phase and how many of them
+were retried after being throttled, the bytes transferred, and the number, duration and
+failures of each type of action.
+
+They are available from the plugin's API as JSON, and at /plugin/onedrive_files/metrics in
+Prometheus' text format, so they can be scraped & graphed across many printers.
+"""
+import math
+import threading
+import time
+
+PREFIX = "onedrive_files"
+
+# Upper bounds, in seconds
+PHASE_BUCKETS = (0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, math.inf)
+ACTION_BUCKETS = (0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, math.inf)
+
+
+class RequestCounters:
+    """Thread-safe totals of the requests sent by a GraphClient"""
+
+    FIELDS = ("requests", "retries", "bytes_sent", "bytes_received")
+
+    def __init__(self):
+        self._values = dict.fromkeys(self.FIELDS, 0)
+        self._lock = threading.Lock()
+
+    def add(self, field, amount=1):
+        with self._lock:
+            self._values[field] += amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    def since(self, snapshot) -> dict:
+        """What has been counted since snapshot() was taken"""
+        current = self.snapshot()
+        return {field: current[field] - snapshot[field] for field in self.FIELDS}
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = f"{PREFIX}_{name}"
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {"|".join(key): value for key, value in self._values.items()}
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name, self._labels(key), value
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _labels(self, key) -> dict:
+        return {label: key[i] for i, label in enumerate(self.labels)}
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Counter):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=PHASE_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "|".join(key): {"count": counts[-1], "sum": round(total, 6)}
+                for key, (counts, total) in self._values.items()
+            }
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(c), t)) for key, (c, t) in self._values.items())
+        for key, (counts, total) in values:
+            labels = self._labels(key)
+            for i, bound in enumerate(self.buckets):
+                le = "+Inf" if bound == math.inf else str(bound)
+                yield f"{self.name}_bucket", dict(labels, le=le), counts[i]
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, counts[-1]
+
+
+class SyncMetrics:
+    def __init__(self):
+        self.runs = Counter("sync_runs_total", "Sync runs, by result", ("result",))
+        self.last_run = Gauge(
+            "sync_last_run_timestamp_seconds", "When the last sync run finished"
+        )
+        self.files = Gauge(
+            "sync_files", "Files listed in the last full sync run, by side", ("side",)
+        )
+        self.phase_seconds = Histogram(
+            "sync_phase_seconds", "Time spent in each phase of a sync run", ("phase",)
+        )
+        self.requests = Counter(
+            "graph_requests_total", "Requests sent to Graph, by phase", ("phase",)
+        )
+        self.retries = Counter(
+            "graph_retries_total",
+            "Requests retried after Graph throttled them, by phase",
+            ("phase",),
+        )
+        self.throttled_seconds = Counter(
+            "graph_throttled_seconds_total", "Time spent waiting out throttling"
+        )
+        self.bytes = Counter(
+            "transfer_bytes_total", "File content transferred", ("direction",)
+        )
+        self.actions = Counter(
+            "actions_total", "Sync actions performed, by type", ("action",)
+        )
+        self.action_errors = Counter(
+            "action_errors_total", "Sync actions that failed, by type", ("action",)
+        )
+        self.action_seconds = Histogram(
+            "action_seconds",
+            "Time taken by each sync action, by type",
+            ("action",),
+            ACTION_BUCKETS,
+        )
+        self.evicted = Counter(
+            "evicted_bytes_total", "Bytes of files swapped for placeholders"
+        )
+
+        self.metrics = [
+            self.runs,
+            self.last_run,
+            self.files,
+            self.phase_seconds,
+            self.requests,
+            self.retries,
+            self.throttled_seconds,
+            self.bytes,
+            self.actions,
+            self.action_errors,
+            self.action_seconds,
+            self.evicted,
+        ]
+
+    def action_done(self, action, seconds=None, failed=False):
+        """
+        Record one sync action
+
+        :param seconds: how long it took, None if not timed on its own, e.g. batched
+        """
+        self.actions.inc(action=action)
+        if failed:
+            self.action_errors.inc(action=action)
+        if seconds is not None:
+            self.action_seconds.observe(seconds, action=action)
+
+    def run_done(self, summary):
+        """Record a sync run from its summary, see sync.run_sync"""
+        self.runs.inc(result="failed" if summary.get("failed") else "ok")
+        self.last_run.set(time.time())
+
+        if not summary.get("subtree"):
+            for side, count in summary.get("files", {}).items():
+                self.files.set(count, side=side)
+
+        for phase, seconds in summary.get("phases", {}).items():
+            self.phase_seconds.observe(seconds, phase=phase)
+
+        for phase, counts in summary.get("requests", {}).items():
+            self.requests.inc(counts["requests"], phase=phase)
+            self.retries.inc(counts["retries"], phase=phase)
+            self.bytes.inc(counts["bytes_received"], direction="download")
+            self.bytes.inc(counts["bytes_sent"], direction="upload")
+
+        self.throttled_seconds.inc(summary.get("throttled", {}).get("seconds", 0))
+        self.evicted.inc(summary.get("evicted", {}).get("bytes", 0))
+
+    def run_error(self):
+        """Record a sync run that stopped with a fatal error"""
+        self.runs.inc(result="error")
+        self.last_run.set(time.time())
+
+    def as_dict(self) -> dict:
+        return {metric.name: metric.as_dict() for metric in self.metrics}
+
+    def prometheus(self) -> str:
+        """The metrics in Prometheus' text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    label_text = ",".join(
+                        '{}="{}"'.format(label, _escape(value))
+                        for label, value in labels.items()
+                    )
+                    name = f"{name}{{{label_text}}}"
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
@@ -0,0 +1,256 @@
+"""
+Graph change notifications for the synced OneDrive folder
+
+Rather than waiting for the next interval, Graph can tell us when something in the folder
+changes. A subscription is created for the folder, pointing at the plugin's notification
+endpoint, which must be reachable from the internet over HTTPS (e.g. through a reverse
+proxy). Each notification then wakes the sync worker, and the delta listing picks up just
+what changed.
+
+Subscriptions on OneDrive only last a few days, so they are renewed before they expire.
+Notifications carry a secret clientState that was given when subscribing, anything without
+it is ignored.
+"""
+import hmac
+import json
+import logging
+import secrets
+import threading
+import time
+
+from .graph import GraphClient, format_time, parse_time
+from .state import load_state, save_state
+
+logger = logging.getLogger("octoprint.plugins.onedrive_files.notifications")
+
+# OneDrive personal allows up to 4230 minutes
+SUBSCRIPTION_LIFETIME = 2 * 24 * 60 * 60  # Seconds
+RENEW_BEFORE = 24 * 60 * 60  # Seconds before expiry
+RETRY_AFTER_FAILURE = 60 * 60  # Seconds, after failing to subscribe or renew
+
+
+class NotificationSubscription:
+    STATE_VERSION = 1
+
+    def __init__(self, path=None):
+        """
+        :param path: Path to persist the subscription to, None to only keep it in memory
+        """
+        self.path = path
+
+        # Loaded lazily, on first use
+        self._subscription = None
+        self._loaded = False
+        self._retry_at = 0.0
+        self._lock = threading.RLock()
+
+    def maintain(self, graph: GraphClient, notification_url, folder_id):
+        """
+        Make sure there is a current subscription for the folder, or none if disabled
+
+        Creates, renews or replaces the subscription as needed. Graph checks the
+        notification URL while subscribing, so the endpoint must already be reachable.
+
+        :param notification_url: public HTTPS URL of the notification endpoint, "" to disable
+        :param folder_id: OneDrive id of the synced folder
+        :raises Exception: anything from Graph, e.g. no token while offline. It is tried
+            again after RETRY_AFTER_FAILURE.
+        """
+        with self._lock:
+            now = time.time()
+            try:
+                self._maintain(graph, notification_url, folder_id, now)
+            except Exception:
+                self._retry_at = now + RETRY_AFTER_FAILURE
+                raise
+
+    def _maintain(self, graph, notification_url, folder_id, now):
+        subscription = self._load()
+
+        if not notification_url or not folder_id:
+            # Nothing to retry while disabled
+            self._retry_at = 0.0
+            if subscription is not None:
+                logger.info("Change notifications disabled, unsubscribing")
+                self._delete(graph)
+            return
+
+        if now < self._retry_at:
+            return
+
+        if subscription is not None and (
+            subscription["notificationUrl"],
+            subscription["folder"],
+        ) != (notification_url, folder_id):
+            logger.info("Notification settings changed, subscribing again")
+            self._delete(graph)
+            subscription = None
+
+        if subscription is not None:
+            if subscription["expires"] - now > RENEW_BEFORE:
+                return
+            if self._renew(graph, now):
+                return
+            # Gone or expired, start again
+            self._set(None)
+
+        self._create(graph, notification_url, folder_id, now)
+
+    def due_in(self, notification_url, folder_id) -> float:
+        """
+        Seconds until maintain() has something to do, None if nothing is planned
+
+        :param notification_url: as will be passed to maintain()
+        :param folder_id: as will be passed to maintain()
+        """
+        if not notification_url or not folder_id:
+            # maintain() only removes the subscription then, which it does straight away
+            return None
+
+        with self._lock:
+            subscription = self._load()
+            due = None
+            if subscription is not None:
+                due = subscription["expires"] - RENEW_BEFORE
+            if self._retry_at:
+                due = max(due or 0.0, self._retry_at)
+            return max(0.0, due - time.time()) if due is not None else None
+
+    def handle(self, args, body: bytes, on_change: callable):
+        """
+        Handle a request from Graph to the notification endpoint
+
+        :param args: the request's query parameters
+        :param body: the raw request body
+        :param on_change: called once if any notification is for the current subscription
+        :return: (response body, HTTP status, headers)
+        """
+        # Graph checks the endpoint when subscribing, and expects the token back
+        token = args.get("validationToken")
+        if token is not None:
+            return token, 200, {"Content-Type": "text/plain"}
+
+        try:
+            notifications = json.loads(body).get("value", [])
+        except (ValueError, AttributeError):
+            return "", 400, {}
+
+        if not isinstance(notifications, list):
+            return "", 400, {}
+
+        valid = [n for n in notifications if self.is_valid(n)]
+        if len(valid) < len(notifications):
+            logger.warning(
+                "Ignored %s change notifications that didn't match the subscription",
+                len(notifications) - len(valid),
+            )
+
+        if valid:
+            logger.debug("OneDrive folder changed, waking sync")
+            on_change()
+
+        # Graph retries anything else, even for notifications we ignored
+        return "", 202, {}
+
+    def is_valid(self, notification) -> bool:
+        """Whether a notification is for the current subscription, with its secret"""
+        with self._lock:
+            subscription = self._load()
+
+        if subscription is None or not isinstance(notification, dict):
+            return False
+
+        if notification.get("subscriptionId") != subscription["id"]:
+            return False
+
+        return hmac.compare_digest(
+            str(notification.get("clientState", "")), subscription["clientState"]
+        )
+
+    def _create(self, graph, notification_url, folder_id, now):
+        client_state = secrets.token_urlsafe(32)
+        response = graph.request(
+            "/subscriptions",
+            method="POST",
+            json={
+                "changeType": "updated",
+                "notificationUrl": notification_url,
+                "resource": f"/me/drive/items/{folder_id}",
+                "expirationDateTime": format_time(now + SUBSCRIPTION_LIFETIME),
+                "clientState": client_state,
+            },
+        )
+
+        if "error" in response or "id" not in response:
+            logger.warning(
+                "Could not subscribe to OneDrive change notifications, will try again "
+                "later (%s)",
+                response.get("error"),
+            )
+            self._retry_at = now + RETRY_AFTER_FAILURE
+            return
+
+        logger.info("Subscribed to OneDrive change notifications")
+        expires = parse_time(response.get("expirationDateTime"))
+        self._retry_at = 0.0
+        self._set(
+            {
+                "id": response["id"],
+                "expires": expires or now + SUBSCRIPTION_LIFETIME,
+                "clientState": client_state,
+                "notificationUrl": notification_url,
+                "folder": folder_id,
+            }
+        )
+
+    def _renew(self, graph, now) -> bool:
+        subscription = self._load()
+        response = graph.request(
+            f"/subscriptions/{subscription['id']}",
+            method="PATCH",
+            json={"expirationDateTime": format_time(now + SUBSCRIPTION_LIFETIME)},
+        )
+
+        if "error" in response:
+            logger.warning(
+                "Could not renew change notification subscription (%s)",
+                response["error"],
+            )
+            return False
+
+        logger.debug("Renewed change notification subscription")
+        self._retry_at = 0.0
+        expires = parse_time(response.get("expirationDateTime"))
+        self._set(dict(subscription, expires=expires or now + SUBSCRIPTION_LIFETIME))
+        return True
+
+    def _delete(self, graph):
+        subscription = self._load()
+        # Best effort, it expires by itself anyway
+        graph.request(f"/subscriptions/{subscription['id']}", method="DELETE")
+        self._retry_at = 0.0
+        self._set(None)
+
+    def _set(self, subscription):
+        self._subscription = subscription
+        self._save()
+
+    def _load(self):
+        if self._loaded:
+            return self._subscription
+
+        self._loaded = True
+
+        state = load_state(self.path, self.STATE_VERSION, "notification subscription")
+        if state is not None:
+            self._subscription = state.get("subscription")
+
+        return self._subscription
+
+    def _save(self):
+        save_state(
+            self.path,
+            self.STATE_VERSION,
+            {"subscription": self._subscription},
+            "notification subscription",
+        )
@@ -0,0 +1,223 @@
+"""
+On-demand placeholders for files in OneDrive
+
+Instead of downloading every file in the synced folder, the sync can add a small placeholder
+to OctoPrint for each one. A placeholder is stored next to where the real file would be, with
+PLACEHOLDER_EXTENSION added to its name, and holds the OneDrive id, eTag, hash & size of the
+real file. The extension is registered as its own file type, not machine code, so OctoPrint
+shows placeholders in the file list but never lets them be selected or printed.
+
+When asked to through the API, the real file is downloaded in place of the placeholder and
+selected, printing it straight away if that was what was asked for.
+"""
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger("octoprint.plugins.onedrive_files.placeholders")
+
+PLACEHOLDER_HEADER = "; OneDrive placeholder"
+PLACEHOLDER_TYPE = "onedrive_placeholder"
+PLACEHOLDER_EXTENSION = "onedrive"
+PLACEHOLDER_SUFFIX = ".placeholder"
+PLACEHOLDER_FIELDS = ("id", "eTag", "hash", "size")
+
+# Anything bigger can't be a placeholder, saves reading whole files to check
+MAX_PLACEHOLDER_SIZE = 4096  # Bytes
+
+PROGRESS_INTERVAL = 1.0  # Seconds between progress messages
+
+
+def extension_tree() -> dict:
+    """Placeholders' file type, for the octoprint.filemanager.extension_tree hook"""
+    return {PLACEHOLDER_TYPE: [PLACEHOLDER_EXTENSION]}
+
+
+def placeholder_name(path) -> str:
+    """Path of the placeholder standing in for the file at path"""
+    return f"{path}.{PLACEHOLDER_EXTENSION}"
+
+
+def is_placeholder_name(path) -> bool:
+    return path.lower().endswith(f".{PLACEHOLDER_EXTENSION}")
+
+
+def real_name(path) -> str:
+    """Path of the file a placeholder at path stands in for"""
+    if not is_placeholder_name(path):
+        return path
+    return path[: -len(PLACEHOLDER_EXTENSION) - 1]
+
+
+def placeholder_content(item) -> bytes:
+    """
+    :param item: the file's id, eTag, hash & size from the OneDrive listing
+    :return: contents of a placeholder for the file
+    """
+    lines = [f"{PLACEHOLDER_HEADER}, download it to print"]
+    for field in PLACEHOLDER_FIELDS:
+        value = item.get(field)
+        lines.append(f"; {field}: {'' if value is None else value}")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def write_placeholder(folder, item) -> str:
+    """
+    Write a placeholder for a file into folder, ready to be added to OctoPrint under
+    placeholder_name()
+
+    :return: path of the placeholder
+    """
+    os.makedirs(folder, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=folder, suffix=PLACEHOLDER_SUFFIX)
+    with os.fdopen(fd, "wb") as f:
+        f.write(placeholder_content(item))
+    return path
+
+
+def read_placeholder(path):
+    """
+    Read a placeholder
+
+    :param path: path of a file on disk
+    :return: {"id", "eTag", "hash", "size"} of the file in OneDrive, or None if path
+        isn't a placeholder. Missing fields are "", and size None
+    """
+    try:
+        if os.path.getsize(path) > MAX_PLACEHOLDER_SIZE:
+            return None
+        with open(path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    except (OSError, UnicodeDecodeError):
+        return None
+
+    if not lines or not lines[0].startswith(PLACEHOLDER_HEADER):
+        return None
+
+    item = dict.fromkeys(PLACEHOLDER_FIELDS, "")
+    for line in lines[1:]:
+        key, sep, value = line.lstrip("; ").partition(":")
+        if sep and key in PLACEHOLDER_FIELDS:
+            item[key] = value.strip()
+
+    if not item.get("id") or not item.get("eTag"):
+        return None
+
+    try:
+        item["size"] = int(item["size"]) if item.get("size") else None
+    except ValueError:
+        item["size"] = None
+
+    return item
+
+
+def is_placeholder(path) -> bool:
+    return read_placeholder(path) is not None
+
+
+class PlaceholderHydrator:
+    """
+    Replaces placeholders with the real file when asked to
+
+    Each download runs in its own thread, so the request that asked for it isn't held up.
+    """
+
+    def __init__(
+        self,
+        path_on_disk: callable,
+        download: callable,
+        on_done: callable,
+        send_message: callable,
+    ):
+        """
+        :param path_on_disk: gives the path on disk of a file in OctoPrint's local storage
+        :param download: download(path, item, on_progress) replaces the placeholder at
+            path with the file from OneDrive
+        :param on_done: on_done(path, print_after) is called with the path of the real
+            file once it is in place
+        :param send_message: send_message(type, content) to update the UI
+        """
+        self.path_on_disk = path_on_disk
+        self.download = download
+        self.on_done = on_done
+        self.send_message = send_message
+
+        # Path => whether to print it once downloaded
+        self._downloading = {}
+        self._lock = threading.Lock()
+
+    def hydrate(self, path, print_after=False) -> bool:
+        """
+        Download the real file for a placeholder in the background
+
+        :param path: path of the placeholder in OctoPrint's local storage
+        :param print_after: start printing the file once downloaded
+        :return: whether path is a placeholder being downloaded
+        """
+        if not is_placeholder_name(path):
+            return False
+
+        with self._lock:
+            if path in self._downloading:
+                # Already on its way, just remember to print it if asked to now
+                self._downloading[path] = self._downloading[path] or print_after
+                return True
+
+            item = read_placeholder(self.path_on_disk(path))
+            if item is None:
+                return False
+
+            self._downloading[path] = print_after
+
+        threading.Thread(
+            target=self._run,
+            args=(path, item),
+            name="OneDriveSync-placeholder",
+            daemon=True,
+        ).start()
+        return True
+
+    def is_downloading(self, path) -> bool:
+        """
+        :param path: path of the placeholder in OctoPrint's local storage
+        """
+        with self._lock:
+            return path in self._downloading
+
+    def _run(self, path, item):
+        # Messages & callbacks refer to the real file, that the user knows
+        target = real_name(path)
+        logger.info("Downloading %s from OneDrive", target)
+        size = item.get("size")
+        last_message = 0.0
+
+        def on_progress(received):
+            nonlocal last_message
+            now = time.monotonic()
+            if now - last_message >= PROGRESS_INTERVAL:
+                last_message = now
+                self.send_message(
+                    "placeholder_progress",
+                    {"path": target, "received": received, "size": size},
+                )
+
+        error = None
+        try:
+            self.download(path, item, on_progress)
+        except Exception as e:
+            logger.error("Could not download %s from OneDrive", target)
+            logger.exception(e)
+            error = str(getattr(e, "error", e))
+
+        with self._lock:
+            print_after = self._downloading.pop(path, False)
+
+        if error is None:
+            logger.info("Downloaded %s from OneDrive", target)
+            self.on_done(target, print_after)
+
+        self.send_message(
+            "placeholder_done", {"path": target, "size": size, "error": error}
+        )
@@ -0,0 +1,114 @@
+"""
+Running the sync at low priority, so it doesn't get in the way of printing
+
+On Linux the sync worker's thread is given the idle I/O scheduling class and a raised nice
+value. Threads started from it, like the listing and action pools, inherit both. Large file
+writes then only go to disk when nothing else needs it, and OctoPrint's communication thread
+gets the CPU first.
+
+LatencyProbe measures how late a normal priority thread wakes up while a sync runs, which is
+what the communication thread experiences. Compare runs with and without low priority to see
+the effect.
+"""
+import contextlib
+import logging
+import sys
+import threading
+import time
+
+import psutil
+
+logger = logging.getLogger("octoprint.plugins.onedrive_files.priority")
+
+NICENESS = 10  # Added to the current nice value
+PROBE_INTERVAL = 0.05  # Seconds between wake ups of the LatencyProbe
+PROBE_MAX_SAMPLES = 100000
+
+
+def lower_priority(niceness=NICENESS) -> bool:
+    """
+    Lower the CPU & I/O priority of the calling thread, and any threads it starts from now on
+
+    Unprivileged processes can't raise it again, so this lasts for the life of the thread.
+
+    :return: whether the priority was lowered, only possible on Linux
+    """
+    if not sys.platform.startswith("linux"):
+        logger.debug("Low priority sync is only supported on Linux")
+        return False
+
+    # On Linux, a thread id can be used as a process id to only affect that thread
+    try:
+        thread = psutil.Process(threading.get_native_id())
+        thread.nice(min(thread.nice() + niceness, 19))
+        thread.ionice(psutil.IOPRIO_CLASS_IDLE)
+    except (psutil.Error, OSError) as e:
+        logger.warning("Could not lower the priority of the sync (%s)", e)
+        return False
+
+    logger.debug("Lowered priority of sync thread %s", threading.current_thread().name)
+    return True
+
+
+class LatencyProbe(threading.Thread):
+    """
+    Measures how late a normal priority thread wakes up from a short sleep
+
+    Must be started from a thread that still has normal priority, so it isn't lowered along
+    with the sync. It sleeps until asked to measure, so costs nothing in between.
+    """
+
+    def __init__(self, interval=PROBE_INTERVAL):
+        super().__init__(name="OneDriveSync-latency", daemon=True)
+        self.interval = interval
+
+        self._measuring = threading.Event()
+        self._samples = []
+        self._lock = threading.Lock()
+
+    def run(self):
+        while True:
+            self._measuring.wait()
+
+            start = time.monotonic()
+            time.sleep(self.interval)
+            late = time.monotonic() - start - self.interval
+
+            with self._lock:
+                if len(self._samples) < PROBE_MAX_SAMPLES:
+                    self._samples.append(late)
+
+    @contextlib.contextmanager
+    def measure(self):
+        """Context manager measuring the latency during its block, see stats()"""
+        with self._lock:
+            self._samples = []
+        self._measuring.set()
+        try:
+            yield
+        finally:
+            self._measuring.clear()
+
+    def stats(self) -> dict:
+        """
+        Summary of the last measurement, in milliseconds
+
+        :return: {"samples": count, "p50": ms, "p99": ms, "max": ms}
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+
+        if not samples:
+            return {"samples": 0, "p50": 0.0, "p99": 0.0, "max": 0.0}
+
+        def percentile(p):
+            return round(
+                samples[min(len(samples) - 1, int(len(samples) * p))] * 1000, 2
+            )
+
+        return {
+            "samples": len(samples),
+            "p50": percentile(0.5),
+            "p99": percentile(0.99),
+            "max": round(samples[-1] * 1000, 2),
+        }
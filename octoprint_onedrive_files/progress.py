@@ -0,0 +1,112 @@
+"""
+Live progress of the transfers in a sync run
+
+Downloads & uploads report their progress as they go, which is added up over the whole run
+and passed on at most every PROGRESS_INTERVAL, so a large sync doesn't flood the socket with
+messages. Throughput is measured over the last THROUGHPUT_WINDOW, and the time left estimated
+from it.
+"""
+import collections
+import threading
+import time
+
+PROGRESS_INTERVAL = 0.5  # Seconds between updates
+THROUGHPUT_WINDOW = 10  # Seconds
+
+
+class TransferProgress:
+    def __init__(self, on_update: callable, interval=PROGRESS_INTERVAL):
+        """
+        :param on_update: called with the progress, see state(), from the transferring thread
+        """
+        self.on_update = on_update
+        self.interval = interval
+
+        self.total = 0
+        self.files_total = 0
+        self.done = 0
+        self.files_done = 0
+        self.current = None
+
+        self._file_done = {}  # Bytes of each file in progress
+        self._samples = collections.deque()  # (time, done)
+        self._last_update = 0.0
+        self._lock = threading.Lock()
+
+    def start(self, files, total):
+        """
+        :param files: number of files to transfer
+        :param total: bytes to transfer
+        """
+        with self._lock:
+            self.files_total = files
+            self.total = total
+            self._samples.append((time.monotonic(), 0))
+        self._update(force=True)
+
+    def file_progress(self, filename, done):
+        """
+        :param filename: the file being transferred
+        :param done: bytes of it transferred so far
+        """
+        with self._lock:
+            previous = self._file_done.get(filename, 0)
+            self._file_done[filename] = done
+            self.done += done - previous
+            self.current = filename
+        self._update()
+
+    def file_finished(self, filename, size=None):
+        """
+        :param size: bytes the file came to, if different from what was reported
+        """
+        with self._lock:
+            previous = self._file_done.pop(filename, 0)
+            if size is not None:
+                self.done += size - previous
+            self.files_done += 1
+        self._update()
+
+    def finish(self):
+        self._update(force=True, finished=True)
+
+    def state(self, finished=False) -> dict:
+        """
+        :return: {"done": bytes, "total": bytes, "files_done": count, "files_total": count,
+            "current": filename, "throughput": bytes/s, "eta": seconds or None,
+            "finished": bool}
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._samples.append((now, self.done))
+            while (
+                len(self._samples) > 2 and now - self._samples[0][0] > THROUGHPUT_WINDOW
+            ):
+                self._samples.popleft()
+
+            first_time, first_done = self._samples[0]
+            elapsed = now - first_time
+            throughput = (self.done - first_done) / elapsed if elapsed > 0 else 0.0
+
+            eta = None
+            if throughput > 0:
+                eta = round(max(0, self.total - self.done) / throughput, 1)
+
+            return {
+                "done": self.done,
+                "total": self.total,
+                "files_done": self.files_done,
+                "files_total": self.files_total,
+                "current": self.current,
+                "throughput": round(throughput),
+                "eta": eta,
+                "finished": finished,
+            }
+
+    def _update(self, force=False, finished=False):
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_update < self.interval:
+                return
+            self._last_update = now
+        self.on_update(self.state(finished))
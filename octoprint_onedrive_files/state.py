@@ -0,0 +1,62 @@
+"""
+State persisted as JSON in the plugin's data folder
+
+Each file is a dict with a "version", so a change to what is saved can just start from
+scratch instead of migrating. Files are written atomically, so a crash part way through
+never leaves a truncated file behind.
+"""
+import json
+import logging
+import os
+
+from octoprint.util import atomic_write
+
+logger = logging.getLogger("octoprint.plugins.onedrive_files.state")
+
+
+def load_state(path, version, name):
+    """
+    Read the state saved at path
+
+    :param path: Path the state is saved at, None if it is only kept in memory
+    :param version: Version of the state expected, any other is ignored
+    :param name: What the state is, for the log, e.g. "sync history"
+    :return: the saved dict, or None if there is none of this version or it can't be read
+    """
+    if not path or not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            state = json.load(f)
+    except Exception as e:
+        logger.error("Failed to read %s, starting from scratch", name)
+        logger.exception(e)
+        return None
+
+    if not isinstance(state, dict) or state.get("version") != version:
+        return None
+    return state
+
+
+def save_state(path, version, state: dict, name) -> bool:
+    """
+    Save the state to path, replacing what was there
+
+    :param path: Path to save the state to, None to skip saving
+    :param version: Version of the state, stored with it
+    :param state: dict to save, anything JSON can encode
+    :param name: What the state is, for the log, e.g. "sync history"
+    :return: whether the state was saved
+    """
+    if not path:
+        return False
+
+    try:
+        with atomic_write(path, mode="wt") as f:
+            json.dump(dict(state, version=version), f)
+    except Exception as e:
+        logger.error("Failed to write %s", name)
+        logger.exception(e)
+        return False
+    return True
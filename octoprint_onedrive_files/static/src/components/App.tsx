@@ -5,6 +5,7 @@ import FileBrowser from "./FileBrowser"
 import { QueryClient, QueryClientProvider } from "@tanstack/react-query"
 import { ReactQueryDevtools } from "@tanstack/react-query-devtools"
 import Auth from "./Auth"
+import SyncHistory from "./SyncHistory"
 
 const queryClient = new QueryClient({
     defaultOptions: {
@@ -54,6 +55,8 @@ function App() {
             <Auth />
             <hr />
             <FileBrowser />
+            <hr />
+            <SyncHistory />
         </>
     )
 }
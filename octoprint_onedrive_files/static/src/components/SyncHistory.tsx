@@ -0,0 +1,191 @@
+import * as React from "react"
+import { useQuery } from "@tanstack/react-query"
+import useSocket from "../hooks/useSocket"
+
+// @ts-ignore:next-line
+const OctoPrint = window.OctoPrint
+const PLUGIN_ID = "onedrive_files"
+
+// Runs taking this many times longer than usual are highlighted
+const SLOW_FACTOR = 3
+
+interface SyncRun {
+    start: number
+    duration: number
+    trigger: "interval" | "manual" | "notification" | "path"
+    subtree: string | null
+    error: boolean
+    files: { octoprint?: number; onedrive?: number }
+    actions: { [action: string]: number }
+    failed: number
+    requests: number
+    bytes: { downloaded: number; uploaded: number }
+    throttled: number
+    evicted: number
+}
+
+const TRIGGERS = {
+    interval: "Scheduled",
+    manual: "Sync now",
+    notification: "OneDrive change",
+    path: "Folder",
+}
+
+const ACTIONS = {
+    download: "downloaded",
+    upload: "uploaded",
+    update_metadata: "updated",
+    delete_octoprint: "deleted in OctoPrint",
+    delete_onedrive: "deleted in OneDrive",
+}
+
+function formatBytes(bytes: number): string {
+    const units = ["B", "KB", "MB", "GB", "TB"]
+    let i = 0
+    while (bytes >= 1024 && i < units.length - 1) {
+        bytes /= 1024
+        i++
+    }
+    return (i ? bytes.toFixed(1) : bytes) + " " + units[i]
+}
+
+function formatDuration(seconds: number): string {
+    if (seconds < 60) {
+        return seconds.toFixed(1) + "s"
+    }
+    const minutes = Math.floor(seconds / 60)
+    return minutes + "m " + Math.round(seconds - minutes * 60) + "s"
+}
+
+function median(values: number[]): number {
+    if (!values.length) {
+        return 0
+    }
+    const sorted = [...values].sort((a, b) => a - b)
+    return sorted[Math.floor(sorted.length / 2)]
+}
+
+export default function SyncHistory() {
+    const { data, isLoading, refetch } = useQuery(["accounts"], () =>
+        OctoPrint.simpleApiGet(PLUGIN_ID),
+    )
+
+    useSocket("plugin", (message) => {
+        if (
+            message.data.plugin === PLUGIN_ID &&
+            message.data.data.type === "sync_end"
+        ) {
+            refetch()
+        }
+    })
+
+    const runs: SyncRun[] = data?.history ? [...data.history].reverse() : []
+
+    // Folder syncs are much quicker than the full ones, compare like with like
+    const usual = median(
+        runs.filter((run) => !run.subtree).map((run) => run.duration),
+    )
+
+    const rows = runs.map((run) => {
+        const slow =
+            !run.subtree && usual > 0 && run.duration > usual * SLOW_FACTOR
+        const rowClass =
+            run.error || run.failed ? "error" : slow ? "warning" : ""
+
+        const actions = Object.keys(run.actions)
+            .map(
+                (action) =>
+                    run.actions[action] + " " + (ACTIONS[action] || action),
+            )
+            .join(", ")
+
+        return (
+            <tr key={run.start} className={rowClass}>
+                <td>{new Date(run.start * 1000).toLocaleString()}</td>
+                <td>
+                    {TRIGGERS[run.trigger] || run.trigger}
+                    {run.subtree && (
+                        <>
+                            {" "}
+                            <code>{run.subtree}</code>
+                        </>
+                    )}
+                </td>
+                <td>
+                    {formatDuration(run.duration)}
+                    {slow && (
+                        <i
+                            className={"fas fa-hourglass-half"}
+                            title={"Slower than usual"}
+                        />
+                    )}
+                    {run.throttled > 0 && (
+                        <div className={"muted"}>
+                            {formatDuration(run.throttled)} throttled
+                        </div>
+                    )}
+                </td>
+                <td>
+                    {run.error
+                        ? "-"
+                        : (run.files.octoprint ?? 0) +
+                          " / " +
+                          (run.files.onedrive ?? 0)}
+                </td>
+                <td>
+                    {run.error ? (
+                        <span className={"text-error"}>
+                            Sync failed, see octoprint.log
+                        </span>
+                    ) : (
+                        actions || "Nothing to do"
+                    )}
+                    {run.failed > 0 && (
+                        <div className={"text-error"}>{run.failed} failed</div>
+                    )}
+                    {run.evicted > 0 && (
+                        <div className={"muted"}>
+                            {run.evicted} swapped for placeholders
+                        </div>
+                    )}
+                </td>
+                <td>
+                    <i className={"fas fa-arrow-down"} />{" "}
+                    {formatBytes(run.bytes.downloaded)}
+                    <br />
+                    <i className={"fas fa-arrow-up"} />{" "}
+                    {formatBytes(run.bytes.uploaded)}
+                </td>
+                <td>{run.requests}</td>
+            </tr>
+        )
+    })
+
+    return (
+        <>
+            <h5>Sync History</h5>
+            {isLoading ? (
+                <p>
+                    <i className={"fas fa-spin fa-spinner"} /> Loading...
+                </p>
+            ) : rows.length ? (
+                <table className={"table table-condensed"}>
+                    <thead>
+                        <tr>
+                            <th>Started</th>
+                            <th>Trigger</th>
+                            <th>Duration</th>
+                            <th title={"OctoPrint / OneDrive"}>Files</th>
+                            <th>Changes</th>
+                            <th>Transferred</th>
+                            <th>Requests</th>
+                        </tr>
+                    </thead>
+                    <tbody>{rows}</tbody>
+                </table>
+            ) : (
+                <p>No syncs yet.</p>
+            )}
+        </>
+    )
+}
@@ -7,6 +7,13 @@ $(function () {
 
         self.syncing = ko.observable(false)
 
+        // Transfers in the current sync, see progress.py
+        self.progress = ko.observable(null)
+
+        // Placeholders being downloaded, path => {received, size}
+        self.downloads = ko.observable({})
+        self.downloadError = ko.observable("")
+
         self.account_configured_override = ko.observable(false)
         self.folder_configured_override = ko.observable(false)
 
@@ -23,8 +30,15 @@ $(function () {
 
         self.paused = ko.pureComputed(function () {
             return (
-                !self.settingsViewModel.settings.plugins.onedrive_files.sync.while_printing() &&
-                self.printerStateViewModel.isPrinting()
+                self.settingsViewModel.settings.plugins.onedrive_files.sync.while_printing() ===
+                    "pause" && self.printerStateViewModel.isPrinting()
+            )
+        })
+
+        self.limited = ko.pureComputed(function () {
+            return (
+                self.settingsViewModel.settings.plugins.onedrive_files.sync.while_printing() ===
+                    "limited" && self.printerStateViewModel.isPrinting()
             )
         })
 
@@ -33,6 +47,8 @@ $(function () {
                 return "fas fa-pause"
             } else if (!self.configured()) {
                 return "fas fa-question"
+            } else if (Object.keys(self.downloads()).length) {
+                return "fas fa-cloud-download-alt"
             } else if (self.syncing()) {
                 return "fas fa-sync"
             } else {
@@ -47,6 +63,8 @@ $(function () {
                 msg += "Paused"
             } else if (!self.configured()) {
                 msg += "Not configured"
+            } else if (self.syncing() && self.limited()) {
+                msg += "Syncing slowly while printing..."
             } else if (self.syncing()) {
                 msg += "Syncing..."
             } else {
@@ -55,6 +73,33 @@ $(function () {
 
             msg = "<p>" + msg + "</p>"
 
+            const progress = self.progress()
+            if (self.syncing() && progress && !progress.finished) {
+                msg += "<p>" + self.progressText(progress) + "</p>"
+            }
+
+            const downloads = self.downloads()
+            Object.keys(downloads).forEach(function (path) {
+                const download = downloads[path]
+                let progress = formatSize(download.received)
+                if (download.size) {
+                    progress +=
+                        " (" +
+                        Math.floor((download.received / download.size) * 100) +
+                        "%)"
+                }
+                msg +=
+                    "<p>Downloading " +
+                    _.escape(path.split("/").pop()) +
+                    ": " +
+                    progress +
+                    "</p>"
+            })
+
+            if (self.downloadError()) {
+                msg += "<p>" + _.escape(self.downloadError()) + "</p>"
+            }
+
             const lastSyncText = self.lastSyncText()
             if (lastSyncText && self.configured()) {
                 msg += "<p>" + lastSyncText + "</p>"
@@ -66,6 +111,36 @@ $(function () {
             return msg
         })
 
+        self.progressText = function (progress) {
+            let text =
+                "Transferring file " +
+                Math.min(progress.files_done + 1, progress.files_total) +
+                " of " +
+                progress.files_total +
+                ": " +
+                formatSize(progress.done) +
+                " of " +
+                formatSize(progress.total)
+
+            if (progress.total) {
+                text +=
+                    " (" + Math.floor((progress.done / progress.total) * 100) + "%)"
+            }
+            if (progress.throughput) {
+                text += ", " + formatSize(progress.throughput) + "/s"
+            }
+            if (progress.eta !== null) {
+                text += ", about " + formatDuration(progress.eta) + " left"
+            }
+            if (progress.current) {
+                text +=
+                    "<br><small>" +
+                    _.escape(progress.current.split("/").pop()) +
+                    "</small>"
+            }
+            return text
+        }
+
         self.sync = function () {
             OctoPrint.simpleApiCommand("onedrive_files", "sync")
         }
@@ -100,11 +175,34 @@ $(function () {
             } else if (data.type === "sync_end") {
                 self.lastSync(new Date().toLocaleTimeString())
                 self.syncing(false)
+                self.progress(null)
+            } else if (data.type === "sync_progress") {
+                self.progress(data.content)
             } else if (data.type === "auth_done") {
                 // slight hack to avoid triggering yet another settings refresh
                 self.account_configured_override(true)
             } else if (data.type === "folder_changed") {
                 self.folder_configured_override(true)
+            } else if (data.type === "placeholder_progress") {
+                const downloads = Object.assign({}, self.downloads())
+                downloads[data.content.path] = {
+                    received: data.content.received,
+                    size: data.content.size,
+                }
+                self.downloads(downloads)
+                self.downloadError("")
+            } else if (data.type === "placeholder_done") {
+                const downloads = Object.assign({}, self.downloads())
+                delete downloads[data.content.path]
+                self.downloads(downloads)
+                if (data.content.error) {
+                    self.downloadError(
+                        "Could not download " +
+                            data.content.path.split("/").pop() +
+                            ": " +
+                            data.content.error
+                    )
+                }
             }
         }
     }
@@ -3,19 +3,53 @@ Module to sync files to OneDrive
 
 
 """
-import copy
+import concurrent.futures
+import contextlib
+import functools
 import logging
 import os
 import pathlib
+import tempfile
 import threading
 import time
+import urllib.parse
 
 import octo_onedrive.onedrive
 import octoprint.filemanager.storage
 from octoprint.filemanager import DiskFileWrapper, FileDestinations, valid_file_type
 
+from .cache import select_evictions
+from .delta import DeltaListing, DeltaSyncError
+from .downloads import DownloadError, DownloadStaging, staging_folder
+from .executor import ActionExecutor, action_limits
+from .graph import GraphClient, GraphError
+from .history import (
+    TRIGGER_INTERVAL,
+    TRIGGER_MANUAL,
+    TRIGGER_NOTIFICATION,
+    TRIGGER_PATH,
+    SyncHistory,
+    history_entry,
+)
+from .index import SyncIndex
+from .metrics import SyncMetrics
+from .notifications import NotificationSubscription
+from .placeholders import (
+    is_placeholder_name,
+    placeholder_name,
+    real_name,
+    write_placeholder,
+)
+from .priority import LatencyProbe, lower_priority
+from .progress import TransferProgress
+from .throttle import BandwidthLimiter
+from .tracking import OctoPrintChangeTracker
+from .uploads import UploadError, UploadSessions
+
 logger = logging.getLogger("octoprint.plugins.onedrive_files.sync")
 
+MIN_WAIT = 1.0  # Seconds the worker waits at least between checks, unless woken
+
 
 class OneDriveSyncWorker(threading.Thread):
     def __init__(
@@ -24,8 +58,12 @@ class OneDriveSyncWorker(threading.Thread):
         onedrive: octo_onedrive.onedrive.OneDriveComm,
         octoprint_filemanager: octoprint.filemanager.FileManager,
         sync_condition: callable,
+        data_folder: str,
         on_sync_start: callable = lambda: None,
         on_sync_end: callable = lambda: None,
+        transfer_limits: callable = lambda: {},
+        in_use: callable = lambda path: False,
+        on_progress: callable = lambda progress: None,
     ):
         super().__init__()
 
@@ -41,6 +79,14 @@ class OneDriveSyncWorker(threading.Thread):
         #    "onedrive_folder": "...",
         #    "octoprint_folder": "OneDrive",
         #    "max_depth": 4,
+        #    "delta": True,
+        #    "list_concurrency": 4,
+        #    "reconcile_interval": 21600,
+        #    "concurrency": {"download": 2, "upload": 1, "delete": 4},
+        #    "low_priority": True,
+        #    "notification_url": "https://.../plugin/onedrive_files/notifications",
+        #    "placeholders": False,
+        #    "cache_size": 0,
         # }
 
         if callable(config):
@@ -49,52 +95,325 @@ class OneDriveSyncWorker(threading.Thread):
             self.config = lambda: config
 
         self.sync_condition = sync_condition
+        # Returns {"bandwidth": bytes/s, "concurrency": n} to hold transfers to, e.g. while
+        # printing, or {} for full speed. Checked throughout each run.
+        self.transfer_limits = transfer_limits
+        # Whether a file in OctoPrint is selected or printing, so mustn't be evicted
+        self.in_use = in_use
+        # Called with the progress of the transfers in a run, see TransferProgress.state()
+        self.on_progress = on_progress
         self.on_sync_start = on_sync_start
         self.on_sync_end = on_sync_end
 
+        self.index = SyncIndex(os.path.join(data_folder, "index.db"))
+        self.tracker = OctoPrintChangeTracker()
+        self.delta_listing = DeltaListing(os.path.join(data_folder, "delta.json"))
+        self.upload_sessions = UploadSessions(os.path.join(data_folder, "uploads.json"))
+        self.download_staging = DownloadStaging(
+            staging_folder(
+                data_folder,
+                os.path.dirname(
+                    octoprint_filemanager.path_on_disk(
+                        FileDestinations.LOCAL, "OneDrive"
+                    )
+                ),
+            )
+        )
+
+        self.subscription = NotificationSubscription(
+            os.path.join(data_folder, "subscription.json")
+        )
+
+        # Created here so it keeps normal priority when this thread's is lowered
+        self.latency_probe = LatencyProbe()
+        self.lowered_priority = None  # Not tried yet
+
+        self.metrics = SyncMetrics()
+        self.history = SyncHistory(os.path.join(data_folder, "history.json"))
+
+        # Set to wake the worker, with the flags below saying why
         self.interrupt = threading.Event()
+        self.sync_requested = False  # Sync now, regardless of the sync condition
+        self.changes_notified = False  # OneDrive reported changes
+        self.pending_subtrees = []  # Folders to sync on their own, ahead of a full run
+        self._wake_lock = threading.Lock()
         self.finished = False
 
         self.daemon = True
 
+    def start(self):
+        self.latency_probe.start()
+        super().start()
+
     def stop(self):
         self.finished = True
         self.interrupt.set()
 
     def run(self):
+        next_sync = time.monotonic() + self.config()["interval"]
+
         while True:
             # Fetch the latest config
             config = self.config()
 
-            # Wait, but break if we're told to stop
-            self.interrupt.wait(config["interval"])
+            can_maintain = self.maintain_subscription(config)
+
+            # Wait until the next sync, or the subscription needs renewing. Break if
+            # we're told to stop
+            timeout = next_sync - time.monotonic()
+            if can_maintain:
+                renew_in = self.subscription.due_in(
+                    config.get("notification_url", ""), config["onedrive_folder"]
+                )
+                if renew_in is not None:
+                    timeout = min(timeout, renew_in)
+            # Never spin, even if something keeps asking to be done now
+            self.interrupt.wait(max(MIN_WAIT, timeout))
 
             if self.finished:
                 break
 
-            if self.sync_condition() or self.interrupt.is_set():
-                # Either sync condition is met or we were asked to sync now
-                if callable(self.on_sync_start):
-                    self.on_sync_start()
+            with self._wake_lock:
+                # Anything that comes in during the sync wakes us up again afterwards
+                requested, self.sync_requested = self.sync_requested, False
+                notified, self.changes_notified = self.changes_notified, False
+                subtrees, self.pending_subtrees = self.pending_subtrees, []
+                self.interrupt.clear()
 
-                try:
-                    run_sync(self.onedrive, self.octoprint_filemanager, config)
-                except FatalSyncError:
-                    logger.error("Fatal error during sync")
+            for subtree in subtrees:
+                # Asked for directly, so like sync now they skip the sync condition
+                self.sync(config, subtree, TRIGGER_PATH)
 
-                self.interrupt.clear()
+            due = time.monotonic() >= next_sync
+            if requested or ((due or notified) and self.sync_condition()):
+                if requested:
+                    trigger = TRIGGER_MANUAL
+                elif notified:
+                    trigger = TRIGGER_NOTIFICATION
+                else:
+                    trigger = TRIGGER_INTERVAL
+                self.sync(config, trigger=trigger)
+                next_sync = time.monotonic() + config["interval"]
+            elif due:
+                # Skipped this time
+                next_sync = time.monotonic() + config["interval"]
+
+    def sync(self, config, subtree=None, trigger=TRIGGER_INTERVAL):
+        """
+        Run a sync in this thread, of everything or just one folder
+
+        :param trigger: what started the run, for the history, see history.TRIGGER_*
+        """
+        if callable(self.on_sync_start):
+            self.on_sync_start()
+
+        start, start_time = time.time(), time.monotonic()
+        summary = None
+        errored = False
+
+        if config.get("low_priority") and self.lowered_priority is None:
+            # Can't be undone, so only happens once
+            self.lowered_priority = lower_priority()
 
-                if callable(self.on_sync_end):
-                    self.on_sync_end()
+        try:
+            with self.latency_probe.measure():
+                summary = run_sync(
+                    self.onedrive,
+                    self.octoprint_filemanager,
+                    config,
+                    self.index,
+                    self.tracker,
+                    delta_listing=self.delta_listing,
+                    upload_sessions=self.upload_sessions,
+                    download_staging=self.download_staging,
+                    transfer_limits=self.transfer_limits,
+                    subtree=subtree,
+                    in_use=self.in_use,
+                    metrics=self.metrics,
+                    progress=TransferProgress(self.on_progress),
+                )
+            if summary is not None:
+                self.metrics.run_done(summary)
+
+                # How late a normal priority thread was woken during the run
+                summary["latency"] = self.latency_probe.stats()
+                logger.debug(
+                    "Wake up latency during sync: p50 %sms, p99 %sms, max %sms",
+                    summary["latency"]["p50"],
+                    summary["latency"]["p99"],
+                    summary["latency"]["max"],
+                )
+        except FatalSyncError:
+            logger.error("Fatal error during sync")
+            self.metrics.run_error()
+            errored = True
+        except Exception as e:
+            # Must not end the worker, the next run may well be fine
+            logger.error("Unexpected error during sync")
+            logger.exception(e)
+            self.metrics.run_error()
+            errored = True
+
+        # Runs that did nothing because the plugin isn't configured aren't kept
+        if summary is not None or errored:
+            self.history.add(
+                history_entry(
+                    start, time.monotonic() - start_time, trigger, summary, subtree
+                )
+            )
+
+        if callable(self.on_sync_end):
+            self.on_sync_end()
 
     def sync_now(self):
         # Override the interval and sync now
-        self.interrupt.set()
+        with self._wake_lock:
+            self.sync_requested = True
+            self.interrupt.set()
+
+    def sync_path(self, subtree):
+        """
+        Sync just one folder, ahead of the next full run
+
+        :param subtree: folder inside the synced folder, normalized by normalize_subtree
+        """
+        with self._wake_lock:
+            if subtree not in self.pending_subtrees:
+                self.pending_subtrees.append(subtree)
+            self.interrupt.set()
+
+    def notify_changed(self):
+        """Something changed in OneDrive, sync now unless the sync condition says not to"""
+        with self._wake_lock:
+            self.changes_notified = True
+            self.interrupt.set()
+
+    def download_placeholder(self, path, item, on_progress=None):
+        """
+        Replace a placeholder with the real file from OneDrive, in the calling thread
+
+        :param path: path of the placeholder in OctoPrint's local storage
+        :param item: the file's id, eTag, hash & size, as read from the placeholder
+        :param on_progress: called with the number of bytes received so far
+        """
+        octoprint_folder = self.config()["octoprint_folder"]
+        filename = "/" + real_name(path)[len(octoprint_folder) :].lstrip("/")
+
+        with GraphClient(self.onedrive, pool_size=1) as graph:
+            download_onedrive(
+                self.octoprint_filemanager,
+                graph,
+                self.index,
+                self.download_staging,
+                filename,
+                item,
+                on_progress=on_progress,
+            )
+
+    def maintain_subscription(self, config) -> bool:
+        """
+        Create, renew or remove the change notification subscription as configured
+
+        :return: whether it could be maintained, not without an account
+        """
+        if not len(self.onedrive.list_accounts()):
+            return False
+
+        try:
+            with GraphClient(self.onedrive, pool_size=1) as graph:
+                self.subscription.maintain(
+                    graph,
+                    config.get("notification_url", ""),
+                    config["onedrive_folder"],
+                )
+        except Exception as e:
+            logger.error("Error maintaining change notification subscription")
+            logger.exception(e)
 
+        return True
+
+
+def run_sync(
+    onedrive,
+    octoprint_filemanager,
+    config,
+    index,
+    tracker,
+    delta_listing=None,
+    graph=None,
+    upload_sessions=None,
+    download_staging=None,
+    transfer_limits=None,
+    subtree=None,
+    in_use=None,
+    metrics: SyncMetrics = None,
+    progress: TransferProgress = None,
+):
+    """
+    Run a sync of the files to OneDrive
+
+    :param index: SyncIndex holding the sync state of each file
+    :param tracker: OctoPrintChangeTracker following changes to the OctoPrint folder
+    :param delta_listing: DeltaListing to list OneDrive incrementally with, if enabled in config
+    :param graph: GraphClient to use, by default one is created for the run
+    :param upload_sessions: UploadSessions to resume interrupted uploads from
+    :param download_staging: DownloadStaging to keep partial downloads in
+    :param transfer_limits: callable returning {"bandwidth": bytes/s, "concurrency": n} to
+        hold transfers to, or {} for full speed. Checked as the run goes, so limits can be
+        lifted or applied part way through. The bandwidth limit only applies to the
+        GraphClient created here.
+    :param subtree: only sync this folder inside the synced folder, e.g. /jobs/bracket, see
+        normalize_subtree. Both sides are listed directly, skipping the delta listing.
+    :param in_use: in_use(path) says whether a file in OctoPrint is selected, printing or
+        being downloaded from its placeholder. These are never replaced, removed or
+        evicted to keep under config["cache_size"]
+    :param metrics: SyncMetrics to record each action in, the run itself is left to the
+        caller to record from the summary
+    :param progress: TransferProgress to report the progress of downloads & uploads to
+
+    :return: dict summarising the run, or None if the plugin is not configured:
+        {
+            "subtree": path or None,
+            "phases": {phase: seconds},
+            "requests": {phase: {"requests", "retries", "bytes_sent", "bytes_received"}},
+            "files": {"octoprint": count, "onedrive": count},
+            "actions": {action: count},
+            "failed": count,
+            "throttled": {"seconds": ..., "responses": ...},
+            "evicted": {"files": count, "bytes": count},
+        }
+    """
+    if graph is None:
+        # One pooled HTTP session for the whole run, closed when the run ends
+        limits = action_limits(config.get("concurrency"))
+        pool_size = sum(limits.values()) + (config.get("list_concurrency") or 1)
+        bandwidth = None
+        if transfer_limits is not None:
+            bandwidth = BandwidthLimiter(lambda: transfer_limits().get("bandwidth", 0))
+
+        with GraphClient(
+            onedrive, pool_size=max(pool_size, 1), bandwidth=bandwidth
+        ) as graph:
+            return run_sync(
+                onedrive,
+                octoprint_filemanager,
+                config,
+                index,
+                tracker,
+                delta_listing=delta_listing,
+                graph=graph,
+                upload_sessions=upload_sessions,
+                download_staging=download_staging,
+                transfer_limits=transfer_limits,
+                subtree=subtree,
+                in_use=in_use,
+                metrics=metrics,
+                progress=progress,
+            )
 
-def run_sync(onedrive, octoprint_filemanager, config):
-    """Run a sync of the files to OneDrive"""
-    logger.debug("Starting sync run, mode: %s", config["mode"])
+    logger.debug(
+        "Starting sync run, mode: %s, folder: %s", config["mode"], subtree or "/"
+    )
     start_time = time.monotonic()
 
     max_depth = config["max_depth"]
@@ -107,36 +426,387 @@ def run_sync(onedrive, octoprint_filemanager, config):
         logger.debug("Plugin not fully configured, skipping sync")
         return
 
-    def recursive_list_onedrive_files(folder_id, current_depth=0, current_path="/"):
-        result = {}
-        root = onedrive.list_files_and_folders(folder_id)
-        if "error" in root:
-            # Error received from OneDrive, abort
-            raise FatalSyncError(root["error"])
-
-        for item in root["items"]:
-            # Check OneDrive file type is valid/supported by OP server
-            if item["type"] == "file" and valid_file_type(item["name"]):
-                result[current_path + item["name"]] = {
-                    "eTag": item["eTag"],
-                    "downloadUrl": item["downloadUrl"],
-                }
-
-            elif item["type"] == "folder":
-                if current_depth < max_depth:
-                    result.update(
-                        recursive_list_onedrive_files(
-                            item["id"],
-                            current_depth + 1,
-                            current_path + item["name"] + "/",
-                        )
+    if upload_sessions is None:
+        upload_sessions = UploadSessions()
+
+    if download_staging is None:
+        download_staging = DownloadStaging(
+            os.path.join(tempfile.gettempdir(), "onedrive_files_downloads")
+        )
+
+    summary = {
+        "subtree": subtree,
+        "phases": {},
+        "requests": {},
+        "files": {},
+        "actions": {},
+    }
+
+    # The scheduler can outlive the run, only count this run's throttling
+    throttled_seconds = graph.scheduler.throttled_seconds
+    throttled_responses = graph.scheduler.throttled_responses
+    phases = summary["phases"]
+    requests = summary["requests"]
+
+    try:
+        with timed(phases, "octoprint_listing"):
+            if not index.seeded:
+                seed_index(octoprint_filemanager, octoprint_folder, index)
+
+            octoprint_files = list_octoprint_files(
+                octoprint_filemanager,
+                octoprint_folder,
+                index,
+                tracker,
+                config.get("reconcile_interval", 0),
+                subtree=subtree,
+            )
+
+        with timed(phases, "onedrive_listing", graph, requests):
+            onedrive_files = None
+            if subtree:
+                onedrive_files = list_onedrive_subtree(
+                    graph,
+                    onedrive_folder,
+                    subtree,
+                    max_depth,
+                    concurrency=config.get("list_concurrency", 1),
+                )
+            elif config.get("delta") and delta_listing is not None:
+                try:
+                    onedrive_files = delta_listing.list_files(
+                        graph, onedrive_folder, max_depth
                     )
-                else:
+                except DeltaSyncError as e:
                     logger.warning(
-                        f"Reached max depth of sub-folders, not going further into {current_path}"
+                        "Incremental listing unavailable, falling back to full listing (%s)",
+                        e,
                     )
 
-        return result
+            if onedrive_files is None:
+                onedrive_files = list_onedrive_files(
+                    graph,
+                    onedrive_folder,
+                    max_depth,
+                    concurrency=config.get("list_concurrency", 1),
+                )
+    except Exception as e:
+        logger.error("Error while listing files")
+        logger.exception(e)
+        raise FatalSyncError("Error while listing files") from e
+
+    sync_algorithms = {
+        "two": two_way_sync,
+        "octoprint": octoprint_sync,
+        "onedrive": onedrive_sync,
+    }
+
+    if mode not in sync_algorithms:
+        logger.error(f"Invalid sync mode: {mode}")
+        raise FatalSyncError
+
+    summary["files"] = {
+        "octoprint": len(octoprint_files),
+        "onedrive": len(onedrive_files),
+    }
+
+    with timed(phases, "diff"):
+        sync_result = sync_algorithms[mode](octoprint_files, onedrive_files)
+
+    for action in sync_result:
+        summary["actions"][action["action"]] = (
+            summary["actions"].get(action["action"], 0) + 1
+        )
+
+    logger.debug("Sync comparison complete")
+    if len(sync_result):
+        # Only what is done to which file, the OneDrive data carries pre-authenticated
+        # download URLs that have no place in the log
+        logger.debug(
+            "Sync actions: %s", [(a["action"], a["file"]) for a in sync_result]
+        )
+
+    with timed(phases, "cleanup", graph, requests):
+        if not subtree:
+            # Sessions for files that don't need uploading any more can go. Only known
+            # after comparing everything
+            upload_sessions.cleanup(
+                graph, keep={a["file"] for a in sync_result if a["action"] == "upload"}
+            )
+        download_staging.cleanup()
+
+    # At this point we have a list of actions to perform
+    with timed(phases, "actions", graph, requests):
+        failed = execute_actions(
+            sync_result,
+            graph,
+            octoprint_filemanager,
+            index,
+            upload_sessions,
+            download_staging,
+            onedrive_folder,
+            limits=config.get("concurrency"),
+            transfer_limits=transfer_limits,
+            placeholders=config.get("placeholders", False),
+            in_use=in_use,
+            metrics=metrics,
+            progress=progress,
+        )
+    summary["failed"] = len(failed)
+
+    summary["evicted"] = {"files": 0, "bytes": 0}
+    if config.get("cache_size") and mode != "octoprint" and not subtree:
+        # Files from OctoPrint are the originals, they stay
+        with timed(phases, "eviction"):
+            summary["evicted"] = evict_files(
+                octoprint_filemanager,
+                index,
+                download_staging,
+                octoprint_folder,
+                config["cache_size"],
+                in_use or (lambda path: False),
+            )
+
+    summary["throttled"] = {
+        "seconds": graph.scheduler.throttled_seconds - throttled_seconds,
+        "responses": graph.scheduler.throttled_responses - throttled_responses,
+    }
+    if summary["throttled"]["responses"]:
+        logger.info(
+            "OneDrive throttled %s requests, sync paused for %.1f seconds",
+            summary["throttled"]["responses"],
+            summary["throttled"]["seconds"],
+        )
+
+    end_time = time.monotonic()
+    logger.debug(
+        "Sync run finished in %s seconds, next run in maximum of %s seconds",
+        round(end_time - start_time, 2),
+        int(config["interval"]),
+    )
+    logger.debug(
+        "Sync phases: %s",
+        ", ".join(
+            f"{phase} {seconds:.2f}s ({requests[phase]['requests']} requests)"
+            if phase in requests
+            else f"{phase} {seconds:.2f}s"
+            for phase, seconds in phases.items()
+        ),
+    )
+
+    return summary
+
+
+def execute_actions(
+    actions,
+    graph,
+    octoprint_filemanager,
+    index,
+    upload_sessions,
+    download_staging,
+    onedrive_folder,
+    limits=None,
+    transfer_limits=None,
+    placeholders=False,
+    in_use: callable = None,
+    metrics: SyncMetrics = None,
+    progress: TransferProgress = None,
+):
+    """
+    Perform the actions from the sync algorithm, logging (and skipping) any failures
+
+    Actions run concurrently, up to the limit for each type of action. Actions on the same
+    path still run in order. Deletes from OneDrive are sent in $batch requests instead.
+
+    :param limits: {"download": n, "upload": n, "delete": n}, see executor.DEFAULT_LIMITS
+    :param transfer_limits: callable returning {"concurrency": n, ...} to cap the number
+        of downloads and uploads at once, see run_sync
+    :param placeholders: add placeholders for new files rather than downloading them
+    :param in_use: in_use(path) says whether a file in OctoPrint's local storage mustn't
+        be replaced or removed, see run_sync
+    :param metrics: SyncMetrics to record each action in
+    :param progress: TransferProgress to report the progress of downloads & uploads to
+    :return: list of the actions that failed
+    """
+    # The sync algorithms never give a path more than one action, so the OneDrive deletes
+    # can be taken out & batched without reordering anything
+    deletes = [a for a in actions if a["action"] == "delete_onedrive"]
+    others = [a for a in actions if a["action"] != "delete_onedrive"]
+
+    # Sized up front, so the bytes to transfer are known before starting
+    transfer_sizes = {}
+    for action in others:
+        if action["action"] == "download":
+            if not wants_placeholder(
+                octoprint_filemanager, action["file"], placeholders
+            ):
+                transfer_sizes[action["file"]] = action.get("size") or 0
+        elif action["action"] == "upload":
+            try:
+                transfer_sizes[action["file"]] = os.path.getsize(
+                    octoprint_filemanager.path_on_disk(
+                        FileDestinations.LOCAL,
+                        storage_path(octoprint_filemanager, action["file"]),
+                    )
+                )
+            except OSError:
+                transfer_sizes[action["file"]] = 0
+
+    if progress is None or not transfer_sizes:
+        progress = None
+    else:
+        progress.start(len(transfer_sizes), sum(transfer_sizes.values()))
+
+    def perform(action):
+        on_progress = None
+        if progress is not None and action["file"] in transfer_sizes:
+            on_progress = functools.partial(progress.file_progress, action["file"])
+
+        if action["action"] == "download":
+            # Decided again, the placeholder may have been downloaded since
+            download_onedrive(
+                octoprint_filemanager,
+                graph,
+                index,
+                download_staging,
+                action["file"],
+                action,
+                placeholder=wants_placeholder(
+                    octoprint_filemanager, action["file"], placeholders
+                ),
+                on_progress=on_progress,
+                in_use=in_use,
+            )
+        elif action["action"] == "upload":
+            upload_onedrive(
+                octoprint_filemanager,
+                graph,
+                index,
+                upload_sessions,
+                onedrive_folder,
+                action["file"],
+                on_progress=on_progress,
+            )
+        elif action["action"] == "update_metadata":
+            update_metadata(octoprint_filemanager, index, action["file"], action)
+        elif action["action"] == "delete_octoprint":
+            delete_octoprint(octoprint_filemanager, index, action["file"], in_use)
+
+    def run_action(action):
+        start = time.monotonic()
+        failed = True
+        try:
+            perform(action)
+            failed = False
+        finally:
+            if metrics is not None:
+                metrics.action_done(
+                    action["action"], time.monotonic() - start, failed=failed
+                )
+            if progress is not None and action["file"] in transfer_sizes:
+                progress.file_finished(
+                    action["file"], None if failed else transfer_sizes[action["file"]]
+                )
+
+    def transfer_limit():
+        if transfer_limits is None:
+            return 0
+        return transfer_limits().get("concurrency", 0)
+
+    failed = ActionExecutor(run_action, limits, transfer_limit).run(others)
+    if progress is not None:
+        progress.finish()
+
+    failed_deletes = delete_onedrive(graph, index, deletes)
+    if metrics is not None:
+        # Batched, so not timed one by one
+        failed_ids = {id(action) for action in failed_deletes}
+        for action in deletes:
+            metrics.action_done(action["action"], failed=id(action) in failed_ids)
+    failed.extend(failed_deletes)
+    return failed
+
+
+@contextlib.contextmanager
+def timed(durations, name, graph=None, requests=None):
+    """
+    Context manager recording how long its block took, in seconds, in durations[name]
+
+    With graph, also records the requests it sent during the block in requests[name], see
+    metrics.RequestCounters
+    """
+    start = time.monotonic()
+    before = graph.counters.snapshot() if graph is not None else None
+    try:
+        yield
+    finally:
+        durations[name] = time.monotonic() - start
+        if before is not None:
+            requests[name] = graph.counters.since(before)
+
+
+def list_octoprint_files(
+    octoprint_filemanager,
+    octoprint_folder,
+    index,
+    tracker,
+    reconcile_interval,
+    subtree=None,
+):
+    """
+    List all the files in the OctoPrint folder, with their sync state from the index
+
+    OctoPrint's metadata is not loaded, the tracker only checks paths that changed on disk.
+    A file only counts as tracked if it is unchanged since it was last synced, otherwise it
+    is treated as a new file.
+
+    :param subtree: only list the files under this folder, e.g. /jobs/bracket. The folder
+        is always re-scanned from disk.
+    :return: dict of files in OctoPrint, {path: {"eTag": ..., "id": ..., "hash": ...}} or
+        {path: {}} if untracked
+    """
+    base_path = octoprint_filemanager.path_on_disk(
+        FileDestinations.LOCAL, octoprint_folder
+    )
+    if subtree:
+        files = tracker.subtree_files(base_path, subtree)
+        tracked = index.files(prefix=subtree + "/")
+    else:
+        files = tracker.files(base_path, reconcile_interval)
+        tracked = index.files()
+
+    result = {}
+    for path, stat in files.items():
+        data = tracked.pop(path, None)
+        if data is not None and unchanged_since_sync(data, stat):
+            result[path] = {
+                "eTag": data["eTag"],
+                "id": data["id"],
+                "hash": data["hash"],
+            }
+        else:
+            # Not synced by OneDriveFileSync, or modified since
+            result[path] = {}
+
+    if tracked:
+        # These files no longer exist, so their state is no longer relevant
+        index.remove(*tracked.keys())
+
+    return result
+
+
+def unchanged_since_sync(data, stat):
+    size, mtime = stat
+    return data["size"] == size and data["mtime"] == mtime
+
+
+def seed_index(octoprint_filemanager, octoprint_folder, index):
+    """
+    Populate the index from the OneDrive metadata on OctoPrint's files
+
+    Only needed once, for files synced before the index existed.
+    """
+    logger.info("Building sync index from OctoPrint's file metadata")
 
     def recursive_list_octoprint_files(data, current_depth=0, current_path="/"):
         result = {}
@@ -164,65 +834,223 @@ def run_sync(onedrive, octoprint_filemanager, config):
 
         return result
 
-    try:
-        octoprint_files = recursive_list_octoprint_files(
-            octoprint_filemanager.list_files(
-                "local", path=octoprint_folder, recursive=True
-            )["local"]
-        )
-        onedrive_files = recursive_list_onedrive_files(onedrive_folder)
-    except Exception as e:
-        logger.error("Error while listing files")
-        logger.exception(e)
-        raise FatalSyncError("Error while listing files") from e
+    octoprint_files = recursive_list_octoprint_files(
+        octoprint_filemanager.list_files(
+            FileDestinations.LOCAL, path=octoprint_folder, recursive=True
+        )[FileDestinations.LOCAL]
+    )
 
-    sync_algorithms = {
-        "two": two_way_sync,
-        "octoprint": octoprint_sync,
-        "onedrive": onedrive_sync,
-    }
+    for path, data in octoprint_files.items():
+        if "eTag" not in data:
+            continue
 
-    if mode not in sync_algorithms:
-        logger.error(f"Invalid sync mode: {mode}")
-        raise FatalSyncError
+        try:
+            stat = os.stat(
+                octoprint_filemanager.path_on_disk(
+                    FileDestinations.LOCAL, octoprint_folder + path
+                )
+            )
+        except OSError:
+            continue
 
-    sync_result = sync_algorithms[mode](octoprint_files, onedrive_files)
+        index.update(path, data["id"], data["eTag"], stat.st_size, stat.st_mtime)
 
-    logger.debug("Sync comparison complete")
-    if len(sync_result):
-        logger.debug("Sync actions:")
-        logger.debug(sync_result)
+    index.mark_seeded()
 
-    # At this point we have a list of actions to perform
-    for action in sync_result:
+
+def list_onedrive_files(
+    graph: GraphClient, folder_id, max_depth, concurrency=1, base_path="/"
+):
+    """
+    List all the valid files in the OneDrive folder, and its sub-folders up to max_depth
+
+    Folders are listed breadth-first, with up to `concurrency` listing requests in flight at
+    once. The result is assembled in the same order a depth-first walk would produce. Each
+    folder is consumed page by page, so large folders are never held in memory in full.
+
+    :param graph: GraphClient to list with
+    :param folder_id: id of the folder to list
+    :param max_depth: maximum depth of sub-folders to list
+    :param concurrency: maximum number of folders to list at once
+    :param base_path: path of the folder inside the synced folder, paths in the result
+        start with it
+
+    :return: dict of files in OneDrive,
+        {path: {"id": ..., "eTag": ..., "hash": ..., "size": ..., "downloadUrl": ...}}
+    :raises FatalSyncError: if OneDrive returns an error for any folder
+    """
+
+    def list_folder(item_id, current_depth, current_path):
+        # Returns the folder's contents in order, files as (path, data) & folders as (path, None)
+        entries = []
+        subfolders = []
         try:
-            if action["action"] == "download":
-                download_onedrive(
-                    octoprint_filemanager, onedrive, onedrive_folder, action["file"]
-                )
-            elif action["action"] == "upload":
-                upload_onedrive(
-                    octoprint_filemanager, onedrive, onedrive_folder, action["file"]
+            for item in graph.children(item_id):
+                add_item(item, current_depth, current_path, entries, subfolders)
+        except GraphError as e:
+            # Error received from OneDrive, abort
+            raise FatalSyncError(e.error) from e
+
+        return current_path, entries, subfolders
+
+    def add_item(item, current_depth, current_path, entries, subfolders):
+        # Check OneDrive file type is valid/supported by OP server. Placeholders are only
+        # ever made by the sync, never synced themselves
+        is_file = item["type"] == "file" and not is_placeholder_name(item["name"])
+        if is_file and valid_file_type(item["name"]):
+            entries.append(
+                (
+                    current_path + item["name"],
+                    {
+                        "id": item["id"],
+                        "eTag": item["eTag"],
+                        "hash": item["hash"],
+                        "size": item["size"],
+                        "downloadUrl": item["downloadUrl"],
+                    },
                 )
-            elif action["action"] == "delete_octoprint":
-                delete_octoprint(octoprint_filemanager, action["file"])
-            elif action["action"] == "delete_onedrive":
-                delete_onedrive(onedrive, onedrive_folder, action["file"])
-        except Exception as e:
-            logger.error("Error syncing file with OneDrive")
-            logger.error(
-                "Error on file %s, action %s", action["file"], action["action"]
             )
-            logger.exception(e)
 
-    end_time = time.monotonic()
-    logger.debug(
-        "Sync run finished in %s seconds, next run in maximum of %s seconds",
-        round(end_time - start_time, 2),
-        int(config["interval"]),
+        elif item["type"] == "folder":
+            if current_depth < max_depth:
+                folder_path = current_path + item["name"] + "/"
+                entries.append((folder_path, None))
+                subfolders.append((item["id"], current_depth + 1, folder_path))
+            else:
+                logger.warning(
+                    f"Reached max depth of sub-folders, not going further into {current_path}"
+                )
+
+    listings = {}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, concurrency), thread_name_prefix="OneDriveList"
+    ) as executor:
+        pending = {executor.submit(list_folder, folder_id, 0, base_path)}
+        try:
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    path, entries, subfolders = future.result()
+                    listings[path] = entries
+                    for subfolder in subfolders:
+                        pending.add(executor.submit(list_folder, *subfolder))
+        except Exception:
+            # Don't carry on listing the rest of the tree
+            for future in pending:
+                future.cancel()
+            raise
+
+    result = {}
+
+    def assemble(path):
+        for entry_path, data in listings[path]:
+            if data is None:
+                assemble(entry_path)
+            else:
+                result[entry_path] = data
+
+    assemble(base_path)
+    return result
+
+
+def list_onedrive_subtree(
+    graph: GraphClient, folder_id, subtree, max_depth, concurrency=1
+):
+    """
+    List the valid files in one folder under the synced OneDrive folder
+
+    :param subtree: path of the folder inside the synced folder, e.g. /jobs/bracket
+    :param max_depth: maximum depth of sub-folders from the synced folder, as for a full listing
+    :return: dict of files in OneDrive, the same as list_onedrive_files. Empty if the folder
+        doesn't exist in OneDrive.
+    :raises FatalSyncError: if OneDrive returns an error
+    """
+    depth = subtree.count("/")
+    if depth > max_depth:
+        logger.warning("%s is deeper than the max depth of sub-folders", subtree)
+        return {}
+
+    item = graph.request(
+        f"/me/drive/items/{folder_id}:/{urllib.parse.quote(subtree.lstrip('/'))}",
+        params={"$select": "id,folder"},
+    )
+    if "error" in item:
+        if item["error"].get("code") == "itemNotFound":
+            return {}
+        raise FatalSyncError(item["error"])
+    if "folder" not in item:
+        logger.warning("%s is not a folder in OneDrive", subtree)
+        return {}
+
+    return list_onedrive_files(
+        graph, item["id"], max_depth - depth, concurrency, base_path=subtree + "/"
     )
 
 
+def normalize_subtree(path):
+    """
+    Turn a folder path given by a user into the form used for subtree syncs
+
+    :return: the path, like /jobs/bracket, or None for the whole synced folder
+    :raises ValueError: if the path isn't a string, or tries to leave the synced folder
+    """
+    if not isinstance(path, str):
+        raise ValueError(f"Invalid folder path: {path!r}")
+
+    parts = [part for part in path.replace("\\", "/").split("/") if part]
+    if any(part in (".", "..") for part in parts):
+        raise ValueError(f"Invalid folder path: {path}")
+    return "/" + "/".join(parts) if parts else None
+
+
+# States of a file in OneDrive, compared to OctoPrint
+ADDED = "added"  # Only in OneDrive
+MODIFIED = "modified"  # In both, OneDrive metadata in OctoPrint doesn't match
+UNTRACKED = "untracked"  # In both, no OneDrive metadata in OctoPrint
+METADATA = "metadata"  # In both, eTag doesn't match but the content hash does
+
+
+def diff_files(octoprint_data, onedrive_data):
+    """
+    Compare the files in OctoPrint and OneDrive by path, shared by all the sync algorithms
+
+    Neither side is copied, and eTags are only compared for paths on both sides. OneDrive
+    changes the eTag on renames and property edits too, so when the eTags differ but the
+    content hashes match the file is only reported as METADATA. Each listing is
+    passed over once with dict membership tests, which benchmarks faster than building key sets
+    (see benchmarks/bench_diff.py).
+
+    :param octoprint_data: dict of files in OctoPrint
+    :param onedrive_data: dict of files in OneDrive
+
+    :return: tuple of (changes, removed)
+        changes: list of (path, state) for each file in OneDrive that is not in sync, in
+            listing order. state is one of ADDED, MODIFIED, UNTRACKED,
+            METADATA.
+        removed: list of paths only in OctoPrint, in listing order
+    """
+    changes = []
+    get_octoprint_file = octoprint_data.get
+    for path, od_file_data in onedrive_data.items():
+        op_file_data = get_octoprint_file(path)
+        if op_file_data is None:
+            changes.append((path, ADDED))
+        elif "eTag" not in op_file_data:
+            changes.append((path, UNTRACKED))
+        elif op_file_data["eTag"] != od_file_data["eTag"]:
+            op_hash = op_file_data.get("hash")
+            if op_hash and op_hash == od_file_data.get("hash"):
+                changes.append((path, METADATA))
+            else:
+                changes.append((path, MODIFIED))
+
+    removed = [path for path in octoprint_data if path not in onedrive_data]
+
+    return changes, removed
+
+
 def two_way_sync(octoprint_data, onedrive_data):
     """
     Two-way sync algorithm producing a list of actions at the end
@@ -239,28 +1067,24 @@ def two_way_sync(octoprint_data, onedrive_data):
     #   If the metadata exists, then the file was deleted from OneDrive and should be deleted from OctoPrint
     #   If the metadata doesn't exist, then it should be uploaded to OneDrive and new metadata added
 
+    changes, removed = diff_files(octoprint_data, onedrive_data)
+
     actions = []
-    # Take a copy of octoprint data so we can remove items as we go
-    octoprint_files_remaining = copy.deepcopy(octoprint_data)
-    for od_file_name, od_file_data in onedrive_data.items():
-        if od_file_name not in octoprint_data:
-            # Exists in OneDrive, not OctoPrint, so download
-            actions.append({"action": "download", "file": od_file_name})
+    for od_file_name, state in changes:
+        if state == METADATA:
+            # Same content, only the OneDrive metadata changed
+            actions.append(
+                onedrive_action("update_metadata", od_file_name, onedrive_data)
+            )
+        elif state == UNTRACKED:
+            # Metadata doesn't exist, upload (file overwritten in OP)
+            actions.append({"action": "upload", "file": od_file_name})
         else:
-            octoprint_files_remaining.pop(od_file_name)
-            # Exists in both, check metadata
-            op_file_data = octoprint_data[od_file_name]
-            if "eTag" in op_file_data:
-                if op_file_data["eTag"] != od_file_data["eTag"]:
-                    # Metadata exists and is different, download (file modified in OneDrive)
-                    actions.append({"action": "download", "file": od_file_name})
-                # Otherwise, metadata matches and do nothing
-            else:
-                # Metadata doesn't exist, upload (file overwritten in OP)
-                actions.append({"action": "upload", "file": od_file_name})
+            # Not in OP, or metadata is different (file modified in OneDrive), download
+            actions.append(onedrive_action("download", od_file_name, onedrive_data))
 
-    for op_file_name, op_file_data in octoprint_files_remaining.items():
-        if "eTag" in op_file_data:
+    for op_file_name in removed:
+        if "eTag" in octoprint_data[op_file_name]:
             # Metadata exists, delete from OP (was deleted from OD)
             actions.append({"action": "delete_octoprint", "file": op_file_name})
         else:
@@ -285,25 +1109,27 @@ def octoprint_sync(octoprint_data, onedrive_data):
     # If the file exists in OctoPrint, but not OneDrive it should be uploaded to OneDrive
     # NEVER download from OneDrive
 
-    actions = []
-    for od_file_name, od_file_data in onedrive_data.items():
+    changes, removed = diff_files(octoprint_data, onedrive_data)
 
-        if od_file_name in octoprint_data:
-            op_file_data = octoprint_data[od_file_name]
-            if "eTag" in op_file_data and op_file_data["eTag"] == od_file_data["eTag"]:
-                # Metadata exists and is the same, ignore
-                continue
-            else:
-                # Something is different, upload
-                actions.append({"action": "upload", "file": od_file_name})
-        else:
+    actions = []
+    for od_file_name, state in changes:
+        if state == ADDED:
             # File exists in OD, but not OP, delete
-            actions.append({"action": "delete_onedrive", "file": od_file_name})
+            actions.append(
+                onedrive_action("delete_onedrive", od_file_name, onedrive_data)
+            )
+        elif state == METADATA:
+            # Same content as OP, only the OneDrive metadata changed
+            actions.append(
+                onedrive_action("update_metadata", od_file_name, onedrive_data)
+            )
+        else:
+            # Something is different, upload
+            actions.append({"action": "upload", "file": od_file_name})
 
-    for op_file_name in octoprint_data.keys():
-        if op_file_name not in onedrive_data:
-            # File exists in OP, but not OD, upload
-            actions.append({"action": "upload", "file": op_file_name})
+    for op_file_name in removed:
+        # File exists in OP, but not OD, upload
+        actions.append({"action": "upload", "file": op_file_name})
 
     return actions
 
@@ -324,58 +1150,107 @@ def onedrive_sync(octoprint_data, onedrive_data):
     #   If the metadata exists, then the file was deleted from OneDrive and should be deleted from OctoPrint
     # NEVER upload to OneDrive
 
-    actions = []
-    for od_file_name, od_file_data in onedrive_data.items():
+    changes, removed = diff_files(octoprint_data, onedrive_data)
 
-        if od_file_name in octoprint_data:
-            op_file_data = octoprint_data[od_file_name]
-            if "eTag" in op_file_data and op_file_data["eTag"] == od_file_data["eTag"]:
-                # Metadata exists and is the same, ignore
-                continue
-            else:
-                # Something is different, download
-                actions.append({"action": "download", "file": od_file_name})
-        else:
-            # File exists in OD, but not OP, download
-            actions.append({"action": "download", "file": od_file_name})
+    # Whatever the difference, download, unless the content is the same
+    actions = [
+        onedrive_action(
+            "update_metadata" if state == METADATA else "download", path, onedrive_data
+        )
+        for path, state in changes
+    ]
 
-    for op_file_name, op_file_data in octoprint_data.items():
-        if op_file_name not in onedrive_data:
-            if "eTag" in op_file_data:
-                # File exists in OP, but not OD (and it was in OD at some point), delete
-                actions.append({"action": "delete_octoprint", "file": op_file_name})
-            # Otherwise ignore the file
+    for op_file_name in removed:
+        if "eTag" in octoprint_data[op_file_name]:
+            # File exists in OP, but not OD (and it was in OD at some point), delete
+            actions.append({"action": "delete_octoprint", "file": op_file_name})
+        # Otherwise ignore the file
 
     return actions
 
 
+def onedrive_action(action, path, onedrive_data):
+    """
+    An action on a file that is in OneDrive, carrying everything the listing knows about it
+    (id, eTag, hash, size, downloadUrl) so it doesn't have to be looked up again
+    """
+    return {"action": action, "file": path, **onedrive_data[path]}
+
+
 def download_onedrive(
     op_filemanager: octoprint.filemanager.FileManager,
-    onedrive: octo_onedrive.onedrive.OneDriveComm,
-    folder_id,
+    graph: GraphClient,
+    index: SyncIndex,
+    download_staging: DownloadStaging,
     filename,
-):
-    logger.debug("Downloading file from OneDrive: %s", filename)
-
-    file_info = onedrive.file_info(root=folder_id, name=filename)
-    if "error" in file_info:
-        # Abort!
-        logger.error("Error fetching file data, skipping (%s)", file_info["error"])
-        return
-
-    file_etag, file_id = file_info.get("eTag", ""), file_info.get("id", "")
-
-    temp_path = onedrive.download_file(folder_id, filename)["path"]
+    item: dict,
+    placeholder=False,
+    on_progress: callable = None,
+    in_use: callable = None,
+) -> bool:
+    """
+    :param item: the file's id, eTag, hash, size & downloadUrl from the OneDrive listing
+    :param placeholder: add a placeholder instead, graph isn't needed then. Whichever of
+        the file & its placeholder was there before is removed
+    :param on_progress: called with the number of bytes received so far
+    :param in_use: in_use(path) says whether the file in OctoPrint's local storage is
+        selected, printing or being downloaded from its placeholder, if so it is left
+        alone. Checked right before it is replaced.
+    :return: whether the file or placeholder was put in place
+    """
+    file_etag, file_id = item["eTag"], item["id"]
 
-    # Do all the long processing to add the file
     new_file_path = pathlib.PurePath(filename[1:])
-    file = DiskFileWrapper(new_file_path.name, temp_path)
-    future_full_path_in_storage = op_filemanager.path_in_storage(
+    real_path = op_filemanager.path_in_storage(
         FileDestinations.LOCAL,
         str("OneDrive" / new_file_path),
     )
+    if placeholder:
+        future_full_path_in_storage = placeholder_name(real_path)
+        replaced_path = real_path
+    else:
+        future_full_path_in_storage = real_path
+        replaced_path = placeholder_name(real_path)
+
+    if placeholder:
+        logger.debug("Adding placeholder for file in OneDrive: %s", filename)
+        temp_path = write_placeholder(download_staging.folder, item)
+    else:
+        logger.debug("Downloading file from OneDrive: %s", filename)
+
+        # Download into staging, carrying on from an interrupted download if there was one
+        try:
+            temp_path = download_staging.fetch(
+                graph,
+                file_id,
+                file_etag,
+                item["size"],
+                item.get("downloadUrl"),
+                on_progress=on_progress,
+            )
+        except DownloadError as e:
+            # Anything received is kept, so the next run can pick up where this one stopped
+            logger.error("Download error: %s", e.error)
+            raise
+
+    # Staged downloads are renamed into place when they are on the same filesystem,
+    # otherwise they have to be copied
+    move = download_staging.same_filesystem(
+        op_filemanager.path_on_disk(FileDestinations.LOCAL, "OneDrive")
+    )
+    if not move:
+        logger.debug("Staging folder is on another filesystem, copying %s", filename)
+    file = DiskFileWrapper(
+        os.path.basename(future_full_path_in_storage), temp_path, move=move
+    )
+
+    # Checked this late as downloads take a while, and files can be selected meanwhile
+    if in_use is not None and in_use(real_path):
+        logger.info("%s is in use, leaving it for the next sync", filename)
+        if placeholder:
+            download_staging.discard(temp_path)
+        return False
 
-    # TODO check that we are not overwriting something already printing?
     try:
         op_filemanager.add_file(
             FileDestinations.LOCAL,
@@ -385,91 +1260,312 @@ def download_onedrive(
         )
     except octoprint.filemanager.storage.StorageError as e:
         logger.error("Error adding file to storage, skipping (%s)", e)
-        return
+        if placeholder:
+            download_staging.discard(temp_path)
+        return False
 
     # Apply metadata to the file
+    metadata = {"eTag": file_etag, "id": file_id}
+    if placeholder:
+        # The file on disk is tiny, this is the size of the real one
+        metadata.update({"placeholder": True, "size": item["size"]})
     op_filemanager.set_additional_metadata(
         FileDestinations.LOCAL,
         future_full_path_in_storage,
         "onedrive",
-        {"eTag": file_etag, "id": file_id},
+        metadata,
         overwrite=True,
     )
 
-    if os.path.exists(temp_path):
-        print("File still exists - it shouldn't!")
+    stat = os.stat(
+        op_filemanager.path_on_disk(FileDestinations.LOCAL, future_full_path_in_storage)
+    )
+    index.update(
+        filename,
+        file_id,
+        file_etag,
+        stat.st_size,
+        stat.st_mtime,
+        item["hash"],
+    )
+
+    # Only once the new one is in place, so the file never disappears from the list
+    if os.path.exists(
+        op_filemanager.path_on_disk(FileDestinations.LOCAL, replaced_path)
+    ):
+        try:
+            op_filemanager.remove_file(FileDestinations.LOCAL, replaced_path)
+        except octoprint.filemanager.storage.StorageError as e:
+            logger.error("Error removing %s from storage (%s)", replaced_path, e)
+
+    if not move:
+        download_staging.discard(temp_path)
+    elif os.path.exists(temp_path):
+        logger.warning("Staged download %s was not moved into OctoPrint", temp_path)
+        download_staging.discard(temp_path)
+
+    return True
+
+
+def wants_placeholder(
+    op_filemanager: octoprint.filemanager.FileManager, filename, placeholders
+) -> bool:
+    """
+    Whether to download a placeholder for a file, rather than the file itself
+
+    Placeholders, including evicted files, stay placeholders & downloaded files are kept
+    up to date. New files get a placeholder if the placeholders setting is on.
+    """
+    path = storage_path(op_filemanager, filename)
+    if not os.path.exists(op_filemanager.path_on_disk(FileDestinations.LOCAL, path)):
+        return placeholders
+    return is_placeholder_name(path)
+
+
+def storage_path(op_filemanager: octoprint.filemanager.FileManager, filename) -> str:
+    """
+    Path in OctoPrint's local storage of a synced file, or of its placeholder if that is
+    what is there instead
+    """
+    path = f"OneDrive/{filename}"
+    if os.path.exists(op_filemanager.path_on_disk(FileDestinations.LOCAL, path)):
+        return path
+
+    placeholder = placeholder_name(path)
+    if os.path.exists(op_filemanager.path_on_disk(FileDestinations.LOCAL, placeholder)):
+        return placeholder
+    return path
+
+
+def evict_files(
+    op_filemanager: octoprint.filemanager.FileManager,
+    index: SyncIndex,
+    download_staging: DownloadStaging,
+    octoprint_folder,
+    max_size,
+    in_use: callable = lambda path: False,
+) -> dict:
+    """
+    Swap the least recently used files for placeholders, until under max_size, see cache.py
+
+    :param max_size: bytes the synced files may take up, 0 for no limit
+    :param in_use: in_use(path) says whether a file in OctoPrint's local storage is
+        selected or printing, and so mustn't be touched
+    :return: {"files": count, "bytes": count} evicted
+    """
+    evicted = {"files": 0, "bytes": 0}
+    files = index.files()
+
+    def can_evict(filename, entry):
+        path = f"{octoprint_folder}{filename}"
+        if in_use(path):
+            return False
+
+        # Missing for files that are already placeholders. Files changed locally are left
+        # alone, the changes would be lost
+        path_on_disk = op_filemanager.path_on_disk(FileDestinations.LOCAL, path)
+        try:
+            stat = os.stat(path_on_disk)
+        except OSError:
+            return False
+        return unchanged_since_sync(entry, (stat.st_size, stat.st_mtime))
+
+    for filename in select_evictions(files, max_size, can_evict):
+        entry = files[filename]
+        logger.debug("Evicting least recently used file: %s", filename)
+        # Checked again right before, as a file could have been selected meanwhile
+        if not download_onedrive(
+            op_filemanager,
+            None,
+            index,
+            download_staging,
+            filename,
+            entry,
+            placeholder=True,
+            in_use=in_use,
+        ):
+            continue
+        evicted["files"] += 1
+        evicted["bytes"] += entry["size"]
+
+    if evicted["files"]:
+        logger.info(
+            "Evicted %s files (%s bytes) to keep under the size limit",
+            evicted["files"],
+            evicted["bytes"],
+        )
+
+    return evicted
 
 
 def upload_onedrive(
     op_filemanager: octoprint.filemanager.FileManager,
-    onedrive: octo_onedrive.onedrive.OneDriveComm,
+    graph: GraphClient,
+    index: SyncIndex,
+    upload_sessions: UploadSessions,
     folder_id,
     filename,
+    on_progress: callable = None,
 ):
+    """
+    :param on_progress: called with the number of bytes uploaded so far
+    """
     logger.debug("Uploading file to OneDrive: %s", filename)
 
     # Get the file from OctoPrint
-    file_path = op_filemanager.path_on_disk(
-        FileDestinations.LOCAL, f"OneDrive/{filename}"
-    )
+    path = storage_path(op_filemanager, filename)
+    if is_placeholder_name(path):
+        # Would replace the real file in OneDrive with the placeholder
+        logger.warning("Not uploading placeholder %s to OneDrive", filename)
+        return
 
-    def on_upload_progress(progress):
-        logger.debug("Upload progress: %s", progress)
+    file_path = op_filemanager.path_on_disk(FileDestinations.LOCAL, path)
 
-    def on_upload_complete():
-        logger.debug("Upload complete")
+    size = os.path.getsize(file_path)
 
-    def on_upload_error(error):
-        logger.error("Upload error: %s", error)
+    def on_upload_progress(progress):
+        logger.debug("Upload progress: %s", progress)
+        if on_progress is not None:
+            on_progress(size * progress // 100)
 
-    # Upload the file
-    result = onedrive.upload_file(
-        filename,
-        file_path,
-        folder_id,
-        on_upload_progress,
-        on_upload_complete,
-        on_upload_error,
-    )
+    # Upload the file, carrying on from an interrupted upload if there was one
+    try:
+        result = upload_sessions.upload(
+            graph, folder_id, filename, file_path, on_upload_progress
+        )
+    except UploadError as e:
+        # The session is kept, so the next run can pick up where this one stopped
+        logger.error("Upload error: %s", e.error)
+        raise
 
     logger.debug("File uploaded successfully")
 
     # Update the metadata
     op_filemanager.set_additional_metadata(
         FileDestinations.LOCAL,
-        f"OneDrive/{filename}",
+        path,
         "onedrive",
         {"eTag": result["eTag"], "id": result["id"]},
         overwrite=True,
     )
 
+    stat = os.stat(file_path)
+    index.update(
+        filename,
+        result["id"],
+        result["eTag"],
+        stat.st_size,
+        stat.st_mtime,
+        result["hash"],
+    )
+
     # Hopefully that means all is good?
     logger.debug("File metadata updated successfully")
 
 
-def delete_octoprint(op_filemanager: octoprint.filemanager.FileManager, filename):
+def update_metadata(
+    op_filemanager: octoprint.filemanager.FileManager,
+    index: SyncIndex,
+    filename,
+    item: dict,
+):
+    logger.debug(
+        "Updating metadata of file, content unchanged in OneDrive: %s", filename
+    )
+
+    file_etag, file_id = item["eTag"], item["id"]
+    path = storage_path(op_filemanager, filename)
+    file_path = op_filemanager.path_on_disk(FileDestinations.LOCAL, path)
+
+    metadata = {"eTag": file_etag, "id": file_id}
+    if is_placeholder_name(path):
+        metadata.update({"placeholder": True, "size": item.get("size")})
+    op_filemanager.set_additional_metadata(
+        FileDestinations.LOCAL,
+        path,
+        "onedrive",
+        metadata,
+        overwrite=True,
+    )
+
+    stat = os.stat(file_path)
+    index.update(
+        filename, file_id, file_etag, stat.st_size, stat.st_mtime, item["hash"]
+    )
+
+
+def delete_octoprint(
+    op_filemanager: octoprint.filemanager.FileManager,
+    index: SyncIndex,
+    filename,
+    in_use: callable = None,
+):
+    """
+    :param in_use: in_use(path) says whether the file in OctoPrint's local storage is
+        selected, printing or being downloaded from its placeholder, if so it is kept
+    """
     logger.debug("Deleting file from OctoPrint: %s", filename)
 
+    if in_use is not None and in_use(f"OneDrive{filename}"):
+        logger.info("%s is in use, leaving it for the next sync", filename)
+        return
+
     try:
-        op_filemanager.remove_file(FileDestinations.LOCAL, f"OneDrive/{filename}")
+        op_filemanager.remove_file(
+            FileDestinations.LOCAL, storage_path(op_filemanager, filename)
+        )
     except octoprint.filemanager.storage.StorageError as e:
         logger.error("Error deleting file from storage, skipping (%s)", e)
+        return
 
+    index.remove(filename)
 
-def delete_onedrive(onedrive: octo_onedrive.onedrive.OneDriveComm, folder_id, filename):
-    logger.debug("Deleting file from OneDrive: %s", filename)
 
-    try:
-        result = onedrive.delete_file(folder_id, filename)
-    except Exception as e:
-        logger.error("Error deleting file from OneDrive, skipping (%s)", e)
-        return
+def delete_onedrive(graph: GraphClient, index: SyncIndex, actions):
+    """
+    Delete files from OneDrive, up to 20 at a time in each $batch request
 
-    if type(result) == dict and "error" in result:
-        logger.error(
-            "Error deleting file from OneDrive, skipping (%s)", result["error"]
-        )
-        return
+    Files are deleted by id, and only if their eTag still matches the listing, so a file
+    changed since it was listed is left alone.
+
+    :param actions: delete_onedrive actions, carrying the files' ids & eTags
+    :return: list of the actions that failed
+    """
+    for action in actions:
+        logger.debug("Deleting file from OneDrive: %s", action["file"])
+
+    responses = graph.batch(
+        [
+            {
+                "id": str(i),
+                "method": "DELETE",
+                "url": f"/me/drive/items/{action['id']}",
+                "headers": {"If-Match": action["eTag"]},
+            }
+            for i, action in enumerate(actions)
+        ]
+    )
+
+    deleted = []
+    failed = []
+    for i, action in enumerate(actions):
+        response = responses[str(i)]
+        status = response["status"]
+
+        # 404 means the file is already gone, which is what we wanted anyway
+        if status is not None and (200 <= status < 300 or status == 404):
+            deleted.append(action["file"])
+        else:
+            logger.error(
+                "Error deleting file from OneDrive, skipping (%s)",
+                response["body"].get("error", status),
+            )
+            failed.append(action)
+
+    if deleted:
+        index.remove(*deleted)
+
+    return failed
 
 
 class FatalSyncError(Exception):
@@ -0,0 +1,223 @@
+"""
+Scheduling of requests to OneDrive, to stay within Graph's throttling limits
+
+All requests in a sync run take a token from a shared bucket before being sent. When Graph
+throttles us (429 or 503), every request waits out the Retry-After period together and the
+rate drops to half of what was actually being sent, then it creeps back up again as requests
+succeed.
+
+Transfers can also be held to a bandwidth limit, for example while a print is running, by
+passing their bytes through a BandwidthLimiter.
+"""
+import collections
+import email.utils
+import logging
+import threading
+import time
+
+logger = logging.getLogger("octoprint.plugins.onedrive_files.throttle")
+
+THROTTLED_STATUSES = (429, 503)
+
+# Requests per second. Until Graph pushes back the limit is high enough not to get in the way
+DEFAULT_RATE = 200.0
+MIN_RATE = 0.5
+MAX_RATE = 200.0
+BURST = 20  # Requests that can be sent at once after a quiet period
+RATE_WINDOW = 10.0  # Seconds of sent requests to measure the actual rate over
+
+RATE_INCREASE = 1.02  # Multiplier on each successful request
+DEFAULT_BACKOFF = 5.0  # Seconds, when Graph doesn't say how long to wait
+MAX_BACKOFF = 5 * 60
+
+RATE_CHECK_INTERVAL = 1.0  # Seconds between checks of a BandwidthLimiter's limit
+
+
+class RequestScheduler:
+    def __init__(self, rate=DEFAULT_RATE, min_rate=MIN_RATE, max_rate=MAX_RATE):
+        """
+        :param rate: requests per second to start at
+        :param min_rate: the rate is never lowered below this
+        :param max_rate: the rate is never raised above this
+        """
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+
+        # Wall time spent paused because of throttling, and how often it happened
+        self.throttled_seconds = 0.0
+        self.throttled_responses = 0
+
+        self._tokens = float(BURST)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._backoff = DEFAULT_BACKOFF
+        # Times requests were sent within the last RATE_WINDOW
+        self._sent = collections.deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request can be sent"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    self._sent.append(now)
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+    def throttled(self, retry_after=None):
+        """
+        Record a throttled response, pausing all requests
+
+        :param retry_after: seconds to wait from the Retry-After header, if there was one
+        """
+        with self._lock:
+            now = time.monotonic()
+
+            if retry_after is None:
+                retry_after = self._backoff
+                self._backoff = min(self._backoff * 2, MAX_BACKOFF)
+
+            if now >= self._paused_until:
+                # Only slow down once for each pause, however many requests were throttled
+                self.rate = max(
+                    self.min_rate, min(self.rate, self._actual_rate(now)) / 2
+                )
+
+            until = now + retry_after
+            if until > self._paused_until:
+                self.throttled_seconds += until - max(now, self._paused_until)
+                self._paused_until = until
+
+            self.throttled_responses += 1
+            self._tokens = 0.0
+
+        logger.debug(
+            "Throttled by OneDrive, pausing for %.1fs, rate now %.1f requests/s",
+            retry_after,
+            self.rate,
+        )
+
+    def succeeded(self):
+        """Record a request that wasn't throttled"""
+        with self._lock:
+            self._backoff = DEFAULT_BACKOFF
+            self.rate = min(self.max_rate, self.rate * RATE_INCREASE)
+
+    def _actual_rate(self, now):
+        while self._sent and self._sent[0] < now - RATE_WINDOW:
+            self._sent.popleft()
+
+        if len(self._sent) < 2:
+            return self.rate
+        return len(self._sent) / max(now - self._sent[0], 1.0)
+
+    def _refill(self, now):
+        self._tokens = min(BURST, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+def parse_retry_after(value):
+    """
+    Seconds to wait from a Retry-After header, either a number of seconds or an HTTP date
+
+    :return: seconds, or None if there was no usable value
+    """
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(
+            0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        )
+    except (TypeError, ValueError):
+        return None
+
+
+class BandwidthLimiter:
+    def __init__(self, rate: callable = lambda: 0):
+        """
+        :param rate: returns the current limit in bytes per second, 0 for no limit. Called
+            at most once every RATE_CHECK_INTERVAL, so the limit can change mid-transfer.
+        """
+        self.rate = rate
+
+        self._current = 0
+        self._checked = 0.0
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        """Block until size bytes can be sent or received within the limit"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                rate = self._limit(now)
+                if not rate:
+                    return
+
+                # Allow up to one second's worth at once, but at least a whole chunk
+                burst = max(rate, size)
+                self._tokens = min(burst, self._tokens + (now - self._updated) * rate)
+                self._updated = now
+
+                if self._tokens >= size:
+                    self._tokens -= size
+                    return
+
+                wait = min((size - self._tokens) / rate, RATE_CHECK_INTERVAL)
+
+            time.sleep(wait)
+
+    def _limit(self, now):
+        if now - self._checked >= RATE_CHECK_INTERVAL:
+            rate = self.rate() or 0
+            if rate and not self._current:
+                # Limit just switched on, start from an empty bucket
+                self._tokens = 0.0
+                self._updated = now
+            self._current = rate
+            self._checked = now
+        return self._current
+
+
+class MeteredBody:
+    """
+    Request body read through a BandwidthLimiter
+
+    requests sends file-like bodies in blocks as they are read, and still sets Content-Length
+    from len(), which Graph needs for upload chunks.
+    """
+
+    def __init__(self, data: bytes, limiter: BandwidthLimiter):
+        self.data = data
+        self.limiter = limiter
+        self._position = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.data) - self._position
+
+        block = self.data[self._position : self._position + size]
+        self._position += len(block)
+        if block:
+            self.limiter.consume(len(block))
+        return block
@@ -0,0 +1,161 @@
+"""
+Tracking of changes to the synced folder in OctoPrint, from OctoPrint's file events
+
+Instead of walking the whole folder every sync, only the paths that OctoPrint reported as
+added, removed or moved since the last run are checked on disk. A full scan is still run
+periodically, in case something changed the folder without OctoPrint knowing.
+
+Placeholders (see placeholders.py) are listed under the name of the file they stand in for,
+the file itself winning if both are there.
+"""
+import logging
+import os
+import threading
+import time
+
+from octoprint.filemanager import valid_file_type
+
+from .placeholders import is_placeholder_name, placeholder_name, real_name
+
+logger = logging.getLogger("octoprint.plugins.onedrive_files.tracking")
+
+
+class OctoPrintChangeTracker:
+    def __init__(self, folder="OneDrive"):
+        """
+        :param folder: The synced folder, relative to OctoPrint's local storage
+        """
+        self.folder = folder.strip("/")
+
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self._full_scan_needed = True
+
+        # path => (size, mtime) of every file in the folder, as of the last run
+        self._files = {}
+        self._last_full_scan = 0.0
+
+    def mark_dirty(self, storage_path):
+        """
+        Mark a path as changed, to be checked on the next sync. Paths outside the synced
+        folder are ignored.
+
+        :param storage_path: path of a file or folder in OctoPrint's local storage
+        """
+        storage_path = storage_path.strip("/")
+
+        if storage_path == self.folder:
+            # The whole folder was affected
+            self.mark_full_scan()
+            return
+
+        if not storage_path.startswith(self.folder + "/"):
+            return
+
+        with self._lock:
+            self._dirty.add(storage_path[len(self.folder) :])
+
+    def mark_full_scan(self):
+        """Force the next sync to scan the whole folder"""
+        with self._lock:
+            self._full_scan_needed = True
+
+    def files(self, base_path, reconcile_interval):
+        """
+        Bring the list of files up to date, and return it
+
+        :param base_path: Path of the synced folder on disk
+        :param reconcile_interval: Seconds between full scans of the folder
+        :return: dict of {path: (size, mtime)} of every file in the folder
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            reconcile_due = (
+                time.monotonic() - self._last_full_scan >= reconcile_interval
+            )
+            full_scan = self._full_scan_needed or reconcile_due
+            self._full_scan_needed = False
+
+        if full_scan:
+            logger.debug("Scanning all files in the OctoPrint folder")
+            files = {}
+            if os.path.isdir(base_path):
+                _scan(base_path, "/", files)
+            self._files = files
+            self._last_full_scan = time.monotonic()
+
+        elif dirty:
+            logger.debug(
+                "Checking %s changed paths in the OctoPrint folder", len(dirty)
+            )
+            for path in dirty:
+                self._refresh(base_path, path)
+
+        return self._files
+
+    def subtree_files(self, base_path, path):
+        """
+        Bring one folder up to date from disk, and return the files in it
+
+        :param base_path: Path of the synced folder on disk
+        :param path: Path of the folder inside the synced folder, e.g. /jobs/bracket
+        :return: dict of {path: (size, mtime)} of every file under the folder
+        """
+        path = "/" + path.strip("/")
+        self._refresh(base_path, path)
+
+        prefix = path + "/"
+        return {p: stat for p, stat in self._files.items() if p.startswith(prefix)}
+
+    def _refresh(self, base_path, path):
+        if is_placeholder_name(path) and not os.path.isdir(
+            os.path.join(base_path, path.lstrip("/"))
+        ):
+            path = real_name(path)
+
+        # Forget anything at or below the path, then add back whatever is there now
+        prefix = path + "/"
+        if self._files.pop(path, None) is None:
+            # Not a known file, so it could be a folder
+            for known in [p for p in self._files if p.startswith(prefix)]:
+                del self._files[known]
+
+        full_path = os.path.join(base_path, path.lstrip("/"))
+        if os.path.isdir(full_path):
+            _scan(full_path, prefix, self._files)
+            return
+
+        for candidate in (full_path, placeholder_name(full_path)):
+            if os.path.isfile(candidate) and _is_synced_file(os.path.basename(path)):
+                stat = os.stat(candidate)
+                self._files[path] = (stat.st_size, stat.st_mtime)
+                break
+
+
+def _is_synced_file(name):
+    # OctoPrint ignores hidden files and folders
+    return not name.startswith(".") and valid_file_type(name, type="machinecode")
+
+
+def _is_placeholder(name):
+    return is_placeholder_name(name) and _is_synced_file(real_name(name))
+
+
+def _scan(folder, current_path, files):
+    for entry in os.scandir(folder):
+        if entry.name.startswith("."):
+            continue
+
+        if entry.is_dir():
+            _scan(entry.path, current_path + entry.name + "/", files)
+
+        elif entry.is_file() and _is_synced_file(entry.name):
+            stat = entry.stat()
+            files[current_path + entry.name] = (stat.st_size, stat.st_mtime)
+
+        elif entry.is_file() and _is_placeholder(entry.name):
+            # Unless the file itself was already found
+            stat = entry.stat()
+            files.setdefault(
+                current_path + real_name(entry.name), (stat.st_size, stat.st_mtime)
+            )
@@ -0,0 +1,260 @@
+"""
+Resumable uploads to OneDrive, through upload sessions
+
+The upload URL of each session, and how much of the file OneDrive has acknowledged, are
+persisted in the plugin's data folder. If OctoPrint restarts or the connection drops part way
+through a large file, the next run carries on from the last acknowledged chunk instead of
+starting again from zero.
+"""
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+from .graph import GraphClient, content_hash, parse_time
+from .state import load_state, save_state
+
+logger = logging.getLogger("octoprint.plugins.onedrive_files.uploads")
+
+# Chunks must be a multiple of 320KiB, Microsoft recommend 5-10MiB
+CHUNK_SIZE = 320 * 1024 * 16
+CHUNK_TIMEOUT = 60  # Seconds, longer than the default as each request carries a chunk
+
+
+class UploadError(Exception):
+    """Raised when an upload fails, its session is kept so it can be resumed next time."""
+
+    def __init__(self, error):
+        super().__init__(error)
+        self.error = error
+
+
+class UploadSessions:
+    STATE_VERSION = 1
+
+    def __init__(self, path=None):
+        """
+        :param path: Path to persist the sessions to, None to only keep them in memory
+        """
+        self.path = path
+
+        # Loaded lazily, on first use
+        self._sessions = None
+        self._lock = threading.RLock()
+
+    def upload(
+        self,
+        graph: GraphClient,
+        folder_id,
+        filename,
+        file_path,
+        on_progress: callable = lambda x: None,
+    ) -> dict:
+        """
+        Upload a file to OneDrive, resuming an earlier session for it if there is one
+
+        An existing file at the same path is replaced.
+
+        :param filename: path of the file relative to the synced folder, e.g. /folder/file.gcode
+        :param file_path: path of the file on disk
+        :param on_progress: called with the upload progress as an integer percentage
+        :return: {"id": ..., "eTag": ..., "hash": ...} of the file in OneDrive
+        :raises UploadError: if any part of the upload fails
+        """
+        stat = os.stat(file_path)
+        size = stat.st_size
+
+        if not size:
+            # Upload sessions can't be used for empty files
+            return self._upload_empty(graph, folder_id, filename)
+
+        session, offset = self._resume(graph, filename, stat)
+        if session is None:
+            session = self._create(graph, folder_id, filename, stat)
+            offset = 0
+
+        with open(file_path, "rb") as f:
+            while True:
+                f.seek(offset)
+                chunk = f.read(CHUNK_SIZE)
+                end = offset + len(chunk) - 1
+
+                response = graph.request(
+                    session["uploadUrl"],
+                    method="PUT",
+                    data=chunk,
+                    headers={"Content-Range": f"bytes {offset}-{end}/{size}"},
+                    timeout=CHUNK_TIMEOUT,
+                    auth=False,
+                )
+
+                if "error" in response:
+                    if response["error"].get("code") in ("itemNotFound", "404"):
+                        # The session has gone, no point trying to resume it
+                        self._forget(filename)
+                    raise UploadError(response["error"])
+
+                if "id" in response:
+                    # The last chunk returns the finished item
+                    self._forget(filename)
+                    on_progress(100)
+                    return _uploaded(response)
+
+                offset = _next_offset(response, end + 1)
+                self._update(
+                    filename,
+                    committed=offset,
+                    expires=parse_time(response.get("expirationDateTime")),
+                )
+                on_progress((100 * offset) // size)
+
+    def cleanup(self, graph: GraphClient, keep=()):
+        """
+        Forget sessions that have expired, and cancel those for files no longer being uploaded
+
+        :param keep: paths of the files that are still to be uploaded
+        """
+        with self._lock:
+            sessions = self._load()
+            now = time.time()
+
+            for filename, session in list(sessions.items()):
+                if _expired(session, now):
+                    logger.debug("Upload session for %s has expired", filename)
+                    self._forget(filename)
+                elif filename not in keep:
+                    logger.debug("Cancelling unfinished upload of %s", filename)
+                    self._cancel(graph, filename)
+
+    def _create(self, graph, folder_id, filename, stat):
+        name = filename.rsplit("/", 1)[-1]
+        response = graph.request(
+            f"/me/drive/items/{folder_id}:/{urllib.parse.quote(filename.lstrip('/'))}:/createUploadSession",
+            method="POST",
+            json={
+                "item": {
+                    "@microsoft.graph.conflictBehavior": "replace",
+                    "name": name,
+                    "fileSize": stat.st_size,
+                }
+            },
+        )
+
+        if "error" in response:
+            raise UploadError(response["error"])
+        if "uploadUrl" not in response:
+            raise UploadError(
+                {"code": "invalidResponse", "message": "No upload URL in response"}
+            )
+
+        session = {
+            "uploadUrl": response["uploadUrl"],
+            "expires": parse_time(response.get("expirationDateTime")),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "committed": 0,
+        }
+
+        with self._lock:
+            self._load()[filename] = session
+            self._save()
+
+        return session
+
+    def _resume(self, graph, filename, stat):
+        with self._lock:
+            session = self._load().get(filename)
+
+        if session is None:
+            return None, 0
+
+        changed = (session["size"], session["mtime"]) != (stat.st_size, stat.st_mtime)
+        if changed or _expired(session, time.time()):
+            # Can't carry on uploading a file that has changed since
+            self._cancel(graph, filename)
+            return None, 0
+
+        status = graph.request(session["uploadUrl"], auth=False)
+        if "error" in status:
+            logger.warning(
+                "Could not resume upload of %s, starting again (%s)",
+                filename,
+                status["error"],
+            )
+            self._forget(filename)
+            return None, 0
+
+        offset = _next_offset(status, session["committed"])
+        logger.info("Resuming upload of %s from byte %s", filename, offset)
+        return session, offset
+
+    def _cancel(self, graph, filename):
+        with self._lock:
+            session = self._load().get(filename)
+        if session is None:
+            return
+
+        # Best effort, the session expires by itself anyway
+        graph.request(session["uploadUrl"], method="DELETE", auth=False)
+        self._forget(filename)
+
+    def _update(self, filename, **kwargs):
+        with self._lock:
+            session = self._load().get(filename)
+            if session is not None:
+                session.update({k: v for k, v in kwargs.items() if v is not None})
+                self._save()
+
+    def _forget(self, filename):
+        with self._lock:
+            if self._load().pop(filename, None) is not None:
+                self._save()
+
+    def _load(self):
+        if self._sessions is not None:
+            return self._sessions
+
+        state = load_state(self.path, self.STATE_VERSION, "upload sessions")
+        self._sessions = state.get("sessions", {}) if state is not None else {}
+
+        return self._sessions
+
+    def _save(self):
+        save_state(
+            self.path,
+            self.STATE_VERSION,
+            {"sessions": self._sessions},
+            "upload sessions",
+        )
+
+    @staticmethod
+    def _upload_empty(graph, folder_id, filename):
+        response = graph.request(
+            f"/me/drive/items/{folder_id}:/{urllib.parse.quote(filename.lstrip('/'))}:/content",
+            method="PUT",
+            data=b"",
+        )
+        if "error" in response:
+            raise UploadError(response["error"])
+        return _uploaded(response)
+
+
+def _uploaded(item):
+    return {
+        "id": item.get("id", ""),
+        "eTag": item.get("eTag", ""),
+        "hash": content_hash(item),
+    }
+
+
+def _next_offset(response, default):
+    # Graph lists the ranges it still needs, e.g. ["12345-"] or ["0-511", "1024-"]
+    ranges = response.get("nextExpectedRanges")
+    if ranges:
+        return int(ranges[0].split("-")[0])
+    return default
+
+
+def _expired(session, now):
+    return session.get("expires") is not None and session["expires"] <= now
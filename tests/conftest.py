@@ -0,0 +1,11 @@
+import pytest
+
+from benchmarks import fakes
+
+
+@pytest.fixture(scope="session", autouse=True)
+def octoprint_basedir(tmp_path_factory):
+    """OctoPrint's settings & plugin manager, which file type checks rely on"""
+    basedir = tmp_path_factory.mktemp("octoprint")
+    fakes.init_octoprint(str(basedir))
+    return basedir
@@ -0,0 +1,126 @@
+"""
+Deleting files from OneDrive through $batch requests, against the fake Graph server from the
+benchmarks
+"""
+import logging
+
+import pytest
+
+from benchmarks import fakes
+from octoprint_onedrive_files.graph import BATCH_SIZE
+from octoprint_onedrive_files.index import SyncIndex
+from octoprint_onedrive_files.sync import (
+    delete_onedrive,
+    list_onedrive_files,
+    onedrive_action,
+)
+
+FILES = BATCH_SIZE + 5  # Enough for more than one batch
+
+
+@pytest.fixture
+def tree():
+    return fakes.RemoteTree(FILES, 0, 0)
+
+
+@pytest.fixture
+def graph(tree):
+    with fakes.FakeGraphClient(tree) as graph:
+        yield graph
+
+
+@pytest.fixture
+def listing(graph):
+    return list_onedrive_files(graph, fakes.ROOT_ID, 0)
+
+
+@pytest.fixture
+def index(tmp_path, listing):
+    index = SyncIndex(str(tmp_path / "index.db"))
+    for path, item in listing.items():
+        index.update(path, item["id"], item["eTag"], item["size"], 0.0, item["hash"])
+    yield index
+    index.close()
+
+
+def delete_actions(listing, paths=None):
+    return [
+        onedrive_action("delete_onedrive", path, listing)
+        for path in (paths if paths is not None else sorted(listing))
+    ]
+
+
+def test_batch_maps_responses_back_to_requests(tree, graph, listing):
+    paths = sorted(listing)
+    missing = set(paths[::3])
+    for path in missing:
+        tree.delete(path)
+
+    requests = [
+        {"id": f"request-{i}", "method": "DELETE", "url": f"/me/drive/items/{item_id}"}
+        for i, item_id in enumerate(listing[path]["id"] for path in paths)
+    ]
+    responses = graph.batch(requests)
+
+    assert len(responses) == len(paths)
+    for i, path in enumerate(paths):
+        expected = 404 if path in missing else 204
+        assert responses[f"request-{i}"]["status"] == expected, path
+
+
+def test_delete_onedrive(tree, graph, listing, index):
+    failed = delete_onedrive(graph, index, delete_actions(listing))
+
+    assert failed == []
+    assert tree.paths == {}
+    assert index.files() == {}
+
+
+def test_delete_onedrive_counts_not_found_as_deleted(tree, graph, listing, index):
+    gone = sorted(listing)[:3]
+    for path in gone:
+        tree.delete(path)
+
+    failed = delete_onedrive(graph, index, delete_actions(listing, gone))
+
+    assert failed == []
+    assert not set(gone) & set(index.files())
+
+
+def test_delete_onedrive_skips_files_changed_since_listing(
+    tree, graph, listing, index, caplog
+):
+    paths = sorted(listing)
+    changed = paths[1]
+    tree.modify(changed)
+
+    with caplog.at_level(logging.ERROR):
+        failed = delete_onedrive(graph, index, delete_actions(listing))
+
+    assert [action["file"] for action in failed] == [changed]
+    assert "preconditionFailed" in caplog.text
+
+    # Left alone in OneDrive, and still tracked
+    assert list(tree.paths) == [changed]
+    assert list(index.files()) == [changed]
+
+
+def test_delete_onedrive_resends_throttled_items(tree, graph, listing, index):
+    graph.throttle_batch_items = 7
+
+    failed = delete_onedrive(graph, index, delete_actions(listing))
+
+    assert failed == []
+    assert tree.paths == {}
+    assert graph.counters.snapshot()["retries"] == 7
+
+
+def test_delete_onedrive_failed_batch_fails_every_item(tree, graph, listing, index):
+    graph.fail_batches = True
+    actions = delete_actions(listing)
+
+    failed = delete_onedrive(graph, index, actions)
+
+    assert failed == actions
+    assert sorted(tree.paths) == sorted(listing)
+    assert sorted(index.files()) == sorted(listing)
@@ -0,0 +1,66 @@
+"""
+Listing OneDrive incrementally with delta queries, against the fake Graph server from the
+benchmarks
+"""
+import json
+
+import pytest
+
+from benchmarks import fakes
+from octoprint_onedrive_files.delta import DeltaListing
+
+
+@pytest.fixture
+def tree():
+    return fakes.RemoteTree(5, 1, 1)
+
+
+@pytest.fixture
+def graph(tree):
+    with fakes.FakeGraphClient(tree) as graph:
+        yield graph
+
+
+@pytest.fixture
+def state_path(tmp_path):
+    return tmp_path / "delta.json"
+
+
+def list_files(graph, state_path):
+    # A new listing each time, as after a restart
+    return DeltaListing(str(state_path)).list_files(graph, fakes.ROOT_ID, 5)
+
+
+def test_unchanged_listing_is_not_saved(graph, state_path, monkeypatch):
+    first = list_files(graph, state_path)
+    saves = []
+    monkeypatch.setattr(DeltaListing, "_save", lambda self: saves.append(self))
+
+    second = list_files(graph, state_path)
+
+    assert second.keys() == first.keys()
+    assert saves == []
+
+
+def test_changed_listing_is_saved(tree, graph, state_path):
+    files = list_files(graph, state_path)
+    changed = sorted(files)[0]
+    tree.modify(changed)
+
+    list_files(graph, state_path)
+
+    state = json.loads(state_path.read_text())
+    assert state["items"][files[changed]["id"]]["eTag"] != files[changed]["eTag"]
+
+
+def test_download_urls_are_not_saved(tree, graph, state_path):
+    files = list_files(graph, state_path)
+    assert all(item["downloadUrl"] for item in files.values())
+    assert "downloadUrl" not in state_path.read_text()
+
+    changed = sorted(files)[0]
+    tree.modify(changed)
+    files = list_files(graph, state_path)
+
+    # Only the changed file was listed again, the others go through /content
+    assert {path for path, item in files.items() if item["downloadUrl"]} == {changed}
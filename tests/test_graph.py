@@ -0,0 +1,40 @@
+"""
+Requests sent through the GraphClient, against the fake Graph server from the benchmarks
+"""
+import logging
+
+import pytest
+import requests
+
+from benchmarks import fakes
+
+UPLOAD_URL = "https://api.onedrive.com/rup/secret-token/upload?auth=secret-token"
+
+
+@pytest.fixture
+def graph():
+    with fakes.FakeGraphClient(fakes.RemoteTree(1, 0, 0)) as graph:
+        yield graph
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        "404 Client Error: Not Found for url: {url}",
+        "HTTPSConnectionPool(host='api.onedrive.com', port=443): Max retries exceeded "
+        "with url: {path} (Caused by NewConnectionError('Failed to connect'))",
+    ],
+)
+def test_failed_request_keeps_url_out_of_logs(graph, monkeypatch, caplog, error):
+    def fail(method, url, **kwargs):
+        path = url.split("api.onedrive.com", 1)[1]
+        raise requests.ConnectionError(error.format(url=url, path=path))
+
+    monkeypatch.setattr(graph, "_transport", fail)
+
+    with caplog.at_level(logging.DEBUG):
+        result = graph.request(UPLOAD_URL, method="PUT", data=b"chunk", auth=False)
+
+    assert result["error"]["code"] == "requestFailed"
+    assert "secret-token" not in result["error"]["message"]
+    assert "secret-token" not in caplog.text
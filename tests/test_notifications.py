@@ -0,0 +1,154 @@
+"""
+Subscribing to Graph change notifications, against the fake Graph server from the
+benchmarks
+"""
+import json
+import time
+
+import pytest
+
+from benchmarks import fakes
+from octoprint_onedrive_files.notifications import (
+    RENEW_BEFORE,
+    RETRY_AFTER_FAILURE,
+    NotificationSubscription,
+)
+
+NOTIFICATION_URL = "https://octopi.invalid/plugin/onedrive_files/notifications"
+
+
+@pytest.fixture
+def graph():
+    with fakes.FakeGraphClient(fakes.RemoteTree(10, 1, 1)) as graph:
+        yield graph
+
+
+@pytest.fixture
+def woken():
+    return []
+
+
+@pytest.fixture
+def subscription(tmp_path, graph, woken):
+    subscription = NotificationSubscription(str(tmp_path / "subscription.json"))
+
+    # Graph validates the endpoint while subscribing
+    graph.validate = lambda url, token: subscription.handle(
+        {"validationToken": token}, b"", lambda: woken.append(True)
+    )[0]
+    return subscription
+
+
+def post(subscription, woken, body):
+    return subscription.handle({}, body, lambda: woken.append(True))
+
+
+def notifications(graph):
+    # Bodies Graph would send now, one per subscription
+    return [json.dumps(body).encode() for body in graph.notifications().values()]
+
+
+def test_subscribe(graph, subscription):
+    subscription.maintain(graph, NOTIFICATION_URL, fakes.ROOT_ID)
+
+    assert len(graph.subscriptions) == 1
+    assert subscription.due_in(NOTIFICATION_URL, fakes.ROOT_ID) > 0
+
+
+def test_notification_wakes_sync(graph, subscription, woken):
+    subscription.maintain(graph, NOTIFICATION_URL, fakes.ROOT_ID)
+
+    statuses = [post(subscription, woken, body)[1] for body in notifications(graph)]
+
+    assert statuses == [202]
+    assert woken == [True]
+
+
+def test_forged_notification_is_ignored(graph, subscription, woken):
+    subscription.maintain(graph, NOTIFICATION_URL, fakes.ROOT_ID)
+
+    for body in graph.notifications().values():
+        body["value"][0]["clientState"] = "forged"
+        assert post(subscription, woken, json.dumps(body).encode())[1] == 202
+
+    assert woken == []
+
+
+def test_malformed_notification_is_rejected(subscription, woken):
+    assert post(subscription, woken, b"not json")[1] == 400
+    assert woken == []
+
+
+def test_renew(tmp_path, graph, subscription):
+    subscription.maintain(graph, NOTIFICATION_URL, fakes.ROOT_ID)
+    # Close to expiry, as if OctoPrint had been off for a while
+    subscription._set(
+        dict(subscription._load(), expires=time.time() + RENEW_BEFORE / 2)
+    )
+
+    subscription = NotificationSubscription(str(tmp_path / "subscription.json"))
+    subscription.maintain(graph, NOTIFICATION_URL, fakes.ROOT_ID)
+
+    assert subscription.due_in(NOTIFICATION_URL, fakes.ROOT_ID) > RENEW_BEFORE / 2
+    assert len(graph.subscriptions) == 1
+
+
+def test_resubscribe_when_url_changes(graph, subscription):
+    subscription.maintain(graph, NOTIFICATION_URL, fakes.ROOT_ID)
+
+    subscription.maintain(graph, NOTIFICATION_URL + "?moved", fakes.ROOT_ID)
+
+    urls = [s["notificationUrl"] for s in graph.subscriptions.values()]
+    assert urls == [NOTIFICATION_URL + "?moved"]
+
+
+def test_unsubscribe_when_disabled(graph, subscription):
+    subscription.maintain(graph, NOTIFICATION_URL, fakes.ROOT_ID)
+
+    subscription.maintain(graph, "", fakes.ROOT_ID)
+
+    assert not graph.subscriptions
+    assert subscription.due_in("", fakes.ROOT_ID) is None
+
+
+def test_failed_subscribe_is_retried_later(graph, subscription):
+    graph.validate = lambda url, token: "wrong"
+
+    subscription.maintain(graph, NOTIFICATION_URL, fakes.ROOT_ID)
+
+    assert not graph.subscriptions
+    assert subscription.due_in(NOTIFICATION_URL, fakes.ROOT_ID) > 0
+
+
+def test_no_retry_once_disabled(graph, subscription):
+    graph.validate = lambda url, token: "wrong"
+    subscription.maintain(graph, NOTIFICATION_URL, fakes.ROOT_ID)
+
+    subscription.maintain(graph, "", fakes.ROOT_ID)
+
+    assert subscription.due_in("", fakes.ROOT_ID) is None
+    # Nothing left over for when they are enabled again
+    assert subscription.due_in(NOTIFICATION_URL, fakes.ROOT_ID) is None
+
+
+def test_renewal_error_is_retried_later(graph, subscription, monkeypatch):
+    subscription.maintain(graph, NOTIFICATION_URL, fakes.ROOT_ID)
+    # Close to expiry, and then offline so there is no token to send
+    subscription._set(
+        dict(subscription._load(), expires=time.time() + RENEW_BEFORE / 2)
+    )
+    offline = []
+
+    def get_headers():
+        offline.append(True)
+        raise ConnectionError("offline")
+
+    monkeypatch.setattr(graph.onedrive, "_get_headers", get_headers)
+
+    with pytest.raises(ConnectionError):
+        subscription.maintain(graph, NOTIFICATION_URL, fakes.ROOT_ID)
+
+    due_in = subscription.due_in(NOTIFICATION_URL, fakes.ROOT_ID)
+    assert RETRY_AFTER_FAILURE - 60 < due_in <= RETRY_AFTER_FAILURE
+    subscription.maintain(graph, NOTIFICATION_URL, fakes.ROOT_ID)
+    assert len(offline) == 1
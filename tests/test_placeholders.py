@@ -0,0 +1,100 @@
+"""
+Placeholders for files in OneDrive, swapped for the real file when it is downloaded
+"""
+import os
+
+import pytest
+
+from benchmarks import fakes
+from octoprint_onedrive_files.downloads import DownloadStaging
+from octoprint_onedrive_files.index import SyncIndex
+from octoprint_onedrive_files.placeholders import (
+    placeholder_name,
+    read_placeholder,
+    write_placeholder,
+)
+from octoprint_onedrive_files.sync import download_onedrive, list_onedrive_files
+
+
+@pytest.fixture
+def tree():
+    return fakes.RemoteTree(3, 0, 0, file_size=1000)
+
+
+@pytest.fixture
+def graph(tree):
+    with fakes.FakeGraphClient(tree) as graph:
+        yield graph
+
+
+@pytest.fixture
+def file_manager(tmp_path):
+    return fakes.make_file_manager(str(tmp_path / "uploads"))
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = SyncIndex(str(tmp_path / "index.db"))
+    yield index
+    index.close()
+
+
+@pytest.fixture
+def staging(tmp_path):
+    return DownloadStaging(str(tmp_path / "downloads"))
+
+
+def test_read_placeholder_keeps_missing_fields_empty(tmp_path):
+    path = write_placeholder(
+        str(tmp_path), {"id": "item-1", "eTag": '"{item-1},1"', "size": 1000}
+    )
+
+    assert read_placeholder(path) == {
+        "id": "item-1",
+        "eTag": '"{item-1},1"',
+        "hash": "",
+        "size": 1000,
+    }
+
+
+def test_download_placeholder_without_hash(graph, file_manager, index, staging):
+    # As for files evicted before their hash was known, e.g. seeded into the index
+    filename, item = sorted(list_onedrive_files(graph, fakes.ROOT_ID, 0).items())[0]
+    item = dict(item, hash=None)
+    download_onedrive(
+        file_manager, graph, index, staging, filename, item, placeholder=True
+    )
+
+    path = f"OneDrive{filename}"
+    placeholder = file_manager.path_on_disk("local", placeholder_name(path))
+    stored = read_placeholder(placeholder)
+    download_onedrive(file_manager, graph, index, staging, filename, stored)
+
+    assert os.path.getsize(file_manager.path_on_disk("local", path)) == 1000
+    assert not os.path.exists(placeholder)
+    assert index.get(filename)["hash"] == ""
+
+
+def test_placeholder_leaves_file_in_use(graph, file_manager, index, staging):
+    # e.g. downloaded from its placeholder since the sync decided to add a placeholder
+    filename, item = sorted(list_onedrive_files(graph, fakes.ROOT_ID, 0).items())[0]
+    download_onedrive(file_manager, graph, index, staging, filename, item)
+
+    path = f"OneDrive{filename}"
+    added = download_onedrive(
+        file_manager,
+        graph,
+        index,
+        staging,
+        filename,
+        item,
+        placeholder=True,
+        in_use=lambda in_use_path: in_use_path == path,
+    )
+
+    assert not added
+    assert os.path.getsize(file_manager.path_on_disk("local", path)) == 1000
+    assert not os.path.exists(
+        file_manager.path_on_disk("local", placeholder_name(path))
+    )
+    assert os.listdir(staging.folder) == []
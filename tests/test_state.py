@@ -0,0 +1,41 @@
+"""
+State persisted as JSON in the plugin's data folder
+"""
+from octoprint_onedrive_files.history import SyncHistory, history_entry
+from octoprint_onedrive_files.state import load_state, save_state
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "state.json")
+
+    assert save_state(path, 2, {"items": {"a": 1}}, "test state")
+
+    assert load_state(path, 2, "test state") == {"version": 2, "items": {"a": 1}}
+
+
+def test_other_version_is_ignored(tmp_path):
+    path = str(tmp_path / "state.json")
+    save_state(path, 1, {"items": {"a": 1}}, "test state")
+
+    assert load_state(path, 2, "test state") is None
+
+
+def test_unreadable_state_is_ignored(tmp_path):
+    path = tmp_path / "state.json"
+    path.write_text('{"version": 2, "items": {')
+
+    assert load_state(str(path), 2, "test state") is None
+    assert load_state(str(tmp_path / "missing.json"), 2, "test state") is None
+
+
+def test_in_memory_state_is_not_saved():
+    assert not save_state(None, 1, {}, "test state")
+    assert load_state(None, 1, "test state") is None
+
+
+def test_history_survives_restart(tmp_path):
+    path = str(tmp_path / "history.json")
+    entry = history_entry(1000.0, 2.5, "manual")
+    SyncHistory(path).add(entry)
+
+    assert SyncHistory(path).runs() == [entry]
@@ -0,0 +1,66 @@
+"""
+Stand-in for Graph's change notifications, to try the notification endpoint without OneDrive
+
+Usage: python tools/fake_notifier.py send URL [--state FILE] [--bad-secret]
+
+send: acts as Graph towards a running OctoPrint. Sends the validation request Graph makes
+    when subscribing, then a change notification for the subscription saved in the plugin's
+    data folder, which should start a sync. With --bad-secret the notification carries the
+    wrong clientState, and should be ignored (check octoprint.log).
+
+The subscription lifecycle itself is covered by tests/test_notifications.py, against the
+fake Graph server from benchmarks/fakes.py.
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import requests  # noqa: E402
+
+from octoprint_onedrive_files.graph import format_time  # noqa: E402
+
+DEFAULT_STATE = os.path.expanduser("~/.octoprint/data/onedrive_files/subscription.json")
+
+
+def send(url, state_path, bad_secret=False):
+    with open(state_path, encoding="utf-8") as f:
+        subscription = json.load(f)["subscription"]
+    if subscription is None:
+        sys.exit("No subscription saved, enable change notifications first")
+
+    response = requests.post(url, params={"validationToken": "fake-token"}, timeout=10)
+    print(f"Validation: {response.status_code} {response.text!r}")
+
+    notification = {
+        "value": [
+            {
+                "subscriptionId": subscription["id"],
+                "clientState": "wrong" if bad_secret else subscription["clientState"],
+                "changeType": "updated",
+                "resource": f"/me/drive/items/{subscription['folder']}",
+                "subscriptionExpirationDateTime": format_time(subscription["expires"]),
+            }
+        ]
+    }
+    response = requests.post(url, json=notification, timeout=10)
+    print(f"Notification: {response.status_code}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    send_parser = commands.add_parser("send", help="Notify a running OctoPrint")
+    send_parser.add_argument("url", help="URL of the plugin's notification endpoint")
+    send_parser.add_argument("--state", default=DEFAULT_STATE)
+    send_parser.add_argument("--bad-secret", action="store_true")
+
+    args = parser.parse_args()
+    send(args.url, args.state, args.bad_secret)
+
+
+if __name__ == "__main__":
+    main()